@@ -1,24 +1,53 @@
+import time
+# startup is timed from here, which doesn't include starting the interpreter
+STARTUP_TIME = time.perf_counter()
 import os
 import sys
 import asyncio
 import signal
 import logging
 import inspect
-from typing import Set, Tuple, Awaitable
+import gc
+from typing import IO, Set, Tuple, Awaitable, Callable, Iterable
 
-logging.basicConfig(filename="/tmp/battery-analytics-decky.log",
-					format='[BatteryAnalytics] %(asctime)s %(levelname)s %(message)s',
-					filemode='w+',
-					force=True)
+from log_pipeline import setup_logging
+log_pipeline = setup_logging("/tmp/battery-analytics-decky.log",
+	level=logging.INFO) # can be changed to logging.DEBUG for debugging issues
 logger=logging.getLogger()
-logger.setLevel(logging.INFO) # can be changed to logging.DEBUG for debugging issues
 
-from utils import try_logexcept_awaitable
+from utils import try_logexcept_awaitable, use_pidfd_child_watcher
+from profiler import PROFILE_MODE_SAMPLE
+from backend_stats import backend_stats, startup_report, process_stats, LoopLagMonitor
+from tracing import tracer, current_trace_id
 from pipetalk import PipeTalker, PipeTalkRequest, PipeTalkData
-from plugin import Plugin
+from plugin import Plugin, PLUGIN_METHOD_LANES
+from paths import BACKEND_DIR, DAEMON_SOCKET_PATH, DAEMON_LOCK_PATH
+from daemon import DaemonLock, DaemonServer, get_backend_version
+
+startup_report.start_time = STARTUP_TIME
+startup_report.record("imports", time.perf_counter() - STARTUP_TIME)
 
 current_tasks: Set[Tuple[str,Awaitable]] = set()
 
+# seconds to profile for when SIGUSR1 is received
+SIGNAL_PROFILE_SECONDS = 30
+
+# run as a daemon serving clients on a unix socket, instead of a child process serving its parent through stdin/stdout
+DAEMON_MODE = "--daemon" in sys.argv[1:]
+# set to stop the daemon
+daemon_stop_evt: asyncio.Event = None
+# pipetalkers of the clients connected to the daemon
+daemon_clients: Set[PipeTalker] = set()
+# number of clients that connected to the daemon, used to name their stats sources
+daemon_client_count: int = 0
+# hash of the backend files the daemon was started from, which clients compare with their own
+daemon_version: str = None
+# seconds between checks that the backend files still exist, so the daemon stops once the plugin is uninstalled
+DAEMON_CHECK_INTERVAL = 60.0
+
+# seconds to wait for a client to take a data change notification
+DATA_CHANGED_TIMEOUT = 10.0
+
 async def handle_request(req: PipeTalkRequest) -> PipeTalkData:
 	req_data = req.get_data()
 	if req_data is None:
@@ -32,16 +61,61 @@ async def call_plugin_method(name: str, kwargs: dict):
 	global plugin
 	global current_tasks
 	func = getattr(plugin, name)
-	if asyncio.iscoroutinefunction(func):
-		task = func(**kwargs)
-		task_tuple = (name, task)
-		current_tasks.add(task_tuple)
-		try:
-			return await task
-		finally:
-			current_tasks.remove(task_tuple)
-	else:
-		return func(**kwargs)
+	backend_stats.increment("plugin.calls")
+	start_time = time.perf_counter()
+	try:
+		if asyncio.iscoroutinefunction(func):
+			task = func(**kwargs)
+			task_tuple = (name, task)
+			current_tasks.add(task_tuple)
+			try:
+				return await task
+			finally:
+				current_tasks.remove(task_tuple)
+		else:
+			return func(**kwargs)
+	except asyncio.CancelledError:
+		backend_stats.increment("plugin.cancelled")
+		raise
+	except BaseException:
+		backend_stats.increment("plugin.errors")
+		raise
+	finally:
+		end_time = time.perf_counter()
+		backend_stats.record("plugin.call."+name, end_time - start_time)
+		trace_id = current_trace_id.get()
+		if trace_id is not None:
+			tracer.record_span("plugin."+name, trace_id, start_time, end_time)
+
+# handle a request from a daemon client
+#  The daemon owns the plugin, so clients loading and unloading the plugin only attach and detach.
+async def handle_daemon_request(req: PipeTalkRequest) -> PipeTalkData:
+	if req.method_name == "_main" or req.method_name == "_unload":
+		return None
+	elif req.method_name == "stop_daemon":
+		logger.info("daemon stop requested")
+		daemon_stop_evt.set()
+		return None
+	elif req.method_name == "get_daemon_version":
+		return {"version": daemon_version, "pid": os.getpid()}
+	return await handle_request(req)
+
+# tell clients that logs were written, so they can drop cached query results
+def notify_data_changed(pipetalkers: Iterable[PipeTalker], changes: dict):
+	for pipetalker in pipetalkers:
+		asyncio.create_task(try_logexcept_awaitable(pipetalker.request("data_changed", changes, timeout=DATA_CHANGED_TIMEOUT)))
+
+def add_signal_handlers(loop: asyncio.AbstractEventLoop, on_stop: Callable[[],None]):
+	def on_signal(sig):
+		logger.info("signal %s received", sig)
+		on_stop()
+	for sig in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(sig, lambda s=sig:on_signal(int(s)))
+	# profile in place with `kill -USR1 <pid>`
+	def on_profile_signal():
+		logger.info("profile signal received, profiling for %s seconds", SIGNAL_PROFILE_SECONDS)
+		asyncio.create_task(try_logexcept_awaitable(plugin.profile(seconds=SIGNAL_PROFILE_SECONDS, mode=PROFILE_MODE_SAMPLE)))
+	loop.add_signal_handler(signal.SIGUSR1, on_profile_signal)
 
 async def run():
 	global current_tasks
@@ -49,21 +123,30 @@ async def run():
 	try:
 		loop = asyncio.get_event_loop()
 		pipetalker = PipeTalker(
-			reader=sys.stdin,
-			writer=sys.stdout,
+			reader=sys.stdin.buffer,
+			writer=sys.stdout.buffer,
 			request_handler=lambda res:handle_request(res))
+		pipetalker.method_lanes = PLUGIN_METHOD_LANES
+		plugin.on_data_changed = lambda changes:notify_data_changed([pipetalker], changes)
+		backend_stats.add_source("pipetalk", pipetalker.stats)
+		backend_stats.add_gauge("plugin.current_tasks", lambda:len(current_tasks))
+		backend_stats.add_source("logging", log_pipeline.stats)
+		backend_stats.add_source("process", process_stats)
+		
+		# measure event loop lag
+		loop_lag_monitor = LoopLagMonitor()
+		loop_lag_monitor.start()
 		
 		# handle signals
-		def on_signal(sig):
-			logger.info("signal {} received".format(str(sig)))
-			asyncio.create_task(try_logexcept_awaitable(pipetalker.unlisten()))
-		for sig in (signal.SIGINT, signal.SIGTERM):
-			loop.add_signal_handler(sig, lambda s=sig:on_signal(int(s)))
+		add_signal_handlers(loop, lambda:asyncio.create_task(try_logexcept_awaitable(pipetalker.unlisten())))
 		
 		# start listening for input
-		pipetalker.listen()
+		await pipetalker.listen_async()
+		startup_report.mark("listening")
 		await pipetalker.wait()
 		
+		await loop_lag_monitor.stop()
+		
 		# unload plugin or wait for unload to finish
 		if plugin.started:
 			await plugin._unload()
@@ -75,8 +158,106 @@ async def run():
 					await task
 	except BaseException as error:
 		logger.exception(error)
+	finally:
+		await close_plugin_db()
+
+# close the DB if unloading the plugin didn't get to it, so everything written is committed before the process exits
+async def close_plugin_db():
+	try:
+		if plugin.db is not None:
+			await plugin.db.close()
+	except BaseException as error:
+		logger.exception(error)
+
+# serve a client of the daemon until it disconnects
+async def serve_daemon_client(reader: IO, writer: IO):
+	global daemon_client_count
+	pipetalker = PipeTalker(
+		reader=reader,
+		writer=writer,
+		request_handler=lambda res:handle_daemon_request(res))
+	pipetalker.method_lanes = PLUGIN_METHOD_LANES
+	daemon_client_count += 1
+	stats_source_name = "pipetalk.client"+str(daemon_client_count)
+	logger.info("daemon client connected")
+	try:
+		await pipetalker.listen_async()
+		daemon_clients.add(pipetalker)
+		backend_stats.add_source(stats_source_name, pipetalker.stats)
+		await pipetalker.wait()
+	finally:
+		daemon_clients.discard(pipetalker)
+		backend_stats.remove_source(stats_source_name)
+		await pipetalker.unlisten()
+		logger.info("daemon client disconnected")
+
+# stop the daemon once the backend files are removed, since nothing would attach to it again
+async def stop_daemon_when_uninstalled():
+	while os.path.exists(BACKEND_DIR+"/__main__.py"):
+		await asyncio.sleep(DAEMON_CHECK_INTERVAL)
+	logger.info("backend files were removed, stopping daemon")
+	daemon_stop_evt.set()
+
+async def run_daemon():
+	global daemon_stop_evt
+	global daemon_version
+	global plugin
+	lock = DaemonLock(DAEMON_LOCK_PATH)
+	if not lock.acquire():
+		logger.info("backend daemon is already running")
+		return
+	try:
+		loop = asyncio.get_event_loop()
+		daemon_stop_evt = asyncio.Event()
+		daemon_version = get_backend_version(BACKEND_DIR)
+		logger.info("backend daemon version "+daemon_version)
+		backend_stats.add_gauge("plugin.current_tasks", lambda:len(current_tasks))
+		backend_stats.add_source("logging", log_pipeline.stats)
+		backend_stats.add_source("process", process_stats)
+		
+		# measure event loop lag
+		loop_lag_monitor = LoopLagMonitor()
+		loop_lag_monitor.start()
+		
+		# handle signals
+		add_signal_handlers(loop, daemon_stop_evt.set)
+		
+		# tell connected clients when logs are written
+		plugin.on_data_changed = lambda changes:notify_data_changed(list(daemon_clients), changes)
+		# start the plugin, which keeps running while clients come and go
+		await plugin._main()
+		server = DaemonServer(DAEMON_SOCKET_PATH, serve_daemon_client)
+		backend_stats.add_gauge("daemon.clients", lambda:server.connection_count)
+		await server.start()
+		startup_report.mark("listening")
+		uninstall_check_task = asyncio.create_task(stop_daemon_when_uninstalled())
+		await daemon_stop_evt.wait()
+		uninstall_check_task.cancel()
+		
+		# stop serving clients, then unload the plugin
+		await server.close()
+		await loop_lag_monitor.stop()
+		await plugin._unload()
+	except BaseException as error:
+		logger.exception(error)
+	finally:
+		await close_plugin_db()
+		lock.release()
 
+tracer.process_name = "backend"
 plugin = Plugin()
+# everything but the DB and the log file runs on the event loop, so don't start a thread for each upower process
+use_pidfd_child_watcher()
 
-logger.info("running plugin")
-asyncio.run(run())
+if DAEMON_MODE:
+	logger.info("running plugin daemon")
+	asyncio.run(run_daemon())
+else:
+	logger.info("running plugin")
+	asyncio.run(run())
+# write the rest of the log and stop its listener thread, then let the interpreter exit normally so buffered
+# output is flushed
+log_pipeline.stop()
+# the DB is closed and the log is written by now, so keep the garbage collector from going through every object
+# while the interpreter finalizes, which otherwise takes longer than unloading the plugin
+gc.freeze()
@@ -0,0 +1,251 @@
+from typing import Callable, Dict, List
+from contextlib import contextmanager
+import os
+import time
+import asyncio
+import resource
+import threading
+import logging
+
+logger = logging.getLogger()
+
+# Latency histogram
+#  Values are recorded in microseconds into log-linear buckets: 8 buckets for each power of two, so any
+#  recorded value is within 12.5% of its bucket. Recording is a few integer operations, so it's cheap
+#  enough to leave enabled, and memory stays fixed no matter how many values are recorded.
+
+HISTOGRAM_SUB_BUCKET_BITS = 3
+HISTOGRAM_SUB_BUCKETS = 1 << HISTOGRAM_SUB_BUCKET_BITS
+# enough buckets for values up to 2^40 microseconds
+HISTOGRAM_BUCKET_COUNT = (40 - HISTOGRAM_SUB_BUCKET_BITS + 1) * HISTOGRAM_SUB_BUCKETS
+
+def _bucket_index(value_us: int) -> int:
+	if value_us < HISTOGRAM_SUB_BUCKETS:
+		return value_us
+	exponent = value_us.bit_length() - HISTOGRAM_SUB_BUCKET_BITS - 1
+	index = ((exponent + 1) << HISTOGRAM_SUB_BUCKET_BITS) + ((value_us >> exponent) - HISTOGRAM_SUB_BUCKETS)
+	return min(index, HISTOGRAM_BUCKET_COUNT - 1)
+
+def _bucket_upper_bound(index: int) -> int:
+	if index < HISTOGRAM_SUB_BUCKETS:
+		return index
+	exponent = (index >> HISTOGRAM_SUB_BUCKET_BITS) - 1
+	sub_bucket = (index & (HISTOGRAM_SUB_BUCKETS - 1)) + HISTOGRAM_SUB_BUCKETS
+	return ((sub_bucket + 1) << exponent) - 1
+
+class LatencyHistogram:
+	count: int = 0
+	total_us: int = 0
+	min_us: int = None
+	max_us: int = 0
+	_buckets: List[int]
+
+	def __init__(self):
+		self._buckets = [0] * HISTOGRAM_BUCKET_COUNT
+
+	def record(self, seconds: float):
+		value_us = int(seconds * 1000000)
+		if value_us < 0:
+			value_us = 0
+		self._buckets[_bucket_index(value_us)] += 1
+		self.count += 1
+		self.total_us += value_us
+		if self.min_us is None or value_us < self.min_us:
+			self.min_us = value_us
+		if value_us > self.max_us:
+			self.max_us = value_us
+
+	# get the value that the given fraction of recorded values are at or below, in microseconds
+	def percentile_us(self, fraction: float) -> int:
+		if self.count == 0:
+			return None
+		target = max(1, int(self.count * fraction + 0.5))
+		seen = 0
+		for (index, bucket_count) in enumerate(self._buckets):
+			seen += bucket_count
+			if seen >= target:
+				return min(_bucket_upper_bound(index), self.max_us)
+		return self.max_us
+
+	def to_dict(self) -> dict:
+		if self.count == 0:
+			return {"count": 0}
+		return {
+			"count": self.count,
+			"mean_ms": (self.total_us / self.count) / 1000,
+			"min_ms": self.min_us / 1000,
+			"p50_ms": self.percentile_us(0.5) / 1000,
+			"p90_ms": self.percentile_us(0.9) / 1000,
+			"p99_ms": self.percentile_us(0.99) / 1000,
+			"max_ms": self.max_us / 1000
+		}
+
+
+
+# Backend stats
+#  Latency histograms and counters by name, plus gauges and stats sources that are read when the
+#  stats are requested. Values can be recorded from any thread.
+
+class BackendStats:
+	histograms: Dict[str,LatencyHistogram]
+	counters: Dict[str,int]
+	gauges: Dict[str,Callable[[],float]]
+	sources: Dict[str,Callable[[],dict]]
+	start_time: float
+	_lock: threading.Lock
+
+	def __init__(self):
+		self.histograms = dict()
+		self.counters = dict()
+		self.gauges = dict()
+		self.sources = dict()
+		self.start_time = time.monotonic()
+		self._lock = threading.Lock()
+
+	# record a latency in seconds
+	def record(self, name: str, seconds: float):
+		with self._lock:
+			histogram = self.histograms.get(name, None)
+			if histogram is None:
+				histogram = LatencyHistogram()
+				self.histograms[name] = histogram
+			histogram.record(seconds)
+
+	def increment(self, name: str, amount: int = 1):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	# add a value, like a queue depth, that is read when the stats are requested
+	def add_gauge(self, name: str, getter: Callable[[],float]):
+		self.gauges[name] = getter
+
+	# add a function returning a dictionary of stats for a component, which is called when the stats are requested
+	def add_source(self, name: str, getter: Callable[[],dict]):
+		self.sources[name] = getter
+
+	def remove_source(self, name: str):
+		self.sources.pop(name, None)
+
+	def to_dict(self) -> dict:
+		with self._lock:
+			histograms = {name: histogram.to_dict() for (name, histogram) in self.histograms.items()}
+			counters = self.counters.copy()
+		gauges = dict()
+		for (name, getter) in list(self.gauges.items()):
+			try:
+				gauges[name] = getter()
+			except BaseException as error:
+				gauges[name] = None
+				logger.error("Error reading gauge "+name+": "+str(error))
+		sources = dict()
+		for (name, getter) in list(self.sources.items()):
+			try:
+				sources[name] = getter()
+			except BaseException as error:
+				sources[name] = None
+				logger.error("Error reading stats source "+name+": "+str(error))
+		return {
+			"uptime_seconds": time.monotonic() - self.start_time,
+			"latency": histograms,
+			"counters": counters,
+			"gauges": gauges,
+			"sources": sources
+		}
+
+backend_stats: BackendStats = BackendStats()
+
+# threads of the process and how often it was switched out, to see what its concurrency costs
+#  Voluntary context switches are mostly threads waiting on each other or on I/O, and involuntary ones are
+#  threads being preempted.
+def process_stats() -> dict:
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	try:
+		os_thread_count = len(os.listdir("/proc/self/task"))
+	except OSError:
+		os_thread_count = None
+	return {
+		"threads": os_thread_count,
+		"python_threads": sorted(thread.name for thread in threading.enumerate()),
+		"voluntary_context_switches": usage.ru_nvcsw,
+		"involuntary_context_switches": usage.ru_nivcsw
+	}
+
+
+
+# Event loop lag monitor
+#  Sleeps for a fixed interval and records how late each wakeup is, which is how long callbacks
+#  on the loop were blocking other work.
+
+class LoopLagMonitor:
+	interval: float = 0.5
+	stats: BackendStats
+	_task: asyncio.Task = None
+
+	def __init__(self, stats: BackendStats = backend_stats):
+		self.stats = stats
+
+	def start(self):
+		if self._task is not None:
+			return
+		self._task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		task = self._task
+		if task is None:
+			return
+		task.cancel()
+		await asyncio.wait([task])
+		if self._task is task:
+			self._task = None
+
+	async def _run(self):
+		while True:
+			start_time = time.perf_counter()
+			await asyncio.sleep(self.interval)
+			lag = time.perf_counter() - start_time - self.interval
+			self.stats.record("loop.lag", max(0.0, lag))
+
+
+
+# Startup report
+#  Durations of the phases of starting up, and the times since the start when milestones (like being
+#  ready to serve queries) were reached.
+
+class StartupReport:
+	start_time: float
+	phases: Dict[str,float]
+	milestones: Dict[str,float]
+
+	def __init__(self, start_time: float = None):
+		self.start_time = start_time if start_time is not None else time.perf_counter()
+		self.phases = dict()
+		self.milestones = dict()
+
+	def record(self, name: str, seconds: float):
+		self.phases[name] = seconds
+
+	# time a block as a phase
+	@contextmanager
+	def phase(self, name: str):
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(name, time.perf_counter() - start_time)
+
+	def mark(self, name: str):
+		self.milestones[name] = time.perf_counter() - self.start_time
+
+	def to_dict(self) -> dict:
+		return {
+			"phases_ms": {name: seconds * 1000 for (name, seconds) in self.phases.items()},
+			"milestones_ms": {name: seconds * 1000 for (name, seconds) in self.milestones.items()}
+		}
+
+	def summary(self) -> str:
+		phases = ", ".join("{} {:.1f} ms".format(name, seconds * 1000) for (name, seconds) in self.phases.items())
+		milestones = ", ".join("{} at {:.1f} ms".format(name, seconds * 1000) for (name, seconds) in self.milestones.items())
+		return phases+"; "+milestones
+
+# startup of this process, timed from when this module was first imported
+startup_report: StartupReport = StartupReport()
@@ -0,0 +1,211 @@
+from typing import IO, Awaitable, Callable, Optional, Set, Tuple
+import os
+import fcntl
+import hashlib
+import socket
+import asyncio
+import logging
+
+logger = logging.getLogger()
+
+DaemonConnectionHandler = Callable[[IO,IO],Awaitable[None]]
+
+# seconds for a connected client to send its pipes
+PIPE_HANDOFF_TIMEOUT = 5.0
+
+# get a hash of the backend's source files, so a client can tell if a running daemon was started from other files
+def get_backend_version(backend_dir: str) -> str:
+	digest = hashlib.sha256()
+	for file_name in sorted(os.listdir(backend_dir)):
+		if not file_name.endswith(".py"):
+			continue
+		digest.update(file_name.encode('utf8')+b'\0')
+		with open(os.path.join(backend_dir, file_name), 'rb') as file:
+			digest.update(file.read())
+	return digest.hexdigest()[:16]
+
+# The socket is only used to hand a pair of pipes to the daemon, which a PipeTalker then uses like the
+# pipes of a child process. The asyncio pipe transports treat a readable write end as closed by the other
+# end, so a socket can't be used for both directions.
+
+# connect to a running daemon, or return None if no daemon is listening
+async def connect_daemon(path: str) -> Optional[socket.socket]:
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.setblocking(False)
+	try:
+		await asyncio.get_running_loop().sock_connect(sock, path)
+	except (FileNotFoundError, ConnectionRefusedError):
+		sock.close()
+		return None
+	except:
+		sock.close()
+		raise
+	return sock
+
+# send a new pair of pipes to the daemon through a connected socket, returning the reader and writer for this end
+def send_pipes(sock: socket.socket) -> Tuple[IO, IO]:
+	(daemon_reader_fd, client_writer_fd) = os.pipe()
+	(client_reader_fd, daemon_writer_fd) = os.pipe()
+	try:
+		sock.setblocking(True)
+		socket.send_fds(sock, [b'p'], [daemon_reader_fd, daemon_writer_fd])
+	except:
+		os.close(client_reader_fd)
+		os.close(client_writer_fd)
+		raise
+	finally:
+		os.close(daemon_reader_fd)
+		os.close(daemon_writer_fd)
+		sock.close()
+	return (open(client_reader_fd, 'rb', buffering=0), open(client_writer_fd, 'wb', buffering=0))
+
+# receive the pair of pipes sent by a client, returning the reader and writer for the daemon end
+def receive_pipes(conn: socket.socket) -> Tuple[IO, IO]:
+	try:
+		conn.settimeout(PIPE_HANDOFF_TIMEOUT)
+		(_, fds, _, _) = socket.recv_fds(conn, 1, 2)
+	finally:
+		conn.close()
+	if len(fds) != 2:
+		for fd in fds:
+			os.close(fd)
+		raise ValueError("Expected 2 pipes from daemon client, but received {}".format(len(fds)))
+	return (open(fds[0], 'rb', buffering=0), open(fds[1], 'wb', buffering=0))
+
+
+
+# Daemon lock
+#  An exclusive lock on a file, held for as long as the daemon runs, so only one daemon serves the socket.
+#  The lock is released by the OS if the daemon dies, so a stale socket file can be safely replaced.
+
+class DaemonLock:
+	path: str
+	_fd: int = None
+
+	def __init__(self, path: str):
+		self.path = path
+
+	# try to take the lock, returning False if another daemon holds it
+	def acquire(self) -> bool:
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			os.close(fd)
+			return False
+		os.ftruncate(fd, 0)
+		os.write(fd, str(os.getpid()).encode('utf8'))
+		self._fd = fd
+		return True
+
+	# check if any process holds the lock, without taking it
+	def is_held(self) -> bool:
+		try:
+			fd = os.open(self.path, os.O_RDWR)
+		except FileNotFoundError:
+			return False
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			return True
+		finally:
+			os.close(fd)
+		return False
+
+	def release(self):
+		fd = self._fd
+		if fd is None:
+			return
+		self._fd = None
+		fcntl.flock(fd, fcntl.LOCK_UN)
+		os.close(fd)
+
+
+
+# Daemon server
+#  Listens on a unix domain socket that only the current user can connect to, and calls the connection
+#  handler with a reader and writer for each client. Closing the server cancels the connection handlers.
+
+class DaemonServer:
+	path: str
+	on_connection: DaemonConnectionHandler
+	_sock: socket.socket = None
+	_accept_task: asyncio.Task = None
+	_connection_tasks: Set[asyncio.Task]
+
+	def __init__(self, path: str, on_connection: DaemonConnectionHandler):
+		self.path = path
+		self.on_connection = on_connection
+		self._connection_tasks = set()
+
+	@property
+	def connection_count(self) -> int:
+		return len(self._connection_tasks)
+
+	# start listening (the daemon lock must be held, so any existing socket file is stale)
+	async def start(self):
+		if self._sock is not None:
+			return
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		try:
+			os.unlink(self.path)
+		except FileNotFoundError:
+			pass
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.setblocking(False)
+		old_umask = os.umask(0o177)
+		try:
+			sock.bind(self.path)
+		finally:
+			os.umask(old_umask)
+		sock.listen(4)
+		self._sock = sock
+		self._accept_task = asyncio.create_task(self._accept_connections(sock))
+		logger.info("backend daemon listening on "+self.path)
+
+	async def close(self):
+		sock = self._sock
+		if sock is None:
+			return
+		self._sock = None
+		accept_task = self._accept_task
+		self._accept_task = None
+		if accept_task is not None:
+			accept_task.cancel()
+			await asyncio.wait([accept_task])
+		sock.close()
+		try:
+			os.unlink(self.path)
+		except FileNotFoundError:
+			pass
+		# stop serving connected clients
+		connection_tasks = list(self._connection_tasks)
+		for task in connection_tasks:
+			task.cancel()
+		if len(connection_tasks) > 0:
+			await asyncio.wait(connection_tasks)
+
+	async def _accept_connections(self, sock: socket.socket):
+		loop = asyncio.get_running_loop()
+		while True:
+			try:
+				(conn, _) = await loop.sock_accept(sock)
+			except asyncio.CancelledError:
+				raise
+			except BaseException as error:
+				logger.error("Error accepting daemon connection: "+str(error))
+				await asyncio.sleep(0.1)
+				continue
+			task = asyncio.create_task(self._serve_connection(conn))
+			self._connection_tasks.add(task)
+			task.add_done_callback(self._connection_tasks.discard)
+
+	async def _serve_connection(self, conn: socket.socket):
+		try:
+			(reader, writer) = await asyncio.get_running_loop().run_in_executor(None, receive_pipes, conn)
+			await self.on_connection(reader, writer)
+		except asyncio.CancelledError:
+			pass
+		except BaseException as error:
+			logger.exception(error)
@@ -0,0 +1,150 @@
+from typing import Dict, List
+import datetime
+import logging
+
+from power_history import BatteryStateLog, tzinfo_utc
+
+logger = logging.getLogger()
+
+# maximum deviation allowed when reconstructing each field from the kept logs
+DEFAULT_FIELD_TOLERANCES: Dict[str,float] = {
+	"energy_Wh": 0.05,
+	"energy_rate_W": 0.5,
+	"voltage_V": 0.05,
+	"seconds_till_full": 300,
+	"seconds_till_empty": 300,
+	"percent_current": 0.5
+}
+
+# fields that always cause a log to be kept when they change
+TRANSITION_FIELDS = (
+	"state",
+	"energy_empty_Wh",
+	"energy_full_Wh",
+	"energy_full_design_Wh",
+	"percent_capacity")
+
+
+
+class _DeviceDoor:
+	archived: BatteryStateLog
+	held: BatteryStateLog = None
+	slopes_max: Dict[str,float]
+	slopes_min: Dict[str,float]
+
+	def __init__(self, archived: BatteryStateLog):
+		self.archived = archived
+		self.slopes_max = dict()
+		self.slopes_min = dict()
+
+
+
+# Swinging door compression of battery state logs
+#  Each device keeps the last kept ("archived") log and the latest received ("held") log.
+#  A log is only kept once a straight line from the archived log to the latest log can no longer pass
+#  within the field tolerances of every log received since, or when a transition field changes.
+
+class BatteryLogCompressor:
+	tolerances: Dict[str,float]
+	# a held log is kept if the last kept log for the device is older than this
+	max_interval: datetime.timedelta = datetime.timedelta(minutes=10)
+	received_count: int = 0
+	kept_count: int = 0
+	_doors: Dict[str,_DeviceDoor]
+
+	def __init__(self, tolerances: Dict[str,float] = None):
+		if tolerances is None:
+			tolerances = DEFAULT_FIELD_TOLERANCES.copy()
+		self.tolerances = tolerances
+		self._doors = dict()
+
+	@property
+	def compression_ratio(self) -> float:
+		if self.kept_count == 0:
+			return 1.0
+		return self.received_count / self.kept_count
+
+	def stats(self) -> dict:
+		return {
+			"received": self.received_count,
+			"kept": self.kept_count,
+			"pending": sum(1 for door in self._doors.values() if door.held is not None),
+			"compression_ratio": self.compression_ratio
+		}
+
+	# add a received log, returning the logs that should be written
+	def add(self, log: BatteryStateLog) -> List[BatteryStateLog]:
+		self.received_count += 1
+		return self._keep(self._add(log))
+
+	# get any held logs that haven't been written yet
+	def flush(self, device_path: str = None) -> List[BatteryStateLog]:
+		logs = list()
+		for (door_device_path, door) in self._doors.items():
+			if device_path is not None and door_device_path != device_path:
+				continue
+			if door.held is not None:
+				logs.append(door.held)
+				self._doors[door_device_path] = _DeviceDoor(door.held)
+		return self._keep(logs)
+
+	def _keep(self, logs: List[BatteryStateLog]) -> List[BatteryStateLog]:
+		self.kept_count += len(logs)
+		return logs
+
+	def _add(self, log: BatteryStateLog) -> List[BatteryStateLog]:
+		door = self._doors.get(log.device_path, None)
+		if door is None:
+			self._doors[log.device_path] = _DeviceDoor(log)
+			return [log]
+		archived = door.archived
+		held = door.held
+		dt = self._seconds_between(archived, log)
+		if dt <= 0 or self._is_transition(archived, log):
+			# keep the held log to end the previous segment, then start a new segment at this log
+			self._doors[log.device_path] = _DeviceDoor(log)
+			if held is not None:
+				return [held, log]
+			return [log]
+		if held is not None and dt > self.max_interval.total_seconds():
+			# keep the held log so that the series never goes too long without a point
+			self._doors[log.device_path] = _DeviceDoor(held)
+			return [held] + self._add(log)
+		# narrow the door for each field
+		slopes_max = dict()
+		slopes_min = dict()
+		for (field, tolerance) in self.tolerances.items():
+			val = getattr(log, field)
+			if val is None:
+				continue
+			archived_val = getattr(archived, field)
+			slope_max = (val + tolerance - archived_val) / dt
+			slope_min = (val - tolerance - archived_val) / dt
+			if field in door.slopes_max:
+				# the line to this log must pass within tolerance of every log since the archived log,
+				#  since this log is what gets kept when the door closes
+				slope = (val - archived_val) / dt
+				if slope > door.slopes_max[field] or slope < door.slopes_min[field]:
+					# the door closed, so the held log must be kept and a new segment starts from it
+					self._doors[log.device_path] = _DeviceDoor(held)
+					return [held] + self._add(log)
+				slope_max = min(slope_max, door.slopes_max[field])
+				slope_min = max(slope_min, door.slopes_min[field])
+			slopes_max[field] = slope_max
+			slopes_min[field] = slope_min
+		door.slopes_max = slopes_max
+		door.slopes_min = slopes_min
+		door.held = log
+		return []
+
+	def _is_transition(self, archived: BatteryStateLog, log: BatteryStateLog) -> bool:
+		for field in TRANSITION_FIELDS:
+			if getattr(archived, field) != getattr(log, field):
+				return True
+		for field in self.tolerances:
+			if (getattr(archived, field) is None) != (getattr(log, field) is None):
+				return True
+		return False
+
+	def _seconds_between(self, log_a: BatteryStateLog, log_b: BatteryStateLog) -> float:
+		return (log_b.time.astimezone(tzinfo_utc) - log_a.time.astimezone(tzinfo_utc)).total_seconds()
@@ -0,0 +1,241 @@
+from typing import Any, AsyncIterator, Dict, List, Tuple
+import time
+import inspect
+import asyncio
+import logging
+
+from pipetalk import PipeTalkData, RequestLane, DEFAULT_LANE_LIMITS, LANE_NORMAL
+from pipetalk_codec import to_plain_data
+from backend_stats import backend_stats
+from tracing import tracer
+
+logger = logging.getLogger()
+
+
+
+# Local response
+#  The result or error of one call in a batch, with the accessors of a PipeTalkResponse.
+
+class LocalResponse:
+	result: PipeTalkData = None
+	error: BaseException = None
+
+	def __init__(self, result: PipeTalkData = None, error: BaseException = None):
+		self.result = result
+		self.error = error
+
+	def get_result_data(self) -> PipeTalkData:
+		return self.result
+
+	def get_error(self) -> Exception:
+		return self.error
+
+
+
+# Local backend
+#  Calls the methods of a backend plugin on the current event loop, with the request, stream and batch methods
+#  of the client end of a PipeTalker, so the backend can run in the same process as its caller. Calls are admitted
+#  through the same lanes as in the backend process, but arguments and results are passed without being encoded
+#  and there's no pipe or second interpreter between the caller and the plugin. Values that aren't JSON types
+#  (like datetimes) are still converted in results, the same way the codecs encode them.
+
+class LocalBackend:
+	plugin: Any
+	# the lane for each method name, with unlisted methods using the normal lane
+	method_lanes: Dict[str,str]
+	lanes: Dict[str,RequestLane]
+	running_count: int = 0
+
+	def __init__(self, plugin: Any, method_lanes: Dict[str,str] = None):
+		self.plugin = plugin
+		self.method_lanes = dict(method_lanes) if method_lanes is not None else dict()
+		self.lanes = {lane_name: RequestLane(lane_name, max_concurrent) for (lane_name, max_concurrent) in DEFAULT_LANE_LIMITS.items()}
+
+	def stats(self) -> dict:
+		return {
+			"running_requests": self.running_count,
+			"lanes": {lane_name: lane.stats() for (lane_name, lane) in self.lanes.items()}
+		}
+
+	async def request(self, method_name: str, data: PipeTalkData = None, timeout: float = None) -> PipeTalkData:
+		if timeout is None:
+			return await self._call(method_name, data)
+		return await asyncio.wait_for(self._call(method_name, data), timeout)
+
+	# call multiple methods at once, returning a response for each call in the same order
+	async def batch(self, calls: List[Tuple[str,PipeTalkData]], timeout: float = None) -> List[LocalResponse]:
+		if len(calls) == 0:
+			return []
+		call_results = asyncio.gather(*[self._call(method_name, data) for (method_name, data) in calls], return_exceptions=True)
+		if timeout is None:
+			call_results = await call_results
+		else:
+			call_results = await asyncio.wait_for(call_results, timeout)
+		responses = list()
+		for call_result in call_results:
+			if isinstance(call_result, asyncio.CancelledError):
+				raise call_result
+			elif isinstance(call_result, BaseException):
+				responses.append(LocalResponse(error=call_result))
+			else:
+				responses.append(LocalResponse(result=call_result))
+		return responses
+
+	# iterate the chunks of a method that returns an async generator, holding its lane until iteration stops
+	#  The timeout applies to waiting for each chunk. A method that doesn't return an async generator is a single chunk.
+	async def stream(self, method_name: str, data: PipeTalkData = None, timeout: float = None) -> AsyncIterator[PipeTalkData]:
+		lane = self._get_lane(method_name)
+		await lane.acquire(method_name)
+		self.running_count += 1
+		start_time = time.perf_counter()
+		try:
+			with tracer.span("local_backend.stream "+method_name):
+				result = self._get_method(method_name)(**(data or dict()))
+				if inspect.isawaitable(result):
+					result = await result
+				if inspect.isasyncgen(result):
+					try:
+						while True:
+							try:
+								if timeout is None:
+									chunk = await result.__anext__()
+								else:
+									chunk = await asyncio.wait_for(result.__anext__(), timeout)
+							except StopAsyncIteration:
+								break
+							yield to_plain_data(chunk)
+					finally:
+						await result.aclose()
+				elif result is not None:
+					yield to_plain_data(result)
+			backend_stats.record("local_backend.stream."+method_name, time.perf_counter() - start_time)
+		finally:
+			self.running_count -= 1
+			lane.release()
+
+	async def _call(self, method_name: str, data: PipeTalkData) -> PipeTalkData:
+		lane = self._get_lane(method_name)
+		await lane.acquire(method_name)
+		self.running_count += 1
+		start_time = time.perf_counter()
+		try:
+			with tracer.span("local_backend.call "+method_name):
+				result = self._get_method(method_name)(**(data or dict()))
+				if inspect.isawaitable(result):
+					result = await result
+				if inspect.isasyncgen(result):
+					result = await self._join_chunks(result)
+				result = to_plain_data(result)
+			backend_stats.record("local_backend.call."+method_name, time.perf_counter() - start_time)
+			return result
+		finally:
+			self.running_count -= 1
+			lane.release()
+
+	def _get_method(self, method_name: str):
+		if not isinstance(method_name, str) or method_name.startswith("__"):
+			raise ValueError("Invalid backend method "+str(method_name))
+		return getattr(self.plugin, method_name)
+
+	def _get_lane(self, method_name: str) -> RequestLane:
+		lane_name = self.method_lanes.get(method_name, LANE_NORMAL)
+		lane = self.lanes.get(lane_name, None)
+		if lane is None:
+			logger.warning("unknown lane "+lane_name+" for method "+method_name)
+			lane = self.lanes[LANE_NORMAL]
+		return lane
+
+	# join the chunks of an async generator result into a single result, like a PipeTalker does for requests that weren't streamed
+	async def _join_chunks(self, result: Any) -> PipeTalkData:
+		joined = list()
+		try:
+			async for chunk in result:
+				if isinstance(chunk, list):
+					joined.extend(chunk)
+				else:
+					joined.append(chunk)
+		finally:
+			await result.aclose()
+		return joined
+
+
+
+# compare the latency of calls through a local backend with requests through a pipe to another process if executing directly
+if __name__ == "__main__":
+	import sys
+	import subprocess
+	from pipetalk import PipeTalker, PipeTalkRequest
+
+	ROW = {
+		'device_path': '/org/freedesktop/UPower/devices/battery_BAT1',
+		'time': '2023-01-01 00:00:00.000000+00:00',
+		'state': 'discharging',
+		'energy_Wh': 40.0,
+		'energy_empty_Wh': 0.0,
+		'energy_full_Wh': 40.04,
+		'energy_full_design_Wh': 40.04,
+		'energy_rate_W': 10.5,
+		'voltage_V': 8.1,
+		'seconds_till_full': None,
+		'seconds_till_empty': 13000.0,
+		'percent_current': 80.0,
+		'percent_capacity': 100.0
+	}
+
+	class BenchmarkPlugin:
+		async def get_rows(self, count: int = 1):
+			return [ROW] * count
+
+		async def stream_rows(self, count: int = 1, chunk_size: int = 1000):
+			for chunk_start in range(0, count, chunk_size):
+				yield [ROW] * min(chunk_size, count - chunk_start)
+
+	# serve the benchmark plugin over stdin/stdout, like the backend process does
+	async def serve_benchmark_plugin():
+		plugin = BenchmarkPlugin()
+		async def handle_request(req: PipeTalkRequest) -> PipeTalkData:
+			result = getattr(plugin, req.method_name)(**(req.get_data() or dict()))
+			if inspect.isawaitable(result):
+				result = await result
+			return result
+		server = PipeTalker(reader=sys.stdin.buffer, writer=sys.stdout.buffer, request_handler=handle_request)
+		await server.listen_async()
+		await server.wait()
+
+	async def measure(backend, row_count: int, iterations: int, stream: bool) -> float:
+		async def call():
+			if stream:
+				async for _ in backend.stream("stream_rows", {"count": row_count}):
+					pass
+			else:
+				await backend.request("get_rows", {"count": row_count})
+		await call()
+		start_time = time.perf_counter()
+		for i in range(iterations):
+			await call()
+		return (time.perf_counter() - start_time) / iterations
+
+	async def run_benchmarks():
+		proc = subprocess.Popen([sys.executable, __file__, "--serve"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		client = PipeTalker(reader=proc.stdout, writer=proc.stdin)
+		await client.listen_async()
+		await client.negotiate()
+		print("subprocess: {} framing, {} codec".format(client.framing, client.codec))
+		local_backend = LocalBackend(BenchmarkPlugin())
+		try:
+			for row_count in (1, 100, 1000, 20000):
+				iterations = max(5, 20000 // row_count)
+				for stream in (False, True):
+					subprocess_time = await measure(client, row_count, iterations, stream)
+					local_time = await measure(local_backend, row_count, iterations, stream)
+					print("{} rows, {}: {:.3f} ms per call in a subprocess, {:.3f} ms per call in process".format(
+						row_count, "stream" if stream else "request", subprocess_time * 1000, local_time * 1000))
+		finally:
+			await client.unlisten()
+			proc.stdin.close()
+			proc.wait()
+
+	if "--serve" in sys.argv[1:]:
+		asyncio.run(serve_benchmark_plugin())
+	else:
+		asyncio.run(run_benchmarks())
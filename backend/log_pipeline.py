@@ -0,0 +1,92 @@
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+
+LOG_FORMAT = '[BatteryAnalytics] %(asctime)s %(levelname)s %(message)s'
+# records waiting to be written, after which new records are dropped instead of blocking the logging thread
+LOG_QUEUE_SIZE = 10000
+# size of the log file before it's rotated, and the number of rotated files kept
+LOG_MAX_BYTES = 2097152
+LOG_BACKUP_COUNT = 2
+
+
+
+# Queue handler that drops records instead of blocking when the queue is full
+#  Records are formatted into their final message when they're queued, so their args can't change
+#  before they're written, but the file is only written from the listener thread.
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+	dropped_count: int = 0
+
+	def enqueue(self, record: logging.LogRecord):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped_count += 1
+
+
+
+# Log pipeline
+#  Loggers on any thread only put records on a bounded queue, and a listener thread writes them to a
+#  size-rotated log file. The log file of the previous run is kept as the first rotated file.
+
+class LogPipeline:
+	handler: BoundedQueueHandler
+	listener: logging.handlers.QueueListener
+	file_handler: logging.handlers.RotatingFileHandler
+	_running: bool = False
+
+	def __init__(self, filename: str, level: int = logging.INFO, queue_size: int = LOG_QUEUE_SIZE, max_bytes: int = LOG_MAX_BYTES, backup_count: int = LOG_BACKUP_COUNT):
+		self.file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+		self.file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+		# start each run with a fresh log file
+		if os.path.exists(filename) and os.path.getsize(filename) > 0:
+			self.file_handler.doRollover()
+		self.handler = BoundedQueueHandler(queue.Queue(queue_size))
+		self.listener = logging.handlers.QueueListener(self.handler.queue, self.file_handler, respect_handler_level=True)
+		root_logger = logging.getLogger()
+		for old_handler in list(root_logger.handlers):
+			root_logger.removeHandler(old_handler)
+			old_handler.close()
+		root_logger.addHandler(self.handler)
+		root_logger.setLevel(level)
+
+	@property
+	def dropped_count(self) -> int:
+		return self.handler.dropped_count
+
+	def start(self):
+		if self._running:
+			return
+		self._running = True
+		self.listener.start()
+		atexit.register(self.stop)
+
+	# write any queued records and stop the listener thread
+	def stop(self):
+		if not self._running:
+			return
+		self._running = False
+		self.listener.stop()
+		self.file_handler.close()
+		atexit.unregister(self.stop)
+
+	def stats(self) -> dict:
+		return {
+			"queued": self.handler.queue.qsize(),
+			"dropped": self.handler.dropped_count
+		}
+
+_active_pipeline: LogPipeline = None
+
+# log to a file through a queue and a listener thread, replacing any pipeline that was already set up
+def setup_logging(filename: str, level: int = logging.INFO) -> LogPipeline:
+	global _active_pipeline
+	if _active_pipeline is not None:
+		_active_pipeline.stop()
+	pipeline = LogPipeline(filename, level=level)
+	pipeline.start()
+	_active_pipeline = pipeline
+	return pipeline
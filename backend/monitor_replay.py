@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+from typing import IO, Deque
+import sys
+import time
+import collections
+import logging
+
+logger = logging.getLogger()
+
+# Recording format
+#  {seconds}\t{line}
+#  seconds: seconds since the recording started when the line arrived
+#  line: the raw output line from `upower --monitor-detail`, without the line ending
+
+class MonitorRecorder:
+	stdout: IO[bytes]
+	record_file: IO[str]
+	_start_time: float
+
+	def __init__(self, stdout: IO[bytes], path: str):
+		self.stdout = stdout
+		self.record_file = open(path, 'w')
+		self._start_time = time.monotonic()
+
+	def readline(self) -> bytes:
+		line = self.stdout.readline()
+		if not line:
+			self.close()
+			return line
+		try:
+			self.record(line.decode('utf-8'))
+		except BaseException as error:
+			logger.exception(error)
+		return line
+
+	# record one or more lines of output that arrived at the same time
+	def record(self, data: str):
+		if self.record_file is None:
+			return
+		elapsed = time.monotonic() - self._start_time
+		lines = data.split("\n")
+		if data.endswith("\n"):
+			lines.pop()
+		for line in lines:
+			self.record_file.write("{:.6f}\t{}\n".format(elapsed, line.rstrip("\r")))
+		self.record_file.flush()
+
+	def close(self):
+		if self.record_file is not None:
+			self.record_file.close()
+			self.record_file = None
+
+
+
+# Replays a recording as if it was the stdout of `upower --monitor-detail`
+#  speed: 1 replays in real time, N replays N times faster, None or 0 replays as fast as possible
+
+class MonitorReplaySource:
+	speed: float
+	records: list
+	# perf_counter times that each chunk-ending empty line was returned at
+	chunk_arrivals: Deque[float]
+	_index: int = 0
+	_start_time: float = None
+
+	def __init__(self, path: str, speed: float = 1.0):
+		self.speed = speed
+		self.records = list()
+		self.chunk_arrivals = collections.deque()
+		with open(path, 'r') as record_file:
+			for record_line in record_file:
+				tab_index = record_line.find("\t")
+				if tab_index == -1:
+					logger.warn("Ignoring invalid record line: "+record_line)
+					continue
+				elapsed = float(record_line[0:tab_index])
+				line = record_line[tab_index+1:].rstrip("\r\n")+"\n"
+				self.records.append((elapsed, line.encode('utf-8')))
+
+	def readline(self) -> bytes:
+		if self._index >= len(self.records):
+			return b""
+		(elapsed, line) = self.records[self._index]
+		self._index += 1
+		if self._start_time is None:
+			self._start_time = time.monotonic() - (elapsed / self.speed if self.speed else 0)
+		elif self.speed:
+			delay = (self._start_time + (elapsed / self.speed)) - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+		if line.isspace():
+			self.chunk_arrivals.append(time.perf_counter())
+		return line
+
+	# feed the recording into an asyncio stream reader
+	async def feed_stream(self, reader: 'asyncio.StreamReader'):
+		import asyncio
+		start_time = time.monotonic()
+		for (elapsed, line) in self.records:
+			if self.speed:
+				delay = (start_time + (elapsed / self.speed)) - time.monotonic()
+				if delay > 0:
+					await asyncio.sleep(delay)
+			if line.isspace():
+				self.chunk_arrivals.append(time.perf_counter())
+			reader.feed_data(line)
+			if not self.speed:
+				# let the reader consume the data
+				await asyncio.sleep(0)
+		reader.feed_eof()
+
+
+
+# Replay driver
+#  replays a recording through the UPowerMonitor -> Plugin -> PowerHistoryDB pipeline and reports
+#  events per second, latency from an event arriving to its battery log being committed, and CPU per event
+
+async def run_replay(path: str, speed: float, db_dir: str, compress: bool = False, async_reader: bool = False) -> dict:
+	import asyncio
+	import threading
+	from upower_monitor import UPowerMonitor
+	from power_history import PowerHistoryDB
+	from ingest_compressor import BatteryLogCompressor
+	from plugin import Plugin
+	loop = asyncio.get_running_loop()
+	source = MonitorReplaySource(path, speed=speed)
+	# create pipeline
+	plugin = Plugin()
+	plugin.loop = loop
+	plugin.db = PowerHistoryDB(dir=db_dir)
+	await plugin.db.connect()
+	if compress:
+		plugin.ingest_compressor = BatteryLogCompressor()
+	monitor = UPowerMonitor()
+	monitor.when_device_updated = plugin._when_device_updated
+	plugin.monitor = monitor
+	# track event arrivals and commits
+	event_arrivals = dict()
+	latencies = list()
+	event_count = 0
+	def track_event(header, logtime_utc):
+		nonlocal event_count
+		event_count += 1
+		arrival = source.chunk_arrivals.popleft() if len(source.chunk_arrivals) > 0 else time.perf_counter()
+		event_arrivals[(header.event_value, logtime_utc)] = arrival
+	if async_reader:
+		# events are tracked as they're queued, since queued events may be coalesced before being dispatched
+		enqueue_monitor_event = monitor._enqueue_monitor_event
+		def on_enqueue_event(header, device_info, logtime_utc):
+			track_event(header, logtime_utc)
+			enqueue_monitor_event(header, device_info, logtime_utc)
+		monitor._enqueue_monitor_event = on_enqueue_event
+	else:
+		on_monitor_device_update = monitor.on_monitor_device_update
+		def on_event(logtime_utc, header, new_info):
+			track_event(header, logtime_utc)
+			return on_monitor_device_update(logtime_utc, header, new_info)
+		monitor.on_monitor_device_update = on_event
+	add_battery_state_log = plugin.db.add_battery_state_log
+	async def on_add_battery_state_log(batt_state_log):
+		result = await add_battery_state_log(batt_state_log)
+		arrival = event_arrivals.pop((batt_state_log.device_path, batt_state_log.time), None)
+		if arrival is not None:
+			latencies.append(time.perf_counter() - arrival)
+		return result
+	plugin.db.add_battery_state_log = on_add_battery_state_log
+	# replay recording
+	cpu_start = time.process_time()
+	wall_start = time.perf_counter()
+	dispatch_task = None
+	if async_reader:
+		stream_reader = asyncio.StreamReader()
+		dispatch_task = asyncio.create_task(monitor._dispatch_monitor_events())
+		await asyncio.gather(
+			source.feed_stream(stream_reader),
+			monitor._read_monitor_stream(None, stream_reader))
+		while len(monitor._event_queue) > 0 or len(monitor._coalesced_events) > 0:
+			await asyncio.sleep(0.01)
+	else:
+		ended_evt = asyncio.Event()
+		monitor.on_monitor_end = lambda:ended_evt.set()
+		reader_thread = threading.Thread(target=monitor._consume_monitor_output, args=(source, ))
+		reader_thread.start()
+		await ended_evt.wait()
+		reader_thread.join()
+	# wait for pending DB writes
+	pending_tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task() and task is not dispatch_task]
+	if len(pending_tasks) > 0:
+		await asyncio.wait(pending_tasks)
+	if dispatch_task is not None:
+		dispatch_task.cancel()
+	await plugin._flush_ingest_compressor()
+	wall_elapsed = time.perf_counter() - wall_start
+	cpu_elapsed = time.process_time() - cpu_start
+	await plugin.db.close()
+	# build report
+	latencies.sort()
+	def percentile(p: float) -> float:
+		if len(latencies) == 0:
+			return None
+		return latencies[min(len(latencies)-1, int(len(latencies) * p))]
+	return {
+		"events": event_count,
+		"committed": len(latencies),
+		"events_per_second": event_count / wall_elapsed if wall_elapsed > 0 else None,
+		"latency_p50_ms": percentile(0.5) * 1000 if len(latencies) > 0 else None,
+		"latency_p99_ms": percentile(0.99) * 1000 if len(latencies) > 0 else None,
+		"latency_max_ms": latencies[-1] * 1000 if len(latencies) > 0 else None,
+		"cpu_per_event_us": (cpu_elapsed / event_count) * 1000000 if event_count > 0 else None,
+		"coalesced": monitor.coalesced_event_count,
+		"wall_seconds": wall_elapsed
+	}
+
+
+
+# run replay driver if executing directly
+if __name__ == "__main__":
+	import argparse
+	import asyncio
+	import tempfile
+	parser = argparse.ArgumentParser(description="Replay a recorded upower monitor stream through the ingest pipeline")
+	parser.add_argument("recording", help="path of a recording made with UPowerMonitor.record_path")
+	parser.add_argument("--speed", type=float, default=0, help="replay speed multiplier (0 replays as fast as possible)")
+	parser.add_argument("--compress", action="store_true", help="enable ingest compression")
+	parser.add_argument("--async-reader", action="store_true", help="read the recording with the asyncio monitor reader")
+	parser.add_argument("--db-dir", default=None, help="directory for the replay DB (defaults to a temporary directory)")
+	args = parser.parse_args()
+
+	logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+	db_dir = args.db_dir or tempfile.mkdtemp(prefix="battery-analytics-replay-")
+	report = asyncio.run(run_replay(args.recording, speed=args.speed, db_dir=db_dir, compress=args.compress, async_reader=args.async_reader))
+	for (key, val) in report.items():
+		print("{}: {}".format(key, val))
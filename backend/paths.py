@@ -0,0 +1,13 @@
+import os
+
+# directory of the backend's source files
+BACKEND_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# directory of the plugin's DB and the files it writes on demand
+DATA_DIR = os.path.expanduser('~')+"/.battery-analytics-decky"
+TRACES_DIR = DATA_DIR+"/traces"
+PROFILES_DIR = DATA_DIR+"/profiles"
+RECORDINGS_DIR = DATA_DIR+"/recordings"
+# socket that the backend daemon listens on, and the lock held by the running daemon
+DAEMON_SOCKET_PATH = DATA_DIR+"/backend.sock"
+DAEMON_LOCK_PATH = DATA_DIR+"/backend.lock"
@@ -1,65 +1,138 @@
 import os
+import io
 import sys
 import select
+import time
+import inspect
+import collections
+import struct
 import asyncio
-import json
 import logging
 import traceback
 import threading
+import contextvars
 from dataclasses import dataclass
 import typing
-from typing import Any, Awaitable, IO, BinaryIO, Callable, Dict, Tuple
+from typing import Any, AsyncIterator, Awaitable, IO, BinaryIO, Callable, Deque, Dict, Tuple, List, Union
 
 from utils import try_logexcept, AsyncValue
+from pipetalk_codec import PipeTalkCodec, PipeTalkPayload, JSON_CODEC, CODEC_JSON, SUPPORTED_CODECS, get_codec
+from pipetalk_compression import PayloadCompressor, SUPPORTED_COMPRESSIONS, get_compression
+from pipetalk_shm import SharedMemoryChannel, SHM_AVAILABLE, FRAME_FLAG_SHM
+from backend_stats import backend_stats
+from tracing import tracer, current_trace_id
 
 logger = logging.getLogger()
 
 MSG_PREFIX_REQUEST = '>'
 MSG_PREFIX_RESPONSE = '<'
+MSG_PREFIX_CANCEL = '!'
+MSG_PREFIX_SHM_ACK = '+'
+# separates the method name from the trace id in the name field of a request
+TRACE_ID_SEPARATOR = '@'
+MSG_TYPE_REQUEST = MSG_PREFIX_REQUEST.encode('utf8')
+MSG_TYPE_RESPONSE = MSG_PREFIX_RESPONSE.encode('utf8')
+MSG_TYPE_CANCEL = MSG_PREFIX_CANCEL.encode('utf8')
+MSG_TYPE_SHM_ACK = MSG_PREFIX_SHM_ACK.encode('utf8')
 
 RESPONSE_TYPE_RESULT = 'result'
 RESPONSE_TYPE_ERROR = 'error'
+# a partial response holding one chunk of a streamed result, which is followed by more chunks and then a result or error
+RESPONSE_TYPE_CHUNK = 'chunk'
 
 MAX_REQUEST_IDS = 9999999
 
+# seconds for queued writes to be written when unlistening, after which they're dropped
+WRITER_STOP_TIMEOUT = 2.0
+# default capacity of a linux pipe, which a write can fill without waiting for the other end to read
+PIPE_BUFFER_SIZE = 65536
+
+FRAMING_TEXT = 'text'
+FRAMING_BINARY = 'binary'
+SUPPORTED_FRAMINGS = [FRAMING_BINARY, FRAMING_TEXT]
+
+# reserved method used to negotiate connection options before any other requests are sent
+NEGOTIATE_METHOD = '__pipetalk_negotiate__'
+
+# reserved method used to send multiple calls in a single request
+#  request data: [[method_name, data], ...]
+#  result data: [[response_type, data], ...] in the same order as the calls
+BATCH_METHOD = '__pipetalk_batch__'
+
+# reserved method used to request a streamed result
+#  request data: [method_name, data]
+#  responses: a chunk response for each chunk the handler yields, then an empty result
+#  If the handler doesn't return an async generator, its result is sent as a single chunk.
+#  When a handler returns an async generator for a regular request, its chunks are joined into one result.
+STREAM_METHOD = '__pipetalk_stream__'
+
 PipeTalkData = typing.Union[dict, list, int, float, None]
 
+def encode_payload(codec: PipeTalkCodec, data: PipeTalkData) -> PipeTalkPayload:
+	if data is None:
+		return None
+	start_time = time.perf_counter()
+	payload = codec.encode(data)
+	backend_stats.record("pipetalk.encode", time.perf_counter() - start_time)
+	return payload
+
+def decode_payload(codec: PipeTalkCodec, payload: PipeTalkPayload) -> PipeTalkData:
+	if payload is None or len(payload) == 0:
+		return None
+	if isinstance(payload, str) and payload.isspace():
+		return None
+	start_time = time.perf_counter()
+	data = codec.decode(payload)
+	backend_stats.record("pipetalk.decode", time.perf_counter() - start_time)
+	return data
+
+def payload_to_str(payload: PipeTalkPayload) -> str:
+	if isinstance(payload, str):
+		return payload
+	return str(payload, 'utf8')
+
+# split the name field of a request into the method name and trace id
+def split_request_name(name: str) -> Tuple[str,str]:
+	separator_index = name.find(TRACE_ID_SEPARATOR)
+	if separator_index == -1:
+		return (name, None)
+	return (name[:separator_index], name[separator_index+1:])
+
 # Request
-#  >{request_id}:{method_name}:{args}
+#  >{request_id}:{method_name}[@{trace_id}]:{args}
 #  request_id: a unique id for the request
 #  method_name: the name of the method that should be called
-#  data: a json representation of the request data
+#  trace_id: the trace that the request is part of, only sent when tracing was negotiated
+#  data: the request data, encoded with the codec of the connection (json in text framing)
 
 @dataclass
 class PipeTalkRequest:
 	request_id: str
 	method_name: str
-	data_str: str
+	payload: PipeTalkPayload
+	codec: PipeTalkCodec = JSON_CODEC
+	trace_id: str = None
 
 	def get_data(self) -> PipeTalkData:
-		if self.data_str is None:
-			return None
-		data_str = self.data_str.strip()
-		if len(data_str) == 0:
-			return None
-		return json.loads(data_str)
+		return decode_payload(self.codec, self.payload)
 	
 	def set_data(self, data: PipeTalkData):
-		if data is not None:
-			self.data_str = json.dumps(data)
-		else:
-			self.data_str = None
+		self.payload = encode_payload(self.codec, data)
+
+	@property
+	def name_field(self) -> str:
+		if self.trace_id is None:
+			return self.method_name
+		return (self.method_name or "") + TRACE_ID_SEPARATOR + self.trace_id
 
 	@classmethod
-	def create(cls, request_id: str, method_name: str, data: PipeTalkData = None) -> 'PipeTalkRequest':
-		if data is not None:
-			data_str = json.dumps(data)
-		else:
-			data_str = None
+	def create(cls, request_id: str, method_name: str, data: PipeTalkData = None, codec: PipeTalkCodec = JSON_CODEC, trace_id: str = None) -> 'PipeTalkRequest':
 		return PipeTalkRequest(
 			request_id = request_id,
 			method_name = method_name,
-			data_str = data_str)
+			payload = encode_payload(codec, data),
+			codec = codec,
+			trace_id = trace_id)
 
 	@classmethod
 	def parse(cls, line: str) -> 'PipeTalkRequest':
@@ -77,24 +150,37 @@ class PipeTalkRequest:
 			return PipeTalkRequest(
 				request_id = line[section_start:],
 				method_name = None,
-				data_str = None)
+				payload = None)
 		req_id = line[section_start:colon_index]
 		section_start = colon_index + 1
 		# parse method name
 		colon_index = line.find(':', section_start)
 		if colon_index == -1:
+			(method_name, trace_id) = split_request_name(line[section_start:].strip())
 			return PipeTalkRequest(
 				request_id = req_id,
-				method_name = line[section_start:].strip(),
-				data_str = None)
-		method_name = line[section_start:colon_index].strip()
+				method_name = method_name,
+				payload = None,
+				trace_id = trace_id)
+		(method_name, trace_id) = split_request_name(line[section_start:colon_index].strip())
 		section_start = colon_index + 1
 		# parse data
-		data_str = line[section_start:]
+		payload = line[section_start:]
 		return PipeTalkRequest(
 				request_id = req_id,
 				method_name = method_name,
-				data_str = data_str)
+				payload = payload,
+				trace_id = trace_id)
+	
+	@classmethod
+	def from_frame(cls, request_id: int, name: memoryview, payload: memoryview, codec: PipeTalkCodec = JSON_CODEC) -> 'PipeTalkRequest':
+		(method_name, trace_id) = split_request_name(str(name, 'utf8'))
+		return PipeTalkRequest(
+			request_id = str(request_id),
+			method_name = method_name,
+			payload = bytes(payload) if len(payload) > 0 else None,
+			codec = codec,
+			trace_id = trace_id)
 	
 	def validate(self):
 		if self.request_id is None:
@@ -102,48 +188,44 @@ class PipeTalkRequest:
 		if self.method_name is None:
 			raise ValueError("missing method_name")
 	
+	def to_frame(self, compressor: PayloadCompressor = None, shm_channel: SharedMemoryChannel = None) -> bytes:
+		return build_frame(MSG_TYPE_REQUEST, self.request_id, self.name_field, self.payload, compressor, shm_channel)
+	
 	def stringify(self) -> str:
 		req_str = MSG_PREFIX_REQUEST
 		# add request id
 		req_str += self.request_id
 		# bail if no method_name or data is available
-		if self.method_name is None and self.data is None:
+		if self.method_name is None and self.payload is None:
 			return req_str
-		# add method name
+		# add method name and trace id
 		req_str += ":"
-		req_str += (self.method_name or "")
+		req_str += (self.name_field or "")
 		# add data
-		if self.data_str is not None and len(self.data_str) > 0:
+		if self.payload is not None and len(self.payload) > 0:
 			req_str += ":"
-			req_str += self.data_str
+			req_str += payload_to_str(self.payload)
 		return req_str
 
 
 # Response
 #  <{request_id}:{response_type}:{data}
 #  request_id: a unique id for the request
-#  response_type: the type of response (result or error)
-#  data: a json representation of the response data
+#  response_type: the type of response (result, error or chunk)
+#  data: the response data, encoded with the codec of the connection (json in text framing)
 
 @dataclass
 class PipeTalkResponse:
 	request_id: str
 	response_type: str
-	data_str: str
+	payload: PipeTalkPayload
+	codec: PipeTalkCodec = JSON_CODEC
 
 	def get_data(self) -> PipeTalkData:
-		if self.data_str is None:
-			return None
-		data_str = self.data_str.strip()
-		if len(data_str) == 0:
-			return None
-		return json.loads(data_str)
+		return decode_payload(self.codec, self.payload)
 	
 	def set_data(self, data: PipeTalkData):
-		if data is not None:
-			self.data_str = json.dumps(data)
-		else:
-			self.data_str = None
+		self.payload = encode_payload(self.codec, data)
 	
 	def get_result_data(self) -> PipeTalkData:
 		if self.response_type != RESPONSE_TYPE_RESULT:
@@ -160,33 +242,31 @@ class PipeTalkResponse:
 		if errordata is None:
 			return None
 		if not isinstance(errordata, dict):
-			logger.error("Unexpected type for error data: "+self.data_str)
+			logger.error("Unexpected type for error data: "+str(errordata))
 			return RuntimeError("Unknown error")
 		return PipeTalkRequestError.parse_dict(errordata)
 	
 
 	@classmethod
-	def from_result_data(cls, request_id: str, result: PipeTalkData) -> 'PipeTalkResponse':
-		if result is not None:
-			data_str = json.dumps(result)
-		else:
-			data_str = None
+	def from_result_data(cls, request_id: str, result: PipeTalkData, codec: PipeTalkCodec = JSON_CODEC) -> 'PipeTalkResponse':
 		return PipeTalkResponse(
 			request_id = request_id,
 			response_type = RESPONSE_TYPE_RESULT,
-			data_str = data_str)
+			payload = encode_payload(codec, result),
+			codec = codec)
 	
 	@classmethod
-	def from_error_data(cls, request_id: str, error: PipeTalkData) -> 'PipeTalkResponse':
+	def from_error_data(cls, request_id: str, error: PipeTalkData, codec: PipeTalkCodec = JSON_CODEC) -> 'PipeTalkResponse':
 		return PipeTalkResponse(
 			request_id = request_id,
 			response_type = RESPONSE_TYPE_ERROR,
-			data_str = json.dumps(error))
+			payload = encode_payload(codec, error),
+			codec = codec)
 	
 	@classmethod
-	def from_error(cls, request_id: str, error: BaseException) -> 'PipeTalkResponse':
+	def from_error(cls, request_id: str, error: BaseException, codec: PipeTalkCodec = JSON_CODEC) -> 'PipeTalkResponse':
 		errordata = error_to_pipetalkdata(error)
-		return cls.from_error_data(request_id, errordata)
+		return cls.from_error_data(request_id, errordata, codec=codec)
 
 	@classmethod
 	def parse(cls, line: str) -> 'PipeTalkResponse':
@@ -204,7 +284,7 @@ class PipeTalkResponse:
 			return PipeTalkResponse(
 				request_id = line[section_start:],
 				response_type = None,
-				data_str = None)
+				payload = None)
 		req_id = line[section_start:colon_index]
 		section_start = colon_index + 1
 		# parse response type
@@ -213,15 +293,23 @@ class PipeTalkResponse:
 			return PipeTalkResponse(
 				request_id = req_id,
 				response_type = line[section_start:].strip(),
-				data_str = None)
+				payload = None)
 		res_type = line[section_start:colon_index].strip()
 		section_start = colon_index + 1
 		# parse data
-		data_str = line[section_start:]
+		payload = line[section_start:]
 		return PipeTalkResponse(
 				request_id = req_id,
 				response_type = res_type,
-				data_str = data_str)
+				payload = payload)
+	
+	@classmethod
+	def from_frame(cls, request_id: int, name: memoryview, payload: memoryview, codec: PipeTalkCodec = JSON_CODEC) -> 'PipeTalkResponse':
+		return PipeTalkResponse(
+			request_id = str(request_id),
+			response_type = str(name, 'utf8'),
+			payload = bytes(payload) if len(payload) > 0 else None,
+			codec = codec)
 	
 	def validate(self):
 		if self.request_id is None:
@@ -229,24 +317,72 @@ class PipeTalkResponse:
 		if self.response_type is None:
 			raise ValueError("missing response_type")
 	
+	def to_frame(self, compressor: PayloadCompressor = None, shm_channel: SharedMemoryChannel = None) -> bytes:
+		return build_frame(MSG_TYPE_RESPONSE, self.request_id, self.response_type, self.payload, compressor, shm_channel)
+	
 	def stringify(self) -> str:
 		req_str = MSG_PREFIX_RESPONSE
 		# add request id
 		req_str += self.request_id
 		# bail if no method_name or data is available
-		if self.response_type is None and self.data is None:
+		if self.response_type is None and self.payload is None:
 			return req_str
 		# add response type
 		req_str += ":"
 		req_str += (self.response_type or "")
 		# add data
-		if self.data_str is not None and len(self.data_str) > 0:
+		if self.payload is not None and len(self.payload) > 0:
 			req_str += ":"
-			req_str += self.data_str
+			req_str += payload_to_str(self.payload)
 		return req_str
 
 
 
+# Cancel
+#  !{request_id}
+#  request_id: the id of a request that the sender is no longer waiting for
+
+@dataclass
+class PipeTalkCancel:
+	request_id: str
+
+	@classmethod
+	def parse(cls, line: str) -> 'PipeTalkCancel':
+		line = line.strip()
+		if len(line) == 0 or line[0] != MSG_PREFIX_CANCEL:
+			raise ValueError("Invalid cancel message: "+line)
+		elif len(line) == 1:
+			raise ValueError("Empty cancel message is not valid")
+		return PipeTalkCancel(request_id = line[1:])
+	
+	@classmethod
+	def from_frame(cls, request_id: int, name: memoryview, payload: memoryview, codec: PipeTalkCodec = JSON_CODEC) -> 'PipeTalkCancel':
+		return PipeTalkCancel(request_id = str(request_id))
+	
+	def stringify(self) -> str:
+		return MSG_PREFIX_CANCEL + self.request_id
+	
+	def to_frame(self, compressor: PayloadCompressor = None, shm_channel: SharedMemoryChannel = None) -> bytes:
+		return build_frame(MSG_TYPE_CANCEL, self.request_id, None, None)
+
+
+
+# Shared memory acknowledgement (binary framing only)
+#  a frame with type '+', request_id 0 and the name of a shared memory region that was read and can be reclaimed
+
+@dataclass
+class PipeTalkShmAck:
+	region_name: str
+
+	@classmethod
+	def from_frame(cls, request_id: int, name: memoryview, payload: memoryview, codec: PipeTalkCodec = JSON_CODEC) -> 'PipeTalkShmAck':
+		return PipeTalkShmAck(region_name = str(name, 'utf8'))
+	
+	def to_frame(self, compressor: PayloadCompressor = None, shm_channel: SharedMemoryChannel = None) -> bytes:
+		return build_frame(MSG_TYPE_SHM_ACK, "0", self.region_name, None)
+
+
+
 # Error
 # {"m": "error message", "d": "full debug error (sometimes with stacktrace if possible)"}
 
@@ -275,6 +411,329 @@ def error_to_pipetalkdata(error: BaseException) -> dict:
 
 
 
+# Binary frame
+#  {type}{flags}{request_id}{name_length}{payload_length}{name}{payload}
+#  type: 1 byte message type ('>' for requests, '<' for responses, '!' for cancellations, '+' for shared memory acknowledgements)
+#  flags: 1 byte of flags
+#    bits 0-1: payload compression (0 for none, 1 for zlib, 2 for lz4)
+#    bit 2: the payload is the name of a shared memory region holding the real payload
+#  request_id: unsigned 32 bit request id
+#  name_length: unsigned 16 bit length of the name
+#  payload_length: unsigned 32 bit length of the payload
+#  name: utf8 method name for requests or response type for responses
+#  payload: the message data, encoded with the codec of the connection
+
+FRAME_HEADER = struct.Struct('!cBIHI')
+
+PipeTalkMessage = typing.Union[PipeTalkRequest, PipeTalkResponse, PipeTalkCancel, PipeTalkShmAck]
+
+def build_frame(msg_type: bytes, request_id: str, name: str, payload: PipeTalkPayload, compressor: PayloadCompressor = None, shm_channel: SharedMemoryChannel = None) -> bytes:
+	name_bytes = (name or "").encode('utf8')
+	if payload is None:
+		payload = b""
+	elif isinstance(payload, str):
+		payload = payload.encode('utf8')
+	flags = 0
+	if shm_channel is not None and shm_channel.should_send(payload):
+		# large payloads skip the pipe, so there's no point compressing them
+		payload = shm_channel.send(payload)
+		flags = FRAME_FLAG_SHM
+	elif compressor is not None:
+		(flags, payload) = compressor.compress(payload)
+	header = FRAME_HEADER.pack(msg_type, flags, int(request_id), len(name_bytes), len(payload))
+	return b"".join((header, name_bytes, payload))
+
+def parse_message_line(line: str, codec: PipeTalkCodec = JSON_CODEC) -> PipeTalkMessage:
+	if len(line) == 0:
+		return None
+	msg_type = line[0]
+	if msg_type == MSG_PREFIX_REQUEST:
+		req = PipeTalkRequest.parse(line)
+		req.codec = codec
+		return req
+	elif msg_type == MSG_PREFIX_RESPONSE:
+		res = PipeTalkResponse.parse(line)
+		res.codec = codec
+		return res
+	elif msg_type == MSG_PREFIX_CANCEL:
+		return PipeTalkCancel.parse(line)
+	raise ValueError("Unknown message type {} for input line: {}".format(msg_type, line))
+
+
+# Message reader
+#  Reads messages into a single reusable buffer, in either text or binary framing.
+#  The framing and codec can be switched between messages, and any bytes already read are parsed with the new ones.
+
+class PipeTalkMessageReader:
+	framing: str = FRAMING_TEXT
+	codec: PipeTalkCodec = JSON_CODEC
+	compressor: PayloadCompressor
+	shm_channel: SharedMemoryChannel
+	_buffer: bytearray
+	# offset of the first unconsumed byte
+	_start: int = 0
+	# offset after the last byte read
+	_end: int = 0
+	# offset to resume searching for a line ending from
+	_scan: int = 0
+	# number of unconsumed bytes needed to complete the current frame
+	_needed: int = 0
+
+	def __init__(self, initial_size: int = 65536, compressor: PayloadCompressor = None, shm_channel: SharedMemoryChannel = None):
+		self._buffer = bytearray(initial_size)
+		self.compressor = compressor or PayloadCompressor()
+		self.shm_channel = shm_channel or SharedMemoryChannel()
+	
+	# read available bytes from a raw reader, returning 0 at EOF
+	def read_from(self, raw_reader: io.RawIOBase) -> int:
+		self._reserve(max(4096, self._needed - (self._end - self._start)))
+		count = raw_reader.readinto(memoryview(self._buffer)[self._end:])
+		if count is None:
+			return -1
+		self._end += count
+		return count
+	
+	def feed(self, data: bytes):
+		data_len = len(data)
+		self._reserve(data_len)
+		self._buffer[self._end:self._end+data_len] = data
+		self._end += data_len
+	
+	# get the next complete message, or None if more bytes are needed
+	def next_message(self) -> PipeTalkMessage:
+		while self._start < self._end:
+			if self.framing == FRAMING_BINARY:
+				return self._next_frame()
+			line = self._next_line()
+			if line is None:
+				return None
+			if len(line) == 0 or line.isspace():
+				continue
+			return parse_message_line(line, self.codec)
+		return None
+	
+	def _next_line(self) -> str:
+		line_end = self._buffer.find(b"\n", max(self._scan, self._start), self._end)
+		if line_end == -1:
+			self._scan = self._end
+			return None
+		line = str(memoryview(self._buffer)[self._start:line_end], 'utf8')
+		self._start = line_end + 1
+		self._scan = self._start
+		self._compact_if_empty()
+		return line
+	
+	def _next_frame(self) -> PipeTalkMessage:
+		available = self._end - self._start
+		if available < FRAME_HEADER.size:
+			self._needed = FRAME_HEADER.size
+			return None
+		(msg_type, flags, request_id, name_len, payload_len) = FRAME_HEADER.unpack_from(self._buffer, self._start)
+		frame_len = FRAME_HEADER.size + name_len + payload_len
+		if available < frame_len:
+			self._needed = frame_len
+			return None
+		self._needed = 0
+		frame_start = self._start
+		name_start = frame_start + FRAME_HEADER.size
+		payload_start = name_start + name_len
+		# consume the frame before parsing it, so a bad frame can't be read twice
+		self._start = frame_start + frame_len
+		self._scan = self._start
+		with memoryview(self._buffer) as buffer_view:
+			name = buffer_view[name_start:payload_start]
+			payload_view = buffer_view[payload_start:self._start]
+			try:
+				payload = payload_view
+				if flags & FRAME_FLAG_SHM:
+					payload = self.shm_channel.receive(payload)
+				payload = self.compressor.decompress(flags, payload)
+				if msg_type == MSG_TYPE_REQUEST:
+					msg = PipeTalkRequest.from_frame(request_id, name, payload, self.codec)
+				elif msg_type == MSG_TYPE_RESPONSE:
+					msg = PipeTalkResponse.from_frame(request_id, name, payload, self.codec)
+				elif msg_type == MSG_TYPE_CANCEL:
+					msg = PipeTalkCancel.from_frame(request_id, name, payload, self.codec)
+				elif msg_type == MSG_TYPE_SHM_ACK:
+					msg = PipeTalkShmAck.from_frame(request_id, name, payload, self.codec)
+				else:
+					raise ValueError("Unknown message type {} for frame".format(msg_type))
+			finally:
+				name.release()
+				payload_view.release()
+		self._compact_if_empty()
+		return msg
+	
+	def _compact_if_empty(self):
+		if self._start == self._end:
+			self._start = 0
+			self._end = 0
+			self._scan = 0
+	
+	# ensure there is room to read the given number of bytes after the buffered bytes
+	def _reserve(self, size: int):
+		buffer_len = len(self._buffer)
+		if buffer_len - self._end >= size:
+			return
+		# move unconsumed bytes to the start of the buffer
+		if self._start > 0:
+			unconsumed = self._end - self._start
+			self._buffer[0:unconsumed] = self._buffer[self._start:self._end]
+			self._scan -= self._start
+			self._start = 0
+			self._end = unconsumed
+		# grow the buffer if there still isn't enough room
+		free = buffer_len - self._end
+		if free < size:
+			self._buffer.extend(bytes(max(size - free, buffer_len)))
+
+
+
+# Asyncio pipe protocols
+
+class _PipeTalkReadProtocol(asyncio.Protocol):
+	def __init__(self, talker: 'PipeTalker', finished_evt: asyncio.Event):
+		self.talker = talker
+		self.finished_evt = finished_evt
+	
+	def data_received(self, data: bytes):
+		self.talker._handle_reader_data(data)
+	
+	def eof_received(self):
+		# returning a falsy value closes the transport
+		return False
+	
+	def connection_lost(self, exc: Exception):
+		if exc is not None:
+			logger.error("pipetalk reader connection lost: "+str(exc))
+		self.talker._on_reader_closed()
+		self.finished_evt.set()
+
+class _PipeTalkWriteProtocol(asyncio.Protocol):
+	def __init__(self):
+		# set while the transport buffer is below its high-water mark
+		self.writable_evt = asyncio.Event()
+		self.writable_evt.set()
+	
+	def pause_writing(self):
+		self.writable_evt.clear()
+	
+	def resume_writing(self):
+		self.writable_evt.set()
+	
+	def connection_lost(self, exc: Exception):
+		if exc is not None:
+			logger.error("pipetalk writer connection lost: "+str(exc))
+		# don't leave the writer waiting on a closed pipe
+		self.writable_evt.set()
+
+
+
+# Request lanes
+#  Received requests are admitted through a lane chosen by their method name, which limits how many
+#  requests of that class are handled at once. Requests waiting for a lane are admitted round robin
+#  between methods, and in order for each method, so a burst of one method can't starve the others.
+#  control: lifecycle calls like _main and _unload, which are never queued
+#  normal: cheap calls, which is the default for methods that aren't assigned a lane
+#  bulk: expensive queries, which are limited so they don't pile up on the DB thread
+
+LANE_CONTROL = 'control'
+LANE_NORMAL = 'normal'
+LANE_BULK = 'bulk'
+
+DEFAULT_LANE_LIMITS: Dict[str,int] = {
+	LANE_CONTROL: None,
+	LANE_NORMAL: 8,
+	LANE_BULK: 2
+}
+
+class RequestLane:
+	name: str
+	# maximum number of requests handled at once, or None for no limit
+	max_concurrent: int = None
+	running_count: int = 0
+	admitted_count: int = 0
+	queued_total_count: int = 0
+	# waiting requests for each method, in the order the methods will be admitted
+	_queues: Dict[str,Deque[asyncio.Future]]
+
+	def __init__(self, name: str, max_concurrent: int = None):
+		self.name = name
+		self.max_concurrent = max_concurrent
+		self._queues = dict()
+	
+	@property
+	def queued_count(self) -> int:
+		return sum(len(queue) for queue in self._queues.values())
+	
+	def stats(self) -> dict:
+		return {
+			"max_concurrent": self.max_concurrent,
+			"running": self.running_count,
+			"queued": self.queued_count,
+			"admitted": self.admitted_count,
+			"queued_total": self.queued_total_count
+		}
+	
+	def set_max_concurrent(self, max_concurrent: int):
+		self.max_concurrent = max_concurrent
+		self._admit_next()
+	
+	# wait until a request for the given method can be handled
+	async def acquire(self, method_name: str):
+		if len(self._queues) == 0 and (self.max_concurrent is None or self.running_count < self.max_concurrent):
+			self.running_count += 1
+			self.admitted_count += 1
+			return
+		future = asyncio.get_running_loop().create_future()
+		queue = self._queues.get(method_name, None)
+		if queue is None:
+			queue = collections.deque()
+			self._queues[method_name] = queue
+		queue.append(future)
+		self.queued_total_count += 1
+		try:
+			await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				# the request was admitted just before it was cancelled, so give up its slot
+				self.release()
+			else:
+				self._remove_waiting(method_name, future)
+			raise
+	
+	# finish handling a request, admitting the next waiting request
+	def release(self):
+		self.running_count -= 1
+		self._admit_next()
+	
+	def _admit_next(self):
+		while len(self._queues) > 0 and (self.max_concurrent is None or self.running_count < self.max_concurrent):
+			# take the next request from the first method, then move that method to the back
+			method_name = next(iter(self._queues))
+			queue = self._queues.pop(method_name)
+			future = queue.popleft()
+			if len(queue) > 0:
+				self._queues[method_name] = queue
+			if future.done():
+				continue
+			self.running_count += 1
+			self.admitted_count += 1
+			future.set_result(None)
+	
+	def _remove_waiting(self, method_name: str, future: asyncio.Future):
+		queue = self._queues.get(method_name, None)
+		if queue is None:
+			return
+		try:
+			queue.remove(future)
+		except ValueError:
+			pass
+		if len(queue) == 0:
+			self._queues.pop(method_name)
+
+
+
 # Communicator
 
 RequestHandler = Callable[[PipeTalkRequest],Awaitable[PipeTalkData]]
@@ -291,16 +750,106 @@ class PipeTalker:
 	_next_request_id: int = 0
 	_loop: asyncio.AbstractEventLoop
 	_reader_thread: threading.Thread = None
+	_read_transport: asyncio.ReadTransport = None
+	_write_transport: asyncio.WriteTransport = None
+	_write_protocol: _PipeTalkWriteProtocol = None
+	# frames waiting to be written by the writer task, which writes everything queued in a loop iteration at once
+	_write_queue: Deque[bytes]
+	_write_queue_size: int = 0
+	_writer_task: asyncio.Task = None
+	_write_ready_evt: asyncio.Event = None
+	# set while everything queued has been written
+	_write_idle_evt: asyncio.Event = None
+	# set once unlistening starts, after which nothing more is queued
+	_writes_closed: bool = False
+	dropped_write_count: int = 0
+	# set while the queued bytes are below the high-water mark
+	_write_space_evt: asyncio.Event = None
+	# producers that wait for space are paused once this many bytes are queued, until the queue drains below the low-water mark
+	write_high_water: int = 4194304
+	write_low_water: int = 1048576
+	write_count: int = 0
+	written_frame_count: int = 0
+	written_bytes: int = 0
+	max_write_queue_size: int = 0
 	_reader_finish_evt: asyncio.Event = None
+	# set once nothing more can be read, so no more responses can be received
+	_reader_closed: bool = False
 	_running: bool = False
-	_waiting_requests: Dict[str,Tuple[asyncio.AbstractEventLoop,asyncio.Event]] = dict()
-	_responses: Dict[str,PipeTalkResponse] = dict()
+	# futures for regular requests, and queues of responses for streamed requests
+	_waiting_requests: Dict[str,Union[asyncio.Future,asyncio.Queue]]
+	_running_requests: Dict[str,asyncio.Task]
+	_msg_reader: PipeTalkMessageReader
+	# the lane for each method name, with unlisted methods using the normal lane
+	method_lanes: Dict[str,str]
+	lanes: Dict[str,RequestLane]
+	_write_framing: str = FRAMING_TEXT
+	_write_codec: PipeTalkCodec = JSON_CODEC
+	_compressor: PayloadCompressor
+	_shm_channel: SharedMemoryChannel
+	_negotiate_request_id: str = None
+	# whether the other end accepts trace ids in requests, which is negotiated
+	_send_trace_ids: bool = False
 
 
 	def __init__(self, reader: IO, writer: IO, request_handler: RequestHandler = None):
 		self.reader = reader
 		self.writer = writer
 		self.request_handler = request_handler
+		self._waiting_requests = dict()
+		self._running_requests = dict()
+		self._write_queue = collections.deque()
+		self.method_lanes = dict()
+		self.lanes = {lane_name: RequestLane(lane_name, max_concurrent) for (lane_name, max_concurrent) in DEFAULT_LANE_LIMITS.items()}
+		self._compressor = PayloadCompressor()
+		self._shm_channel = SharedMemoryChannel()
+		self._shm_channel.on_region_read = self._on_shm_region_read
+		self._msg_reader = PipeTalkMessageReader(compressor=self._compressor, shm_channel=self._shm_channel)
+	
+	@property
+	def framing(self) -> str:
+		return self._write_framing
+	
+	@property
+	def codec(self) -> str:
+		return self._write_codec.name
+	
+	@property
+	def compression(self) -> str:
+		compression = self._compressor.compression
+		if compression is None:
+			return None
+		return compression.name
+	
+	def stats(self) -> dict:
+		return {
+			"framing": self.framing,
+			"codec": self.codec,
+			"compression": self.compression,
+			"trace": self._send_trace_ids,
+			"waiting_requests": len(self._waiting_requests),
+			"running_requests": len(self._running_requests),
+			"compression_stats": dict(self._compressor.stats.to_dict(), transfer_bytes_per_second=self._compressor.transfer_bytes_per_second),
+			"shm": self._shm_channel.enabled,
+			"shm_stats": dict(self._shm_channel.stats.to_dict(), outstanding=self._shm_channel.outstanding_count),
+			"lanes": {lane_name: lane.stats() for (lane_name, lane) in self.lanes.items()},
+			"writes": {
+				"writes": self.write_count,
+				"frames": self.written_frame_count,
+				"bytes": self.written_bytes,
+				"queued_bytes": self._write_queue_size,
+				"max_queued_bytes": self.max_write_queue_size,
+				"dropped": self.dropped_write_count
+			}
+		}
+	
+	# set the maximum number of requests handled at once in a lane, or None for no limit
+	def set_lane_limit(self, lane_name: str, max_concurrent: int):
+		lane = self.lanes.get(lane_name, None)
+		if lane is None:
+			self.lanes[lane_name] = RequestLane(lane_name, max_concurrent)
+		else:
+			lane.set_max_concurrent(max_concurrent)
 	
 
 	# start listening for requests/responses
@@ -318,14 +867,41 @@ class PipeTalker:
 		self._reader_finish_evt = reader_finish_evt
 		# start reader thread
 		self._running = True
+		self._reader_closed = False
+		self._writes_closed = False
 		self._reader_thread = threading.Thread(target=lambda:self._consume_reader(
 			quit_pipe = quit_pipe_reader,
 			finished_evt = reader_finish_evt,
 			loop = loop))
 		self._reader_thread.start()
 	
+	# start listening for requests/responses on the event loop, without a reader thread
+	async def listen_async(self):
+		if self._reader_thread is not None or self._read_transport is not None:
+			return
+		loop = asyncio.get_running_loop()
+		self._loop = loop
+		# create finish event for reader
+		reader_finish_evt = asyncio.Event()
+		self._reader_finish_evt = reader_finish_evt
+		self._running = True
+		self._reader_closed = False
+		self._writes_closed = False
+		# attach the pipes to the event loop
+		(write_transport, write_protocol) = await loop.connect_write_pipe(_PipeTalkWriteProtocol, self.writer)
+		write_transport.set_write_buffer_limits(high=self.write_high_water, low=self.write_low_water)
+		self._write_transport = write_transport
+		self._write_protocol = write_protocol
+		(read_transport, _) = await loop.connect_read_pipe(
+			lambda:_PipeTalkReadProtocol(self, reader_finish_evt),
+			self.reader)
+		self._read_transport = read_transport
+	
 	# stop listening for requests / responses
 	async def unlisten(self):
+		if self._read_transport is not None:
+			await self._unlisten_async()
+			return
 		loop = self._loop
 		finish_evt = self._reader_finish_evt
 		thread = self._reader_thread
@@ -333,6 +909,9 @@ class PipeTalker:
 		quit_pipe_reader = self._quit_pipe_reader
 		if thread is None:
 			return
+		# write anything still queued
+		self._writes_closed = True
+		await self._stop_writer()
 		# unset running to stop reader loop
 		self._running = False
 		# write to quit pipe to stop blocking select.select call
@@ -365,6 +944,40 @@ class PipeTalker:
 			self._reader_thread = None
 		if self._loop is loop:
 			self._loop = None
+		# remove shared memory regions the other end never read
+		self._shm_channel.close()
+	
+	async def _unlisten_async(self):
+		loop = self._loop
+		finish_evt = self._reader_finish_evt
+		read_transport = self._read_transport
+		write_transport = self._write_transport
+		# write anything still queued
+		self._writes_closed = True
+		flushed = await self._stop_writer()
+		self._running = False
+		# close transports, dropping what the transport still buffers if the other end stopped reading
+		read_transport.close()
+		if write_transport is not None:
+			if flushed:
+				write_transport.close()
+			else:
+				write_transport.abort()
+		# wait for the reader to finish
+		if finish_evt is not None:
+			await finish_evt.wait()
+		# unset properties
+		if self._read_transport is read_transport:
+			self._read_transport = None
+		if self._write_transport is write_transport:
+			self._write_transport = None
+			self._write_protocol = None
+		if self._reader_finish_evt is finish_evt:
+			self._reader_finish_evt = None
+		if self._loop is loop:
+			self._loop = None
+		# remove shared memory regions the other end never read
+		self._shm_channel.close()
 	
 	async def wait(self):
 		finish_evt = self._reader_finish_evt
@@ -372,32 +985,155 @@ class PipeTalker:
 			return
 		await finish_evt.wait()
 
-	async def send_request(self, method_name: str, data: PipeTalkData = None) -> PipeTalkResponse:
+	# send a request and wait for its response
+	#  If the timeout passes or the calling task is cancelled, the other end is told to cancel the request.
+	async def send_request(self, method_name: str, data: PipeTalkData = None, timeout: float = None) -> PipeTalkResponse:
+		return await self._send_request_with_id(self._get_next_request_id(), method_name, data, timeout=timeout)
+	
+	async def _send_request_with_id(self, req_id: str, method_name: str, data: PipeTalkData = None, timeout: float = None) -> PipeTalkResponse:
 		# prepare request
-		req_id = self._get_next_request_id()
+		trace_id = self._get_trace_id()
+		start_time = time.perf_counter()
 		req = PipeTalkRequest.create(
 			request_id = req_id,
 			method_name = method_name,
-			data = data)
-		evtloop = asyncio.get_event_loop()
-		evt = asyncio.Event()
-		self._waiting_requests[req_id] = (evtloop, evt)
-		# send request and wait for response
+			data = data,
+			codec = self._write_codec,
+			trace_id = trace_id)
+		future = asyncio.get_running_loop().create_future()
+		self._waiting_requests[req_id] = future
 		try:
+			# send request and wait for response
+			await self.drain()
 			self._write_request(req)
-		except:
-			self._waiting_requests.pop(req_id)
+			if timeout is None:
+				res = await future
+			else:
+				res = await asyncio.wait_for(future, timeout)
+			backend_stats.record("pipetalk.rtt."+method_name, time.perf_counter() - start_time)
+			return res
+		except (asyncio.CancelledError, asyncio.TimeoutError):
+			backend_stats.increment("pipetalk.cancelled")
+			# let the other end stop working on the request
+			try:
+				self._write_cancel(PipeTalkCancel(req_id))
+			except BaseException as error:
+				logger.error("Error sending cancel for request "+req_id+": "+str(error))
 			raise
-		await evt.wait()
-		# get response
-		res = self._responses.pop(req_id, None)
-		self._waiting_requests.pop(req_id, None)
-		return res
+		finally:
+			if self._waiting_requests.get(req_id, None) is future:
+				self._waiting_requests.pop(req_id)
+			if trace_id is not None:
+				tracer.record_span("pipetalk.request "+method_name, trace_id, start_time, time.perf_counter())
+	
+	# send multiple calls in a single request, which the other end handles concurrently
+	#  Returns a response for each call, in the same order as the calls.
+	async def batch(self, calls: List[Tuple[str,PipeTalkData]], timeout: float = None) -> List[PipeTalkResponse]:
+		if len(calls) == 0:
+			return []
+		req_id = self._get_next_request_id()
+		res = await self._send_request_with_id(req_id, BATCH_METHOD, [[method_name, data] for (method_name, data) in calls], timeout=timeout)
+		if res.response_type != RESPONSE_TYPE_RESULT:
+			raise (res.get_error() or RuntimeError("Unknown error response"))
+		results = res.get_result_data()
+		if not isinstance(results, list) or len(results) != len(calls):
+			raise RuntimeError("Invalid batch response for request_id "+req_id)
+		responses = list()
+		for (response_type, data) in results:
+			if response_type == RESPONSE_TYPE_ERROR:
+				responses.append(PipeTalkResponse.from_error_data(req_id, data, codec=res.codec))
+			else:
+				responses.append(PipeTalkResponse.from_result_data(req_id, data, codec=res.codec))
+		return responses
 	
-	async def request(self, method_name: str, data: PipeTalkData = None) -> PipeTalkData:
+	# send a request for a streamed result, and iterate the chunks as they're received
+	#  The timeout applies to waiting for each chunk. If iteration stops early, the other end is told to cancel the request.
+	async def stream(self, method_name: str, data: PipeTalkData = None, timeout: float = None) -> AsyncIterator[PipeTalkData]:
+		req_id = self._get_next_request_id()
+		trace_id = self._get_trace_id()
+		start_time = time.perf_counter()
+		req = PipeTalkRequest.create(
+			request_id = req_id,
+			method_name = STREAM_METHOD,
+			data = [method_name, data],
+			codec = self._write_codec,
+			trace_id = trace_id)
+		queue = asyncio.Queue()
+		self._waiting_requests[req_id] = queue
+		finished = False
+		chunk_count = 0
+		try:
+			# send request and wait for chunks
+			await self.drain()
+			self._write_request(req)
+			while True:
+				if timeout is None:
+					res = await queue.get()
+				else:
+					res = await asyncio.wait_for(queue.get(), timeout)
+				if res.response_type == RESPONSE_TYPE_CHUNK:
+					chunk_count += 1
+					if trace_id is not None and chunk_count == 1:
+						tracer.record_span("pipetalk.first_chunk "+method_name, trace_id, start_time, time.perf_counter())
+					yield res.get_data()
+					continue
+				finished = True
+				if res.response_type == RESPONSE_TYPE_ERROR:
+					raise (res.get_error() or RuntimeError("Unknown error response"))
+				elif res.response_type != RESPONSE_TYPE_RESULT:
+					raise RuntimeError("Unknown error response type "+res.response_type)
+				backend_stats.record("pipetalk.stream."+method_name, time.perf_counter() - start_time)
+				break
+		finally:
+			if self._waiting_requests.get(req_id, None) is queue:
+				self._waiting_requests.pop(req_id)
+			if trace_id is not None:
+				tracer.record_span("pipetalk.stream "+method_name, trace_id, start_time, time.perf_counter(), {"chunks": chunk_count})
+			if not finished:
+				# let the other end stop producing chunks
+				try:
+					self._write_cancel(PipeTalkCancel(req_id))
+				except BaseException as error:
+					logger.error("Error sending cancel for request "+req_id+": "+str(error))
+	
+	# negotiate connection options with the other end of the pipe
+	#  This must be called before any other requests are sent. If the other end
+	#  doesn't support negotiation, the connection stays on the text protocol with json.
+	#  Framings, codecs and compressions are given in order of preference, and the chosen framing is returned.
+	#  Payload compression and shared memory are only used with binary framing.
+	#  With trace enabled, requests sent within a trace carry its id so the other end records spans for the same trace.
+	async def negotiate(self, framings: List[str] = SUPPORTED_FRAMINGS, codecs: List[str] = SUPPORTED_CODECS, compressions: List[str] = SUPPORTED_COMPRESSIONS, shm: bool = SHM_AVAILABLE, trace: bool = True) -> str:
+		req_id = self._get_next_request_id()
+		self._negotiate_request_id = req_id
+		try:
+			res = await self._send_request_with_id(req_id, NEGOTIATE_METHOD, {
+				"framing": framings,
+				"codec": codecs,
+				"compression": compressions,
+				"shm": shm,
+				"trace": trace
+			})
+		finally:
+			self._negotiate_request_id = None
+		if res.response_type != RESPONSE_TYPE_RESULT:
+			logger.info("pipetalk negotiation not supported, using text framing")
+			return self._write_framing
+		# the reader was already switched to the chosen framing and codec when the response was read
+		result = res.get_result_data() or dict()
+		framing = result.get("framing", FRAMING_TEXT)
+		self._write_framing = framing
+		self._write_codec = get_codec(result.get("codec", CODEC_JSON))
+		compression = result.get("compression", None)
+		self._compressor.compression = get_compression(compression) if compression is not None else None
+		self._shm_channel.enabled = result.get("shm", False)
+		self._send_trace_ids = result.get("trace", False)
+		return framing
+	
+	async def request(self, method_name: str, data: PipeTalkData = None, timeout: float = None) -> PipeTalkData:
 		res = await self.send_request(
 			method_name = method_name,
-			data = data)
+			data = data,
+			timeout = timeout)
 		if res.response_type == RESPONSE_TYPE_RESULT:
 			return res.get_result_data()
 		elif res.response_type == RESPONSE_TYPE_ERROR:
@@ -407,17 +1143,25 @@ class PipeTalker:
 	
 	
 	
+	# get the id of the trace that a request sent from the current task is part of
+	def _get_trace_id(self) -> str:
+		if not self._send_trace_ids:
+			return None
+		return current_trace_id.get()
+	
 	def _increment_request_id(self):
 		self._next_request_id += 1
 		if self._next_request_id >= MAX_REQUEST_IDS:
 			self._next_request_id = 0
 	
 	def _get_next_request_id(self) -> str:
+		if self._reader_closed:
+			raise ConnectionResetError("pipetalk reader is closed")
 		if len(self._waiting_requests) >= MAX_REQUEST_IDS:
 			raise RuntimeError("Too many pending requests")
 		next_id = str(self._next_request_id)
 		self._increment_request_id()
-		while next_id in self._waiting_requests or next_id in next_id in self._responses:
+		while next_id in self._waiting_requests:
 			next_id = str(self._next_request_id)
 			self._increment_request_id()
 		return next_id
@@ -426,66 +1170,205 @@ class PipeTalker:
 	# consume output from the reader pipe
 	def _consume_reader(self, quit_pipe: int, finished_evt: asyncio.Event, loop: asyncio.AbstractEventLoop):
 		try:
+			reader_fd = self.reader.fileno()
+			# read straight from the file descriptor, so no bytes get stuck in a buffer that select can't see
+			raw_reader = io.FileIO(reader_fd, 'rb', closefd=False)
+			msg_reader = self._msg_reader
 			while self._running:
 				# wait for readable pipe
-				(readable, _, _) = select.select([self.reader, quit_pipe], [], [])
+				(readable, _, _) = select.select([reader_fd, quit_pipe], [], [])
 				if quit_pipe in readable:
 					# quit pipe was written to, so listener loop needs to exit
 					break
-				# read line
-				line = self.reader.readline()
-				if isinstance(line, bytes):
-					line: str = line.decode('utf8')
-				if line and len(line) > 0:
+				# read available bytes
+				if msg_reader.read_from(raw_reader) == 0:
+					# reader pipe was closed
+					break
+				# handle any complete messages
+				while True:
+					try:
+						msg = msg_reader.next_message()
+					except BaseException as error:
+						logger.exception(error)
+						continue
+					if msg is None:
+						break
 					try:
-						self._handle_reader_line(line)
+						self._handle_reader_message(msg)
 					except BaseException as error:
 						logger.exception(error)
 		except BaseException as error:
 			logger.exception(error)
 		finally:
 			# trigger finished event
+			loop.call_soon_threadsafe(self._on_reader_closed)
 			loop.call_soon_threadsafe(finished_evt.set)
 	
-	# handle a received line from the reader pipe
-	def _handle_reader_line(self, line: str):
-		# ignore if empty
-		if len(line) == 0:
-			return
+	# respond to requests that are still waiting once nothing more can be read, so they don't wait forever
+	def _on_reader_closed(self):
+		self._reader_closed = True
+		for (req_id, waiting) in list(self._waiting_requests.items()):
+			res = PipeTalkResponse.from_error(req_id, ConnectionResetError("pipetalk reader closed before a response was received"))
+			if isinstance(waiting, asyncio.Queue):
+				waiting.put_nowait(res)
+			elif not waiting.done():
+				waiting.set_result(res)
+	
+	# handle bytes received by the asyncio reader protocol
+	def _handle_reader_data(self, data: bytes):
+		msg_reader = self._msg_reader
+		msg_reader.feed(data)
+		while True:
+			try:
+				msg = msg_reader.next_message()
+			except BaseException as error:
+				logger.exception(error)
+				continue
+			if msg is None:
+				break
+			try:
+				self._handle_reader_message(msg)
+			except BaseException as error:
+				logger.exception(error)
+	
+	# call a function on the event loop, directly if already running on it
+	def _call_on_loop(self, callable: Callable, *args):
+		if self._read_transport is not None:
+			callable(*args)
+		else:
+			self._loop.call_soon_threadsafe(callable, *args)
+	
+	# handle a received message from the reader pipe
+	def _handle_reader_message(self, msg: PipeTalkMessage):
 		loop = self._loop
-		# check message type
-		msg_type = line[0]
 
-		if msg_type == MSG_PREFIX_REQUEST:
+		if isinstance(msg, PipeTalkRequest):
 			# request message
-			req = PipeTalkRequest.parse(line)
+			req = msg
 			# check for request_id
 			if req.request_id is None:
-				logger.error("Received invalid request with no ID: "+line)
+				logger.error("Received invalid request with no ID: "+str(req))
 				return
 			# validate request
 			try:
 				req.validate()
 			except BaseException as error:
 				# send error response
-				res = PipeTalkResponse.from_error(req.request_id, error)
-				loop.call_soon_threadsafe(try_logexcept, args=(lambda:self._write_response(res),))
+				res = PipeTalkResponse.from_error(req.request_id, error, codec=self._write_codec)
+				self._call_on_loop(try_logexcept, lambda:self._write_response(res))
+				return
+			# handle negotiation on the reader thread, so the framing switches before the next message is read
+			if req.method_name == NEGOTIATE_METHOD:
+				self._handle_negotiate_request(req)
 				return
 			# handle request on main loop
-			loop.call_soon_threadsafe(lambda:loop.create_task(self._handle_request(req)))
+			self._call_on_loop(self._start_request_task, req, time.perf_counter())
 
-		elif msg_type == MSG_PREFIX_RESPONSE:
+		elif isinstance(msg, PipeTalkResponse):
 			# response message
-			res = PipeTalkResponse.parse(line)
+			res = msg
 			# check for request_id
 			if res.request_id is None:
-				logger.error("Received invalid response with no ID: "+line)
+				logger.error("Received invalid response with no ID: "+str(res))
 				return
+			# switch framing and codec if this is the negotiation response
+			if res.request_id == self._negotiate_request_id and res.response_type == RESPONSE_TYPE_RESULT:
+				result = res.get_result_data() or dict()
+				self._msg_reader.framing = result.get("framing", FRAMING_TEXT)
+				self._msg_reader.codec = get_codec(result.get("codec", CODEC_JSON))
 			# handle response
-			loop.call_soon_threadsafe(lambda:self._handle_response(res))
+			self._call_on_loop(self._handle_response, res)
+
+		elif isinstance(msg, PipeTalkCancel):
+			# cancel message
+			self._call_on_loop(self._handle_cancel, msg)
 
+		elif isinstance(msg, PipeTalkShmAck):
+			# the other end read a shared memory region, so it can be removed
+			self._shm_channel.reclaim(msg.region_name)
+	
+	# acknowledge a shared memory region after reading it (called on the reader thread when not using the asyncio transport)
+	def _on_shm_region_read(self, region_name: str):
+		ack = PipeTalkShmAck(region_name)
+		self._call_on_loop(try_logexcept, lambda:self._write_bytes(ack.to_frame()))
+	
+	# handle a negotiation request (called on the reader thread when not using the asyncio transport)
+	def _handle_negotiate_request(self, req: PipeTalkRequest):
+		loop = self._loop
+		try:
+			options = req.get_data() or dict()
+			framing = FRAMING_TEXT
+			for requested_framing in options.get("framing", []):
+				if requested_framing in SUPPORTED_FRAMINGS:
+					framing = requested_framing
+					break
+			# binary codecs can only be used with binary framing
+			codec = get_codec(CODEC_JSON)
+			for requested_codec in options.get("codec", []):
+				if requested_codec in SUPPORTED_CODECS:
+					requested_codec = get_codec(requested_codec)
+					if framing == FRAMING_BINARY or not requested_codec.binary:
+						codec = requested_codec
+						break
+			# compression is flagged in the frame header, so it needs binary framing
+			compression = None
+			if framing == FRAMING_BINARY:
+				for requested_compression in options.get("compression", []):
+					if requested_compression in SUPPORTED_COMPRESSIONS:
+						compression = get_compression(requested_compression)
+						break
+			# shared memory regions are flagged in the frame header too
+			use_shm = framing == FRAMING_BINARY and SHM_AVAILABLE and options.get("shm", False) == True
+			use_trace = options.get("trace", False) == True
+			res = PipeTalkResponse.from_result_data(req.request_id, {
+				"framing": framing,
+				"codec": codec.name,
+				"compression": compression.name if compression is not None else None,
+				"shm": use_shm,
+				"trace": use_trace
+			}, codec=self._write_codec)
+		except BaseException as error:
+			res = PipeTalkResponse.from_error(req.request_id, error, codec=self._write_codec)
+			framing = None
+			codec = None
+		# the other end will only send in the new framing and codec after it receives the response
+		if framing is not None:
+			self._msg_reader.framing = framing
+			self._msg_reader.codec = codec
+		def write_negotiate_response():
+			# the response is written in the old framing and codec, and anything after it in the new ones
+			self._write_response(res)
+			if framing is not None:
+				self._write_framing = framing
+				self._write_codec = codec
+				self._compressor.compression = compression
+				self._shm_channel.enabled = use_shm
+				self._send_trace_ids = use_trace
+		self._call_on_loop(try_logexcept, write_negotiate_response)
+	
+	# start a task to handle a parsed request, so it can be cancelled by the other end
+	def _start_request_task(self, req: PipeTalkRequest, received_time: float = None):
+		if req.request_id in self._running_requests:
+			logger.error("received duplicate request_id "+req.request_id)
+			return
+		# run the task within the trace of the request, if it has one
+		context = None
+		if req.trace_id is not None:
+			context = contextvars.copy_context()
+			context.run(current_trace_id.set, req.trace_id)
+			if received_time is not None:
+				tracer.record_span("pipetalk.dispatch", req.trace_id, received_time, time.perf_counter())
+		if req.method_name == BATCH_METHOD:
+			task = self._loop.create_task(self._handle_batch_request(req), context=context)
+		elif req.method_name == STREAM_METHOD:
+			task = self._loop.create_task(self._handle_stream_request(req), context=context)
 		else:
-			logger.error("Unknown message type {} for input line: {}".format(msg_type, line))
+			task = self._loop.create_task(self._handle_request(req), context=context)
+		self._running_requests[req.request_id] = task
+		def on_task_done(t: asyncio.Task):
+			if self._running_requests.get(req.request_id, None) is t:
+				self._running_requests.pop(req.request_id)
+		task.add_done_callback(on_task_done)
 	
 	# handle a parsed request
 	async def _handle_request(self, req: PipeTalkRequest):
@@ -495,47 +1378,421 @@ class PipeTalker:
 				if self.request_handler is None:
 					raise RuntimeError("No request handler available")
 				# call request handler
-				result = await self.request_handler(req)
-				res = PipeTalkResponse.from_result_data(req.request_id, result)
+				result = await self._call_request_handler(req)
+				res = PipeTalkResponse.from_result_data(req.request_id, result, codec=self._write_codec)
+			except asyncio.CancelledError:
+				# the other end stopped waiting, so there is nobody to respond to
+				logger.debug("request %s (%s) was cancelled", req.request_id, req.method_name)
+				return
 			except BaseException as error:
 				# handle error
-				res = PipeTalkResponse.from_error(req.request_id, error)
+				res = PipeTalkResponse.from_error(req.request_id, error, codec=self._write_codec)
 			self._write_response(res)
 		except BaseException as error:
 			logger.exception(error)
 	
+	# handle a parsed batch request, calling the request handler for each call concurrently
+	async def _handle_batch_request(self, req: PipeTalkRequest):
+		try:
+			try:
+				# ensure a request handler is available
+				if self.request_handler is None:
+					raise RuntimeError("No request handler available")
+				calls = req.get_data()
+				if not isinstance(calls, list):
+					raise ValueError("Invalid batch request data type "+str(type(calls)))
+				# validate every call before calling any, so an invalid call doesn't leave other calls unawaited
+				call_reqs = list()
+				for (index, call) in enumerate(calls):
+					if not isinstance(call, (list, tuple)) or len(call) != 2 or not isinstance(call[0], str):
+						raise ValueError("Invalid call at index {} of batch request".format(index))
+					(method_name, data) = call
+					call_reqs.append(PipeTalkRequest.create(
+						request_id = req.request_id+"."+str(index),
+						method_name = method_name,
+						data = data,
+						codec = req.codec,
+						trace_id = req.trace_id))
+				# call request handler for each call
+				call_tasks = [self._call_request_handler(call_req) for call_req in call_reqs]
+				call_results = await asyncio.gather(*call_tasks, return_exceptions=True)
+				results = list()
+				for call_result in call_results:
+					if isinstance(call_result, asyncio.CancelledError):
+						raise call_result
+					elif isinstance(call_result, BaseException):
+						results.append([RESPONSE_TYPE_ERROR, error_to_pipetalkdata(call_result)])
+					else:
+						results.append([RESPONSE_TYPE_RESULT, call_result])
+				res = PipeTalkResponse.from_result_data(req.request_id, results, codec=self._write_codec)
+			except asyncio.CancelledError:
+				# the other end stopped waiting, so there is nobody to respond to
+				logger.debug("batch request %s was cancelled", req.request_id)
+				return
+			except BaseException as error:
+				# handle error
+				res = PipeTalkResponse.from_error(req.request_id, error, codec=self._write_codec)
+			self._write_response(res)
+		except BaseException as error:
+			logger.exception(error)
+	
+	# handle a parsed stream request, writing each chunk as soon as the handler yields it
+	async def _handle_stream_request(self, req: PipeTalkRequest):
+		try:
+			try:
+				# ensure a request handler is available
+				if self.request_handler is None:
+					raise RuntimeError("No request handler available")
+				stream_data = req.get_data()
+				if not isinstance(stream_data, list) or len(stream_data) != 2:
+					raise ValueError("Invalid stream request data")
+				(method_name, data) = stream_data
+				stream_req = PipeTalkRequest.create(
+					request_id = req.request_id,
+					method_name = method_name,
+					data = data,
+					codec = req.codec,
+					trace_id = req.trace_id)
+				# call request handler, holding the lane until the stream ends
+				lane = self._get_lane(method_name)
+				await self._acquire_lane(lane, method_name)
+				try:
+					with tracer.span("pipetalk.handle "+method_name):
+						result = await self.request_handler(stream_req)
+					if inspect.isasyncgen(result):
+						try:
+							async for chunk in result:
+								with tracer.span("pipetalk.write_chunk"):
+									self._write_response(PipeTalkResponse(
+										request_id = req.request_id,
+										response_type = RESPONSE_TYPE_CHUNK,
+										payload = encode_payload(self._write_codec, chunk),
+										codec = self._write_codec))
+									# don't produce chunks faster than the other end reads them
+									await self.drain()
+						finally:
+							await result.aclose()
+					elif result is not None:
+						self._write_response(PipeTalkResponse(
+							request_id = req.request_id,
+							response_type = RESPONSE_TYPE_CHUNK,
+							payload = encode_payload(self._write_codec, result),
+							codec = self._write_codec))
+				finally:
+					lane.release()
+				res = PipeTalkResponse.from_result_data(req.request_id, None, codec=self._write_codec)
+			except asyncio.CancelledError:
+				# the other end stopped iterating, so there is nobody to respond to
+				logger.debug("stream request %s was cancelled", req.request_id)
+				return
+			except BaseException as error:
+				# handle error
+				res = PipeTalkResponse.from_error(req.request_id, error, codec=self._write_codec)
+			self._write_response(res)
+		except BaseException as error:
+			logger.exception(error)
+	
+	def _get_lane(self, method_name: str) -> RequestLane:
+		lane_name = self.method_lanes.get(method_name, LANE_NORMAL)
+		lane = self.lanes.get(lane_name, None)
+		if lane is None:
+			logger.warning("unknown lane "+lane_name+" for method "+method_name)
+			lane = self.lanes[LANE_NORMAL]
+		return lane
+	
+	async def _acquire_lane(self, lane: RequestLane, method_name: str):
+		start_time = time.perf_counter()
+		await lane.acquire(method_name)
+		end_time = time.perf_counter()
+		backend_stats.record("pipetalk.lane_wait."+lane.name, end_time - start_time)
+		trace_id = current_trace_id.get()
+		if trace_id is not None:
+			tracer.record_span("pipetalk.lane_wait", trace_id, start_time, end_time, {"lane": lane.name})
+	
+	# call the request handler once the request is admitted by its lane
+	async def _call_request_handler(self, req: PipeTalkRequest) -> PipeTalkData:
+		lane = self._get_lane(req.method_name)
+		await self._acquire_lane(lane, req.method_name)
+		try:
+			with tracer.span("pipetalk.handle "+req.method_name):
+				return await self._join_chunks(await self.request_handler(req))
+		finally:
+			lane.release()
+	
+	# join the chunks of an async generator result into a single result, for requests that weren't streamed
+	#  list chunks are concatenated, and any other chunks are added as items
+	async def _join_chunks(self, result: Any) -> PipeTalkData:
+		if not inspect.isasyncgen(result):
+			return result
+		joined = list()
+		try:
+			async for chunk in result:
+				if isinstance(chunk, list):
+					joined.extend(chunk)
+				else:
+					joined.append(chunk)
+		finally:
+			await result.aclose()
+		return joined
+	
 	# handle a parsed response
 	def _handle_response(self, res: PipeTalkResponse):
 		try:
-			# check for conflicting response
 			req_id = res.request_id
-			if req_id in self._responses:
-				logger.error("cannot overwrite existing response for request_id "+req_id)
+			future = self._waiting_requests.get(req_id, None)
+			if future is None:
+				# the request may have timed out or been cancelled
+				if res.response_type != RESPONSE_TYPE_CHUNK:
+					logger.warning("no waiting requests found matching response with request_id "+req_id)
 				return
-			if req_id not in self._waiting_requests:
-				logger.error("no waiting requests found matching response with request_id "+req_id)
+			if isinstance(future, asyncio.Queue):
+				# streamed request
+				future.put_nowait(res)
 				return
-			# set response and trigger event
-			(evtloop,evt) = self._waiting_requests[req_id]
-			self._responses[res.request_id] = res
-			evtloop.call_soon_threadsafe(evt.set)
+			if res.response_type == RESPONSE_TYPE_CHUNK:
+				logger.error("received chunk for request_id "+req_id+" that isn't streamed")
+				return
+			if future.done():
+				logger.error("cannot overwrite existing response for request_id "+req_id)
+				return
+			future.set_result(res)
 		except BaseException as error:
 			logger.exception(error)
+	
+	# handle a request cancellation from the other end
+	def _handle_cancel(self, cancel: PipeTalkCancel):
+		task = self._running_requests.get(cancel.request_id, None)
+		if task is None:
+			# the request already finished
+			return
+		task.cancel()
 
 	# writes a request to the writer pipe
 	def _write_request(self, req: PipeTalkRequest):
-		req_str = req.stringify()+"\n"
-		if 'b' in self.writer.mode:
-			self.writer.write(req_str.encode('utf8'))
+		if self._write_framing == FRAMING_BINARY:
+			self._write_bytes(req.to_frame(self._compressor, self._shm_channel))
+		else:
+			self._write_bytes((req.stringify()+"\n").encode('utf8'))
+	
+	# writes a cancellation to the writer pipe
+	def _write_cancel(self, cancel: PipeTalkCancel):
+		if self._write_framing == FRAMING_BINARY:
+			self._write_bytes(cancel.to_frame())
 		else:
-			self.writer.write(req_str)
-		self.writer.flush()
+			self._write_bytes((cancel.stringify()+"\n").encode('utf8'))
 	
 	# writes a response to the writer pipe
 	def _write_response(self, res: PipeTalkResponse):
-		res_str = res.stringify()+"\n"
-		if 'b' in self.writer.mode:
-			self.writer.write(res_str.encode('utf8'))
+		if self._write_framing == FRAMING_BINARY:
+			self._write_bytes(res.to_frame(self._compressor, self._shm_channel))
 		else:
-			self.writer.write(res_str)
-		self.writer.flush()
+			self._write_bytes((res.stringify()+"\n").encode('utf8'))
+	
+	# queue bytes to be written by the writer task (called on the event loop)
+	#  Bytes written once the pipetalker has stopped, like late responses, are dropped.
+	def _write_bytes(self, data: bytes):
+		if self._writes_closed or (self._writer_task is None and not self._running):
+			self.dropped_write_count += 1
+			logger.debug("dropping write of %d bytes to a stopped pipetalker", len(data))
+			return
+		if self._writer_task is None:
+			self._start_writer()
+		self._write_idle_evt.clear()
+		self._write_queue.append(data)
+		self._write_queue_size += len(data)
+		if self._write_queue_size > self.max_write_queue_size:
+			self.max_write_queue_size = self._write_queue_size
+		if self._write_queue_size >= self.write_high_water:
+			self._write_space_evt.clear()
+		self._write_ready_evt.set()
+	
+	# wait until the write queue and the pipe have room for more, so producers don't outpace the other end
+	async def drain(self):
+		write_space_evt = self._write_space_evt
+		if write_space_evt is not None and not write_space_evt.is_set():
+			await write_space_evt.wait()
+		write_protocol = self._write_protocol
+		if write_protocol is not None and not write_protocol.writable_evt.is_set():
+			await write_protocol.writable_evt.wait()
+	
+	def _start_writer(self):
+		self._write_ready_evt = asyncio.Event()
+		self._write_space_evt = asyncio.Event()
+		self._write_space_evt.set()
+		self._write_idle_evt = asyncio.Event()
+		self._write_idle_evt.set()
+		self._writer_task = self._loop.create_task(self._run_writer())
+	
+	# write anything still queued within WRITER_STOP_TIMEOUT seconds, then stop the writer task
+	#  If the other end stops reading, whatever is left in the queue is dropped.
+	#  Returns whether everything was written.
+	async def _stop_writer(self) -> bool:
+		writer_task = self._writer_task
+		if writer_task is None:
+			return True
+		write_idle_evt = self._write_idle_evt
+		flushed = True
+		if not write_idle_evt.is_set() and not writer_task.done():
+			try:
+				await asyncio.wait_for(write_idle_evt.wait(), WRITER_STOP_TIMEOUT)
+			except asyncio.TimeoutError:
+				logger.warning("other end of pipetalker stopped reading, dropping unwritten writes (%d bytes queued)", self._write_queue_size)
+				flushed = False
+		writer_task.cancel()
+		await asyncio.wait([writer_task])
+		if self._writer_task is writer_task:
+			self._writer_task = None
+			self.dropped_write_count += len(self._write_queue)
+			self._write_queue.clear()
+			self._write_queue_size = 0
+			self._write_space_evt.set()
+		return flushed
+	
+	async def _run_writer(self):
+		loop = asyncio.get_running_loop()
+		write_queue = self._write_queue
+		while True:
+			await self._write_ready_evt.wait()
+			self._write_ready_evt.clear()
+			while len(write_queue) > 0:
+				# join every frame queued since the last write into a single write
+				frame_count = len(write_queue)
+				if frame_count == 1:
+					data = write_queue.popleft()
+				else:
+					data = b"".join(write_queue)
+					write_queue.clear()
+				self._write_queue_size -= len(data)
+				start_time = time.perf_counter()
+				try:
+					write_transport = self._write_transport
+					if write_transport is not None:
+						# buffered by the transport without blocking the loop
+						write_transport.write(data)
+						await self._write_protocol.writable_evt.wait()
+					else:
+						# blocking writes happen off the loop, so a slow reader can't block it
+						await loop.run_in_executor(None, self._write_blocking, data)
+				except asyncio.CancelledError:
+					raise
+				except BaseException as error:
+					logger.exception(error)
+				# bytes past the pipe's capacity wait for the other end to read them, which is the time compression saves
+				self._compressor.record_transfer(len(data) - PIPE_BUFFER_SIZE, time.perf_counter() - start_time)
+				self.write_count += 1
+				self.written_frame_count += frame_count
+				self.written_bytes += len(data)
+				if self._write_queue_size <= self.write_low_water:
+					self._write_space_evt.set()
+			self._write_idle_evt.set()
+	
+	def _write_blocking(self, data: bytes):
+		writer = self.writer
+		if 'b' not in writer.mode:
+			# write to the underlying binary buffer of a text writer
+			writer.flush()
+			writer = writer.buffer
+		writer.write(data)
+		writer.flush()
+
+
+
+# run loopback benchmark if executing directly
+if __name__ == "__main__":
+	import time
+
+	def make_rows(count: int) -> list:
+		rows = list()
+		for i in range(count):
+			rows.append({
+				'device_path': '/org/freedesktop/UPower/devices/battery_BAT1',
+				'time': '2023-01-01 00:{:02d}:{:02d}.000000+00:00'.format((i // 60) % 60, i % 60),
+				'state': 'discharging',
+				'energy_Wh': 40.0 - (i * 0.001),
+				'energy_empty_Wh': 0.0,
+				'energy_full_Wh': 40.04,
+				'energy_full_design_Wh': 40.04,
+				'energy_rate_W': 10.5,
+				'voltage_V': 8.1,
+				'seconds_till_full': None,
+				'seconds_till_empty': 13000.0,
+				'percent_current': 80.0,
+				'percent_capacity': 100.0
+			})
+		return rows
+
+	async def run_benchmark(framing: str, row_count: int, iterations: int, use_asyncio: bool = False, codec: str = CODEC_JSON, compressions: List[str] = [], shm: bool = False) -> float:
+		(req_reader_fd, req_writer_fd) = os.pipe()
+		(res_reader_fd, res_writer_fd) = os.pipe()
+		rows = make_rows(row_count)
+		async def handle_request(req: PipeTalkRequest) -> PipeTalkData:
+			return rows
+		server = PipeTalker(
+			reader=open(req_reader_fd, 'rb'),
+			writer=open(res_writer_fd, 'wb'),
+			request_handler=handle_request)
+		client = PipeTalker(
+			reader=open(res_reader_fd, 'rb'),
+			writer=open(req_writer_fd, 'wb'))
+		if use_asyncio:
+			await server.listen_async()
+			await client.listen_async()
+		else:
+			server.listen()
+			client.listen()
+		await client.negotiate([framing], [codec], compressions, shm)
+		await client.request("get_rows")
+		start_time = time.perf_counter()
+		for i in range(iterations):
+			await client.request("get_rows")
+		elapsed = time.perf_counter() - start_time
+		if len(compressions) > 0:
+			print("  server compression stats: {}".format(server.stats()["compression_stats"]))
+		await client.unlisten()
+		await server.unlisten()
+		for pipe_file in (server.reader, server.writer, client.reader, client.writer):
+			if not pipe_file.closed:
+				pipe_file.close()
+		return elapsed / iterations
+
+	# time building a response and parsing it back in a framing, which is the work the framing adds to a request
+	# apart from the codec and the pipe
+	def benchmark_framing(framing: str, codec: str, row_count: int, iterations: int) -> float:
+		res = PipeTalkResponse.from_result_data("1", make_rows(row_count), codec=get_codec(codec))
+		reader = PipeTalkMessageReader()
+		reader.framing = framing
+		start_time = time.perf_counter()
+		for i in range(iterations):
+			if framing == FRAMING_BINARY:
+				reader.feed(res.to_frame())
+			else:
+				reader.feed((res.stringify()+"\n").encode('utf8'))
+			reader.next_message()
+		return (time.perf_counter() - start_time) / iterations
+
+	# the best of a few runs, since a single run is easily thrown off by the scheduler on a busy machine
+	async def best_of_runs(run: Callable[[],Awaitable[float]], count: int = 3) -> float:
+		return min([await run() for i in range(count)])
+
+	async def run_benchmarks():
+		for row_count in (10, 1000, 20000):
+			iterations = max(5, 20000 // row_count)
+			for codec in SUPPORTED_CODECS:
+				if get_codec(codec).binary:
+					framings = (FRAMING_BINARY,)
+				else:
+					framings = (FRAMING_TEXT, FRAMING_BINARY)
+				for framing in framings:
+					framing_time = benchmark_framing(framing, codec, row_count, iterations)
+					for use_asyncio in (False, True):
+						per_request = await best_of_runs(lambda:run_benchmark(framing, row_count, iterations, use_asyncio=use_asyncio, codec=codec))
+						print("{} rows, {} codec, {} framing, {} transport: {:.3f} ms per request ({:.3f} ms framing)".format(
+							row_count, codec, framing, "asyncio" if use_asyncio else "thread", per_request * 1000, framing_time * 1000))
+			for compression in SUPPORTED_COMPRESSIONS:
+				per_request = await run_benchmark(FRAMING_BINARY, row_count, iterations, use_asyncio=True, codec=SUPPORTED_CODECS[0], compressions=[compression])
+				print("{} rows, {} codec, {} compression: {:.3f} ms per request".format(row_count, SUPPORTED_CODECS[0], compression, per_request * 1000))
+			if SHM_AVAILABLE:
+				per_request = await run_benchmark(FRAMING_BINARY, row_count, iterations, use_asyncio=True, codec=SUPPORTED_CODECS[0], shm=True)
+				print("{} rows, {} codec, shared memory: {:.3f} ms per request".format(row_count, SUPPORTED_CODECS[0], per_request * 1000))
+
+	asyncio.run(run_benchmarks())
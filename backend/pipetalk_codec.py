@@ -0,0 +1,217 @@
+from typing import Any, Dict, List, Union
+from abc import ABC, abstractmethod
+import json
+import datetime
+import logging
+
+# optional fast codecs, available when installed in py_modules
+try:
+	import orjson
+except ImportError:
+	orjson = None
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+logger = logging.getLogger()
+
+CODEC_JSON = 'json'
+CODEC_ORJSON = 'orjson'
+CODEC_MSGPACK = 'msgpack'
+
+PipeTalkPayload = Union[str, bytes, memoryview]
+
+_DATETIME_TYPES = (datetime.datetime, datetime.date, datetime.time)
+# values that to_plain_data converts or looks into
+_NON_PLAIN_TYPES = _DATETIME_TYPES + (dict, list, set, frozenset, tuple)
+# values that never need converting, checked by exact type first since that's much faster than isinstance
+_PLAIN_TYPES = frozenset((str, int, float, bool, type(None)))
+
+# encode values that the codecs don't support natively
+def _encode_default(value: Any) -> Any:
+	if isinstance(value, _DATETIME_TYPES):
+		return value.isoformat()
+	elif isinstance(value, (set, frozenset, tuple)):
+		return list(value)
+	raise TypeError("Object of type {} is not serializable".format(type(value).__name__))
+
+# convert the values in data that the codecs don't support natively the same way they're encoded, for results
+# that aren't sent through a pipe
+#  Data is converted in place, and only values that need converting or may contain such values are looked into.
+def to_plain_data(data: Any) -> Any:
+	if isinstance(data, _DATETIME_TYPES):
+		return data.isoformat()
+	elif isinstance(data, (set, frozenset, tuple)):
+		data = list(data)
+	if isinstance(data, dict):
+		for (key, value) in data.items():
+			if type(value) not in _PLAIN_TYPES and isinstance(value, _NON_PLAIN_TYPES):
+				data[key] = to_plain_data(value)
+	elif isinstance(data, list):
+		for (index, value) in enumerate(data):
+			if type(value) is dict:
+				# rows are checked here instead of in another call, since results are often long lists of them
+				for (key, item) in value.items():
+					if type(item) not in _PLAIN_TYPES and isinstance(item, _NON_PLAIN_TYPES):
+						value[key] = to_plain_data(item)
+			elif type(value) not in _PLAIN_TYPES and isinstance(value, _NON_PLAIN_TYPES):
+				data[index] = to_plain_data(value)
+	return data
+
+
+
+# Codec
+#  Encodes message data into payloads and decodes it back. Datetimes are encoded as ISO 8601 strings.
+#  binary: whether payloads can contain bytes that aren't valid utf8, so they can only be sent with binary framing
+
+class PipeTalkCodec(ABC):
+	name: str
+	binary: bool = False
+
+	@abstractmethod
+	def encode(self, data: Any) -> PipeTalkPayload:
+		pass
+
+	@abstractmethod
+	def decode(self, payload: PipeTalkPayload) -> Any:
+		pass
+
+class JsonCodec(PipeTalkCodec):
+	name = CODEC_JSON
+
+	def encode(self, data: Any) -> str:
+		return json.dumps(data, default=_encode_default)
+
+	def decode(self, payload: PipeTalkPayload) -> Any:
+		if isinstance(payload, memoryview):
+			payload = bytes(payload)
+		return json.loads(payload)
+
+class OrjsonCodec(PipeTalkCodec):
+	name = CODEC_ORJSON
+
+	def encode(self, data: Any) -> bytes:
+		return orjson.dumps(data, default=_encode_default)
+
+	def decode(self, payload: PipeTalkPayload) -> Any:
+		return orjson.loads(payload)
+
+class MsgpackCodec(PipeTalkCodec):
+	name = CODEC_MSGPACK
+	binary = True
+
+	def encode(self, data: Any) -> bytes:
+		return msgpack.packb(data, default=_encode_default, use_bin_type=True)
+
+	def decode(self, payload: PipeTalkPayload) -> Any:
+		if isinstance(payload, str):
+			raise ValueError("msgpack payloads can't be sent in text framing")
+		return msgpack.unpackb(payload, raw=False)
+
+
+
+JSON_CODEC: PipeTalkCodec = JsonCodec()
+
+# available codecs, from most to least preferred
+CODECS: Dict[str,PipeTalkCodec] = dict()
+if msgpack is not None:
+	CODECS[CODEC_MSGPACK] = MsgpackCodec()
+if orjson is not None:
+	CODECS[CODEC_ORJSON] = OrjsonCodec()
+CODECS[CODEC_JSON] = JSON_CODEC
+
+SUPPORTED_CODECS: List[str] = list(CODECS.keys())
+
+def get_codec(name: str) -> PipeTalkCodec:
+	codec = CODECS.get(name, None)
+	if codec is None:
+		raise ValueError("Unsupported pipetalk codec "+str(name))
+	return codec
+
+
+
+# run codec benchmark if executing directly
+#  Uses the battery logs from the last 7 days of a power history DB if a DB directory is given,
+#  or generated battery logs otherwise.
+if __name__ == "__main__":
+	import time
+	import asyncio
+	import argparse
+	from power_history import PowerHistoryDB, BatteryStateLog, tzinfo_utc
+
+	def make_logs(count: int) -> List[BatteryStateLog]:
+		start_time = datetime.datetime.now(tzinfo_utc) - datetime.timedelta(days=7)
+		logs = list()
+		for i in range(count):
+			logs.append(BatteryStateLog(
+				device_path = '/org/freedesktop/UPower/devices/battery_BAT1',
+				time = start_time + datetime.timedelta(seconds=i * 30),
+				state = 'discharging',
+				energy_Wh = 40.0 - ((i % 1000) * 0.03),
+				energy_empty_Wh = 0.0,
+				energy_full_Wh = 40.04,
+				energy_full_design_Wh = 40.04,
+				energy_rate_W = 10.5 + ((i % 7) * 0.1),
+				voltage_V = 8.1,
+				seconds_till_full = None,
+				seconds_till_empty = 13000.0 - (i % 1000),
+				percent_current = 80.0,
+				percent_capacity = 100.0))
+		return logs
+
+	async def load_logs(db_dir: str) -> List[BatteryStateLog]:
+		db = PowerHistoryDB(dir=db_dir)
+		await db.connect()
+		try:
+			return await db.get_battery_state_logs(
+				time_start = datetime.datetime.now(tzinfo_utc) - datetime.timedelta(days=7))
+		finally:
+			await db.close()
+
+	def benchmark_codec(codec: PipeTalkCodec, data: Any, iterations: int) -> dict:
+		payload = codec.encode(data)
+		start_time = time.perf_counter()
+		for i in range(iterations):
+			payload = codec.encode(data)
+		encode_time = (time.perf_counter() - start_time) / iterations
+		start_time = time.perf_counter()
+		for i in range(iterations):
+			codec.decode(payload)
+		decode_time = (time.perf_counter() - start_time) / iterations
+		return {
+			"size": len(payload),
+			"encode_ms": encode_time * 1000,
+			"decode_ms": decode_time * 1000
+		}
+
+	parser = argparse.ArgumentParser(description="Benchmark pipetalk codecs with battery state log results")
+	parser.add_argument("--db-dir", default=None, help="directory of a power history DB to load battery logs from")
+	parser.add_argument("--count", type=int, default=20160, help="number of generated battery logs (7 days at 30 second intervals)")
+	parser.add_argument("--iterations", type=int, default=10)
+	args = parser.parse_args()
+
+	if args.db_dir is not None:
+		logs = asyncio.run(load_logs(args.db_dir))
+	else:
+		logs = make_logs(args.count)
+	print("{} battery logs, codecs: {}".format(len(logs), ", ".join(SUPPORTED_CODECS)))
+	# results as returned by the plugin, with times as DB strings
+	str_rows = list()
+	for log in logs:
+		row = log.to_dict()
+		if isinstance(row['time'], datetime.datetime):
+			row['time'] = str(row['time'])
+		str_rows.append(row)
+	# results with datetimes, which are encoded natively without converting them first
+	datetime_rows = list()
+	for log in logs:
+		row = log.to_dict()
+		if isinstance(row['time'], str):
+			row['time'] = datetime.datetime.fromisoformat(row['time'])
+		datetime_rows.append(row)
+	for (rows_name, rows) in (("string times", str_rows), ("datetimes", datetime_rows)):
+		for codec in CODECS.values():
+			result = benchmark_codec(codec, rows, args.iterations)
+			print("{}, {}: {} bytes, encode {:.2f} ms, decode {:.2f} ms".format(
+				rows_name, codec.name, result["size"], result["encode_ms"], result["decode_ms"]))
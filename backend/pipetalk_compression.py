@@ -0,0 +1,188 @@
+from typing import Dict, List, Tuple, Union
+from abc import ABC, abstractmethod
+import zlib
+import time
+import logging
+
+# optional fast compression, available when installed in py_modules
+try:
+	import lz4.frame
+except ImportError:
+	lz4 = None
+
+logger = logging.getLogger()
+
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_LZ4 = 'lz4'
+
+# compression algorithm bits of the binary frame flags
+FRAME_FLAG_COMPRESSION_MASK = 0x03
+FRAME_FLAG_ZLIB = 0x01
+FRAME_FLAG_LZ4 = 0x02
+
+
+
+# Compression algorithm
+#  flag: the frame flag marking a payload compressed with this algorithm
+
+class PipeTalkCompression(ABC):
+	name: str
+	flag: int
+
+	@abstractmethod
+	def compress(self, payload: bytes) -> bytes:
+		pass
+
+	@abstractmethod
+	def decompress(self, payload: Union[bytes, memoryview]) -> bytes:
+		pass
+
+class ZlibCompression(PipeTalkCompression):
+	name = COMPRESSION_ZLIB
+	flag = FRAME_FLAG_ZLIB
+	# the lowest level is much faster and only slightly larger for repetitive json
+	level: int = 1
+
+	def compress(self, payload: bytes) -> bytes:
+		return zlib.compress(payload, self.level)
+
+	def decompress(self, payload: Union[bytes, memoryview]) -> bytes:
+		return zlib.decompress(payload)
+
+class Lz4Compression(PipeTalkCompression):
+	name = COMPRESSION_LZ4
+	flag = FRAME_FLAG_LZ4
+
+	def compress(self, payload: bytes) -> bytes:
+		return lz4.frame.compress(payload)
+
+	def decompress(self, payload: Union[bytes, memoryview]) -> bytes:
+		return lz4.frame.decompress(payload)
+
+
+
+# available compression algorithms, from most to least preferred
+COMPRESSIONS: Dict[str,PipeTalkCompression] = dict()
+if lz4 is not None:
+	COMPRESSIONS[COMPRESSION_LZ4] = Lz4Compression()
+COMPRESSIONS[COMPRESSION_ZLIB] = ZlibCompression()
+
+SUPPORTED_COMPRESSIONS: List[str] = list(COMPRESSIONS.keys())
+
+_COMPRESSIONS_BY_FLAG: Dict[int,PipeTalkCompression] = {compression.flag: compression for compression in COMPRESSIONS.values()}
+
+def get_compression(name: str) -> PipeTalkCompression:
+	compression = COMPRESSIONS.get(name, None)
+	if compression is None:
+		raise ValueError("Unsupported pipetalk compression "+str(name))
+	return compression
+
+
+
+class PayloadCompressionStats:
+	compressed_count: int = 0
+	# payloads over the size threshold that weren't compressed because it wasn't worth the CPU time
+	skipped_count: int = 0
+	decompressed_count: int = 0
+	bytes_in: int = 0
+	bytes_out: int = 0
+	compress_seconds: float = 0.0
+	decompress_seconds: float = 0.0
+
+	def to_dict(self) -> dict:
+		return {
+			"compressed": self.compressed_count,
+			"skipped": self.skipped_count,
+			"decompressed": self.decompressed_count,
+			"bytes_in": self.bytes_in,
+			"bytes_out": self.bytes_out,
+			"bytes_saved": self.bytes_in - self.bytes_out,
+			"compress_ms": self.compress_seconds * 1000,
+			"decompress_ms": self.decompress_seconds * 1000
+		}
+
+
+
+# Payload compressor
+#  Compresses frame payloads over a size threshold, and decompresses received payloads based on the frame flags.
+#  The time spent compressing a payload is compared with the estimated time saved by sending fewer bytes
+#  (assuming decompressing costs about as much as compressing), using the transfer speed measured from the
+#  writer's large writes. Payloads that shrink below the ratio threshold are always worth sending compressed.
+#  When compressing isn't worth it, the next payloads are sent uncompressed, backing off further each time
+#  another attempt isn't worth it either.
+
+class PayloadCompressor:
+	# the negotiated algorithm to compress sent payloads with, or None to only decompress
+	compression: PipeTalkCompression = None
+	# payloads smaller than this are never compressed
+	size_threshold: int = 32768
+	# estimated speed that bytes move through the pipe and get copied by the reader, until writes are measured
+	transfer_bytes_per_second: float = 1000000000.0
+	# weight of each measured write in the transfer speed estimate
+	transfer_sample_weight: float = 0.25
+	# payloads compressed to less than this fraction of their size are worth it regardless of the time taken
+	ratio_threshold: float = 0.25
+	# estimated cost of decompressing, relative to the cost of compressing
+	decompress_cost_factor: float = 1.0
+	# bounds for the number of payloads to skip after compressing wasn't worth it
+	min_skip_count: int = 4
+	max_skip_count: int = 256
+	stats: PayloadCompressionStats
+	_skip_count: int = 0
+	_skip_remaining: int = 0
+
+	def __init__(self, compression: PipeTalkCompression = None):
+		self.compression = compression
+		self.stats = PayloadCompressionStats()
+
+	# compress a payload if it's worth it, returning the frame flags and the payload to send
+	def compress(self, payload: bytes) -> Tuple[int, bytes]:
+		compression = self.compression
+		payload_len = len(payload)
+		if compression is None or payload_len < self.size_threshold:
+			return (0, payload)
+		if self._skip_remaining > 0:
+			self._skip_remaining -= 1
+			self.stats.skipped_count += 1
+			return (0, payload)
+		start_time = time.perf_counter()
+		compressed = compression.compress(payload)
+		elapsed = time.perf_counter() - start_time
+		stats = self.stats
+		stats.compress_seconds += elapsed
+		compressed_len = len(compressed)
+		# check if the saved transfer time made up for the time spent compressing and decompressing
+		saved_seconds = (payload_len - compressed_len) / self.transfer_bytes_per_second
+		if compressed_len > payload_len * self.ratio_threshold and saved_seconds <= elapsed * (1 + self.decompress_cost_factor):
+			self._skip_count = min(self.max_skip_count, max(self.min_skip_count, self._skip_count * 2))
+			self._skip_remaining = self._skip_count
+		else:
+			self._skip_count = 0
+		if compressed_len >= payload_len:
+			stats.skipped_count += 1
+			return (0, payload)
+		stats.compressed_count += 1
+		stats.bytes_in += payload_len
+		stats.bytes_out += compressed_len
+		return (compression.flag, compressed)
+
+	# update the transfer speed estimate from the time taken to write a number of bytes to the pipe
+	def record_transfer(self, byte_count: int, seconds: float):
+		if byte_count < self.size_threshold or seconds <= 0:
+			return
+		weight = self.transfer_sample_weight
+		self.transfer_bytes_per_second = (self.transfer_bytes_per_second * (1 - weight)) + ((byte_count / seconds) * weight)
+
+	# decompress a received payload if its frame flags mark it as compressed
+	def decompress(self, flags: int, payload: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+		compression_flag = flags & FRAME_FLAG_COMPRESSION_MASK
+		if compression_flag == 0:
+			return payload
+		compression = _COMPRESSIONS_BY_FLAG.get(compression_flag, None)
+		if compression is None:
+			raise ValueError("Unsupported compression flag {} for frame".format(compression_flag))
+		start_time = time.perf_counter()
+		decompressed = compression.decompress(payload)
+		self.stats.decompress_seconds += time.perf_counter() - start_time
+		self.stats.decompressed_count += 1
+		return decompressed
@@ -0,0 +1,173 @@
+from typing import Callable, Dict
+import os
+import threading
+import logging
+
+logger = logging.getLogger()
+
+SHM_DIR = '/dev/shm'
+SHM_FILE_PREFIX = 'pipetalk-'
+
+# whether payloads can be placed in shared memory on this system
+SHM_AVAILABLE: bool = os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK)
+
+# shared memory bit of the binary frame flags
+#  When set, the frame payload is the utf8 name of a shared memory region holding the real payload.
+FRAME_FLAG_SHM = 0x04
+
+# whether regions left behind by processes that are gone were already removed by this process
+_stale_regions_removed: bool = False
+
+# remove the regions of processes that exited without removing them, like after a crash
+#  Region names start with the pid of the process that wrote them. Returns the number of regions removed.
+def remove_stale_regions() -> int:
+	try:
+		names = os.listdir(SHM_DIR)
+	except OSError:
+		return 0
+	own_pid = os.getpid()
+	own_uid = os.getuid()
+	removed_count = 0
+	for name in names:
+		if not name.startswith(SHM_FILE_PREFIX):
+			continue
+		pid_str = name[len(SHM_FILE_PREFIX):].split('-', 1)[0]
+		if not pid_str.isdigit() or int(pid_str) == own_pid:
+			continue
+		try:
+			if os.stat(os.path.join(SHM_DIR, name)).st_uid != own_uid:
+				continue
+			os.kill(int(pid_str), 0)
+			# the process is still running
+			continue
+		except ProcessLookupError:
+			pass
+		except OSError:
+			continue
+		try:
+			os.unlink(os.path.join(SHM_DIR, name))
+			removed_count += 1
+		except OSError:
+			pass
+	if removed_count > 0:
+		logger.info("removed %d stale shared memory regions", removed_count)
+	return removed_count
+
+
+
+class SharedMemoryStats:
+	sent_count: int = 0
+	sent_bytes: int = 0
+	received_count: int = 0
+	received_bytes: int = 0
+	reclaimed_count: int = 0
+
+	def to_dict(self) -> dict:
+		return {
+			"sent": self.sent_count,
+			"sent_bytes": self.sent_bytes,
+			"received": self.received_count,
+			"received_bytes": self.received_bytes,
+			"reclaimed": self.reclaimed_count
+		}
+
+
+
+# Shared memory side channel
+#  Payloads at or above the size threshold are written to a file in /dev/shm, and only the file name
+#  is sent through the pipe. The receiver reads the payload from the region and acknowledges it by name,
+#  and the sender then removes the region. Regions that are never acknowledged are removed on close, and the
+#  regions of processes that died before closing are removed by the first channel created in another process.
+
+class SharedMemoryChannel:
+	# whether sent payloads can be placed in shared memory, which is negotiated with the other end
+	enabled: bool = False
+	# payloads smaller than this are sent through the pipe
+	size_threshold: int = 1048576
+	# called with the name of each region that was read, so the sender can be told to reclaim it
+	on_region_read: Callable[[str],None] = None
+	stats: SharedMemoryStats
+	_next_region_id: int = 0
+	# regions that were sent and not yet acknowledged
+	_outstanding: Dict[str,int]
+	_lock: threading.Lock
+
+	def __init__(self):
+		global _stale_regions_removed
+		self.stats = SharedMemoryStats()
+		self._outstanding = dict()
+		self._lock = threading.Lock()
+		if SHM_AVAILABLE and not _stale_regions_removed:
+			_stale_regions_removed = True
+			remove_stale_regions()
+
+	@property
+	def outstanding_count(self) -> int:
+		return len(self._outstanding)
+
+	def should_send(self, payload: bytes) -> bool:
+		return self.enabled and len(payload) >= self.size_threshold
+
+	# write a payload into a new region, returning the name to send in its place
+	def send(self, payload: bytes) -> bytes:
+		with self._lock:
+			region_id = self._next_region_id
+			self._next_region_id += 1
+		name = "{}{}-{}".format(SHM_FILE_PREFIX, os.getpid(), region_id)
+		fd = os.open(os.path.join(SHM_DIR, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+		try:
+			with memoryview(payload) as payload_view:
+				offset = 0
+				payload_len = len(payload_view)
+				while offset < payload_len:
+					offset += os.write(fd, payload_view[offset:])
+		except:
+			os.close(fd)
+			self._unlink(name)
+			raise
+		os.close(fd)
+		with self._lock:
+			self._outstanding[name] = len(payload)
+		self.stats.sent_count += 1
+		self.stats.sent_bytes += len(payload)
+		return name.encode('utf8')
+
+	# read the payload of a received region
+	def receive(self, handle: bytes) -> bytes:
+		name = str(handle, 'utf8')
+		if '/' in name or not name.startswith(SHM_FILE_PREFIX):
+			raise ValueError("Invalid shared memory region name "+name)
+		with open(os.path.join(SHM_DIR, name), 'rb', buffering=0) as region_file:
+			payload = region_file.readall()
+		self.stats.received_count += 1
+		self.stats.received_bytes += len(payload)
+		if self.on_region_read is not None:
+			self.on_region_read(name)
+		return payload
+
+	# reclaim a region that the other end acknowledged
+	def reclaim(self, name: str):
+		with self._lock:
+			size = self._outstanding.pop(name, None)
+		if size is None:
+			logger.warning("received acknowledgement for unknown shared memory region "+name)
+			return
+		self._unlink(name)
+		self.stats.reclaimed_count += 1
+
+	# remove any regions that were never acknowledged
+	def close(self):
+		self.enabled = False
+		with self._lock:
+			names = list(self._outstanding.keys())
+			self._outstanding.clear()
+		for name in names:
+			self._unlink(name)
+
+	def _unlink(self, name: str):
+		try:
+			os.unlink(os.path.join(SHM_DIR, name))
+		except FileNotFoundError:
+			pass
+		except BaseException as error:
+			logger.error("Error removing shared memory region "+name+": "+str(error))
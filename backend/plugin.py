@@ -1,27 +1,75 @@
 import os
 import asyncio
-from typing import Tuple, Callable
+from typing import Awaitable, Dict, List, Tuple, Callable
 import datetime
 import logging
 
 from utils import datetime_from_isoformat, try_logexcept_awaitable
-from upower_monitor import UPowerMonitor, UPowerDeviceInfo
-from power_history import PowerHistoryDB, SystemEventLog, SystemEventTypes
+from upower_monitor import UPowerMonitor, UPowerDeviceInfo, BatteryChanges, MONITOR_RECORD_PATH_ENV
+from power_history import PowerHistoryDB, BatteryStateLog, SystemEventLog, SystemEventTypes
+from ingest_compressor import BatteryLogCompressor
+from sampling_scheduler import AdaptiveSampler
 from system_signals import SystemSignalListener
-
-DATA_DIR = os.path.expanduser('~')+"/.battery-analytics-decky"
+from backend_stats import backend_stats, startup_report
+from tracing import tracer, write_trace_file
+from profiler import ProfilingSession, PROFILE_MODE_SAMPLE
+from pipetalk import LANE_CONTROL, LANE_BULK
+from paths import DATA_DIR, TRACES_DIR, PROFILES_DIR, RECORDINGS_DIR
 
 logger = logging.getLogger()
 
+# seconds for the plugin to unload, after which the steps that are still running are cancelled
+UNLOAD_TIMEOUT = 2.0
+# seconds that closing the DB is given when the unload deadline has already passed
+UNLOAD_DB_CLOSE_TIMEOUT = 0.5
+
+# seconds between logging each battery again with its current values, since the monitor doesn't report updates
+#  without changes, and the DB (or the ingest compressor) only keeps the unchanged logs it needs
+LOG_HEARTBEAT_INTERVAL = 60.0
+
+# request lanes for plugin methods, with other methods using the normal lane
+PLUGIN_METHOD_LANES = {
+	"_main": LANE_CONTROL,
+	"_unload": LANE_CONTROL,
+	"get_backend_stats": LANE_CONTROL,
+	"get_trace_events": LANE_CONTROL,
+	"dump_traces": LANE_CONTROL,
+	"profile": LANE_CONTROL,
+	"get_startup_report": LANE_CONTROL,
+	"stop_daemon": LANE_CONTROL,
+	"record_monitor": LANE_CONTROL,
+	"get_daemon_version": LANE_CONTROL,
+	"get_battery_state_logs": LANE_BULK,
+	"stream_battery_state_logs": LANE_BULK,
+	"get_system_event_logs": LANE_BULK
+}
+
 class Plugin:
 	started: bool = False
 	loop: asyncio.AbstractEventLoop = None
 	monitor: UPowerMonitor = None
 	db: PowerHistoryDB = None
 	system_signal_listener: SystemSignalListener = None
+	# compress battery logs before they're written to the DB
+	compress_ingest: bool = False
+	ingest_compressor: BatteryLogCompressor = None
+	# read the batteries' kernel power supplies between upower events at a rate adapted to the battery state
+	adaptive_sampling: bool = True
+	sampler: AdaptiveSampler = None
+	profiling_session: ProfilingSession = None
+	# starts the signal listener, device monitor and sampler after the plugin is ready to serve queries
+	_warmup_task: asyncio.Task = None
+	# logs batteries that haven't changed, so they're still logged every PowerHistoryDB.unchanged_log_interval
+	_heartbeat_task: asyncio.Task = None
+	# called with the range of times of the logs written to each table since it was last called, so cached query
+	# results can be dropped, as {table_name: [since, until]} with ISO 8601 times
+	#  Logs written in the same event loop iteration are reported in a single call.
+	on_data_changed: Callable[[Dict[str,List[str]]],None] = None
+	_changed_time_ranges: Dict[str,List[datetime.datetime]] = None
 	
 
 	# Asyncio-compatible long-running code, executed in a task when the plugin is loaded
+	#  This returns once the plugin is ready to serve queries, and the rest of the startup continues in the background.
 	async def _main(self):
 		logger.info("Loading Battery Analytics plugin")
 		if self.started:
@@ -30,28 +78,65 @@ class Plugin:
 		utcnow = datetime.datetime.utcnow()
 		self.loop = asyncio.get_event_loop()
 		# connect DB
-		if self.db is None:
-			self.db = PowerHistoryDB(dir=DATA_DIR)
-		await self.db.connect()
-		# start sleep inhibitor
-		if self.system_signal_listener is None:
-			self.system_signal_listener = SystemSignalListener()
-			self.system_signal_listener.on_system_suspend = self._when_system_suspended
-			self.system_signal_listener.on_system_resume = self._when_system_resumed
-			self.system_signal_listener.on_system_shutdown = self._when_system_shutdown
-		self.system_signal_listener.listen()
-		# start device monitor
-		if self.monitor is None:
-			self.monitor = UPowerMonitor()
-			self.monitor.update_devices_on_start = True
-			self.monitor.when_device_updated = self._when_device_updated
-		logger.info("starting upower monitor")
-		self.monitor.start()
-		# log plugin load
-		await self.db.add_system_event_log(SystemEventLog(utcnow, SystemEventTypes.PLUGIN_LOAD))
+		with startup_report.phase("db_connect"):
+			if self.db is None:
+				self.db = PowerHistoryDB(dir=DATA_DIR)
+			self.db.on_log_written = self._when_log_written
+			await self.db.connect()
+		backend_stats.add_source("db", self.db.stats)
+		# create ingest compressor
+		if self.compress_ingest and self.ingest_compressor is None:
+			self.ingest_compressor = BatteryLogCompressor()
+		if self.ingest_compressor is not None:
+			backend_stats.add_source("ingest_compressor", self.ingest_compressor.stats)
+		startup_report.mark("ready")
+		# start everything else in the background
+		self._warmup_task = asyncio.create_task(self._warm_up(utcnow))
+	
+	async def _warm_up(self, utcnow: datetime.datetime):
+		try:
+			# start sleep inhibitor
+			with startup_report.phase("signal_listener"):
+				if self.system_signal_listener is None:
+					self.system_signal_listener = SystemSignalListener()
+					self.system_signal_listener.on_system_suspend = self._when_system_suspended
+					self.system_signal_listener.on_system_resume = self._when_system_resumed
+					self.system_signal_listener.on_system_shutdown = self._when_system_shutdown
+				await self.system_signal_listener.listen_async()
+			# start device monitor
+			with startup_report.phase("monitor_start"):
+				if self.monitor is None:
+					self.monitor = UPowerMonitor()
+					self.monitor.update_devices_on_start = True
+					self.monitor.when_device_updated = self._when_device_updated
+				logger.info("starting upower monitor")
+				await self.monitor.start_async()
+			backend_stats.add_source("monitor", self.monitor.stats)
+			# start log heartbeat
+			if self._heartbeat_task is None:
+				self._heartbeat_task = asyncio.create_task(self._log_heartbeats())
+			# start adaptive sampler
+			if self.adaptive_sampling:
+				if self.sampler is None:
+					self.sampler = AdaptiveSampler(self.monitor)
+				self.sampler.start()
+				backend_stats.add_source("sampler", self.sampler.stats)
+			# log plugin load
+			with startup_report.phase("log_plugin_load"):
+				await self.db.add_system_event_log(SystemEventLog(utcnow, SystemEventTypes.PLUGIN_LOAD))
+			startup_report.mark("warm")
+			logger.info("startup: %s", startup_report.summary())
+		except asyncio.CancelledError:
+			logger.info("plugin was unloaded before it finished starting")
+			raise
+		except BaseException as error:
+			logger.exception(error)
 	
 	
 	# Function called first during the unload process, utilize this to handle your plugin being removed
+	#  The plugin is torn down in parallel within UNLOAD_TIMEOUT seconds. The events already read from the monitor
+	#  and the logs held by the ingest compressor are written before the DB is closed, and any step that is still
+	#  running at the deadline is cancelled.
 	async def _unload(self):
 		logger.info("Unloading Battery Analytics plugin")
 		was_started = self.started
@@ -59,21 +144,139 @@ class Plugin:
 			logger.warn("Plugin._unload called when plugin has already been closed")
 		self.started = False
 		utcnow = datetime.datetime.utcnow()
-		# stop device monitor
+		loop = asyncio.get_running_loop()
+		start_time = loop.time()
+		deadline = start_time + UNLOAD_TIMEOUT
+		# stop starting up
+		warmup_task = self._warmup_task
+		if warmup_task is not None:
+			if not warmup_task.done():
+				warmup_task.cancel()
+			await asyncio.wait([warmup_task])
+			if self._warmup_task is warmup_task:
+				self._warmup_task = None
+		teardown_steps = {
+			"stopping battery logging": self._stop_battery_logging(deadline),
+			"stopping SystemSignalListener": self._stop_system_signal_listener()
+		}
+		# log plugin unload if plugin was already started
+		if was_started and self.db is not None:
+			teardown_steps["logging plugin unload"] = self.db.add_system_event_log(SystemEventLog(utcnow, SystemEventTypes.PLUGIN_UNLOAD))
+		await self._run_teardown_steps(teardown_steps, deadline)
+		# close db once everything is written, even if the deadline has passed
+		if self.db is not None:
+			await self._run_teardown_steps({"closing DB": self.db.close()}, max(deadline, loop.time() + UNLOAD_DB_CLOSE_TIMEOUT))
+		logger.info("plugin unloaded in %.1f ms", (loop.time() - start_time) * 1000)
+	
+	# stop the log heartbeat, the sampler and the device monitor, then write the logs they left behind
+	async def _stop_battery_logging(self, deadline: float):
+		loop = asyncio.get_running_loop()
+		# stop log heartbeat
+		heartbeat_task = self._heartbeat_task
+		if heartbeat_task is not None:
+			heartbeat_task.cancel()
+			await asyncio.wait([heartbeat_task])
+			if self._heartbeat_task is heartbeat_task:
+				self._heartbeat_task = None
+		# stop adaptive sampler
+		try:
+			if self.sampler is not None:
+				await self.sampler.stop()
+		except BaseException as error:
+			logger.error("Error while stopping adaptive sampler:\n"+str(error))
+		# stop device monitor, dispatching the events it already read
 		try:
 			if self.monitor is not None:
-				self.monitor.stop()
+				await self.monitor.stop_async(flush_timeout=max(0.0, deadline - loop.time()))
 		except BaseException as error:
 			logger.error("Error while stopping UPower monitor:\n"+str(error))
-		# log plugin unload if plugin was already started
-		if was_started:
-			await self.db.add_system_event_log(SystemEventLog(utcnow, SystemEventTypes.PLUGIN_UNLOAD))
-		# stop sleep inhibitor
+		# write any battery logs held by the compressor
+		try:
+			await self._flush_ingest_compressor()
+		except BaseException as error:
+			logger.error("Error while flushing ingest compressor:\n"+str(error))
+	
+	async def _stop_system_signal_listener(self):
 		if self.system_signal_listener is not None:
-			self.system_signal_listener.unlisten()
-		# close db
-		if self.db is not None:
-			await self.db.close()
+			await self.system_signal_listener.unlisten_async()
+	
+	# run teardown steps at the same time, cancelling the steps that haven't finished by the deadline
+	#  steps: the awaitable of each step, keyed on a description of the step for logging
+	async def _run_teardown_steps(self, steps: Dict[str,Awaitable], deadline: float):
+		loop = asyncio.get_running_loop()
+		step_names = {asyncio.ensure_future(step): step_name for (step_name, step) in steps.items()}
+		(done, pending) = await asyncio.wait(step_names.keys(), timeout=max(0.0, deadline - loop.time()))
+		for task in done:
+			if not task.cancelled() and task.exception() is not None:
+				logger.error("Error while "+step_names[task]+":\n"+str(task.exception()))
+		if len(pending) > 0:
+			for task in pending:
+				logger.error("Timed out while "+step_names[task])
+				task.cancel()
+			await asyncio.wait(pending)
+	
+	
+	# latency histograms, counters and queue depths of the backend
+	async def get_backend_stats(self) -> dict:
+		return backend_stats.to_dict()
+	
+	# profile CPU time and memory allocations of the backend for a number of seconds
+	#  mode: "sample" to sample the stacks of all threads into a collapsed stack file, or "cprofile" to
+	#   write a pstats file of the event loop thread
+	#  trace_memory: also write a tracemalloc snapshot and a summary of the top allocation sites
+	#  returns the paths of the written files, under the profiles folder of the data directory
+	async def profile(self, seconds: float = 30, mode: str = PROFILE_MODE_SAMPLE, trace_memory: bool = True) -> list:
+		if self.profiling_session is not None:
+			raise RuntimeError("A profiling session is already running")
+		session = ProfilingSession(PROFILES_DIR, mode=mode, trace_memory=trace_memory)
+		self.profiling_session = session
+		try:
+			return await session.run(seconds)
+		finally:
+			if self.profiling_session is session:
+				self.profiling_session = None
+	
+	# start or stop recording the raw upower monitor output to a file in the recordings folder of the data directory,
+	# for replaying with monitor_replay.py, which restarts the monitor if it's running
+	#  returns the path of the recording, or None when recording is stopped
+	async def record_monitor(self, enabled: bool = True) -> str:
+		record_path = None
+		if enabled:
+			os.makedirs(RECORDINGS_DIR, exist_ok=True)
+			record_path = RECORDINGS_DIR+"/monitor-"+datetime.datetime.now().strftime("%Y%m%d-%H%M%S")+".txt"
+		# the monitor reads the environment variable when it starts, so this also applies to a monitor created later
+		if record_path is None:
+			os.environ.pop(MONITOR_RECORD_PATH_ENV, None)
+		else:
+			os.environ[MONITOR_RECORD_PATH_ENV] = record_path
+		monitor = self.monitor
+		if monitor is not None:
+			monitor.record_path = record_path
+			if monitor.async_monitor_proc is not None:
+				await monitor.stop_async()
+				await monitor.start_async()
+		logger.info("recording upower monitor output to "+record_path if record_path is not None else "stopped recording upower monitor output")
+		return record_path
+	
+	# durations of the startup phases of the backend, and when it was ready to serve queries and fully started
+	async def get_startup_report(self) -> dict:
+		return startup_report.to_dict()
+	
+	# spans of recent traced requests, as Chrome trace events
+	async def get_trace_events(self) -> list:
+		return tracer.trace_events()
+	
+	# write the spans of recent traced requests to a Chrome trace_event JSON file, which can be opened in
+	# chrome://tracing or https://ui.perfetto.dev, along with any given events from the other end of the pipe
+	#  returns the path of the written file
+	async def dump_traces(self, events: list = None) -> str:
+		all_events = tracer.trace_events()
+		if events is not None:
+			all_events.extend(events)
+		path = TRACES_DIR+"/trace-"+datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")+".json"
+		await asyncio.get_running_loop().run_in_executor(None, write_trace_file, path, all_events)
+		logger.info("wrote traces to "+path)
+		return path
 	
 	
 	async def get_battery_state_logs(self,
@@ -86,6 +289,55 @@ class Plugin:
 		prefer_group_first: bool = True):
 		if self.db is None:
 			logger.error("DB has not been created")
+		logs = await self.db.get_battery_state_logs(**self._parse_battery_state_logs_args(
+			time_start = time_start,
+			time_start_incl = time_start_incl,
+			time_end = time_end,
+			time_end_incl = time_end_incl,
+			group_by_interval_start = group_by_interval_start,
+			group_by_interval = group_by_interval,
+			prefer_group_first = prefer_group_first))
+		logs_arr = list()
+		for log in logs:
+			logs_arr.append(log.to_dict())
+		return logs_arr
+	
+	# same as get_battery_state_logs, but streams the logs in chunks as they're read from the DB
+	async def stream_battery_state_logs(self,
+		time_start: str = None,
+		time_start_incl: bool = True,
+		time_end: str = None,
+		time_end_incl: bool = False,
+		group_by_interval_start: str = None,
+		group_by_interval: int = None,
+		prefer_group_first: bool = True,
+		chunk_size: int = 1000):
+		if self.db is None:
+			logger.error("DB has not been created")
+		logs_iter = self.db.iter_battery_state_logs(chunk_size=chunk_size, **self._parse_battery_state_logs_args(
+			time_start = time_start,
+			time_start_incl = time_start_incl,
+			time_end = time_end,
+			time_end_incl = time_end_incl,
+			group_by_interval_start = group_by_interval_start,
+			group_by_interval = group_by_interval,
+			prefer_group_first = prefer_group_first))
+		try:
+			async for logs in logs_iter:
+				with tracer.span("plugin.convert_chunk", {"logs": len(logs)}):
+					logs_arr = [log.to_dict() for log in logs]
+				yield logs_arr
+		finally:
+			await logs_iter.aclose()
+	
+	def _parse_battery_state_logs_args(self,
+		time_start: str = None,
+		time_start_incl: bool = True,
+		time_end: str = None,
+		time_end_incl: bool = False,
+		group_by_interval_start: str = None,
+		group_by_interval: int = None,
+		prefer_group_first: bool = True) -> dict:
 		if time_start is not None:
 			time_start: datetime.datetime = datetime_from_isoformat(time_start)
 		if time_end is not None:
@@ -98,17 +350,14 @@ class Plugin:
 				utcnow = datetime.datetime.utcnow()
 				group_by_interval_start = datetime.datetime(year=utcnow.year, month=utcnow.month, day=utcnow.day, tzinfo=utcnow.tzinfo)
 			group_by_interval: Tuple[datetime.datetime, datetime.timedelta] = (group_by_interval_start, datetime.timedelta(seconds=group_by_interval))
-		logs = await self.db.get_battery_state_logs(
-			time_start = time_start,
-			time_start_incl = time_start_incl,
-			time_end = time_end,
-			time_end_incl = time_end_incl,
-			group_by_interval = group_by_interval,
-			prefer_group_first = prefer_group_first)
-		logs_arr = list()
-		for log in logs:
-			logs_arr.append(log.to_dict())
-		return logs_arr
+		return {
+			"time_start": time_start,
+			"time_start_incl": time_start_incl,
+			"time_end": time_end,
+			"time_end_incl": time_end_incl,
+			"group_by_interval": group_by_interval,
+			"prefer_group_first": prefer_group_first
+		}
 	
 	async def get_system_event_logs(self,
 		time_start: str = None,
@@ -134,17 +383,96 @@ class Plugin:
 
 	
 	def _task_threadsafe(self, loop: asyncio.AbstractEventLoop, callable: Callable):
+		if self._is_on_loop(loop):
+			return loop.create_task(try_logexcept_awaitable(callable()))
 		return loop.call_soon_threadsafe(lambda:loop.create_task(try_logexcept_awaitable(callable())))
 	
+	def _is_on_loop(self, loop: asyncio.AbstractEventLoop) -> bool:
+		try:
+			return asyncio.get_running_loop() is loop
+		except RuntimeError:
+			return False
 	
 	
-	def _when_device_updated(self, logtime: datetime.datetime, device_path: str, device_info: UPowerDeviceInfo):
+	
+	def _when_device_updated(self, logtime: datetime.datetime, device_path: str, device_info: UPowerDeviceInfo, changes: BatteryChanges):
 		loop = self.loop
 		if loop is None:
 			logger.error("called _when_device_updated, but no event loop available to queue action to")
 			return
-		loop.call_soon_threadsafe(lambda:logger.debug("power device {0} was updated at {1}".format(device_path, logtime.isoformat())))
-		self._task_threadsafe(loop, lambda:self.db.log_device_info(logtime, device_path, device_info))
+		sampler = self.sampler
+		if sampler is not None:
+			sampler.observe(device_path, device_info)
+			if not sampler.should_record(device_path, changes):
+				return None
+		if self._is_on_loop(loop):
+			# return the task so the monitor can wait for the write before dispatching more events
+			logger.debug("power device %s was updated at %s", device_path, logtime)
+			return loop.create_task(try_logexcept_awaitable(self._log_device_info(logtime, device_path, device_info, changes)))
+		logger.debug("power device %s was updated at %s", device_path, logtime)
+		self._task_threadsafe(loop, lambda:self._log_device_info(logtime, device_path, device_info, changes))
+	
+	async def _log_device_info(self, logtime: datetime.datetime, device_path: str, device_info: UPowerDeviceInfo, changes: BatteryChanges):
+		compressor = self.ingest_compressor
+		if compressor is None or device_info.get_device_type() != 'battery':
+			await self.db.log_device_info(logtime, device_path, device_info, changes)
+			return
+		batt_log = BatteryStateLog.from_device_info(logtime, device_path, device_info)
+		# the compressor already dropped the logs that aren't needed, and the DB must not drop a kept log that
+		#  repeats the previous one, since it ends a segment
+		for kept_log in compressor.add(batt_log):
+			await self.db.add_battery_state_log(kept_log)
+	
+	# log every battery with its current values each LOG_HEARTBEAT_INTERVAL seconds
+	async def _log_heartbeats(self):
+		while True:
+			await asyncio.sleep(LOG_HEARTBEAT_INTERVAL)
+			monitor = self.monitor
+			if monitor is None:
+				continue
+			utcnow = datetime.datetime.utcnow()
+			for (device_path, device_info) in list(monitor.device_infos.items()):
+				if device_info.get_device_type() != 'battery':
+					continue
+				try:
+					await self._log_device_info(utcnow, device_path, device_info, BatteryChanges.NONE)
+				except Exception as error:
+					logger.error("Error while logging heartbeat for "+device_path+":\n"+str(error))
+	
+	async def _flush_ingest_compressor(self):
+		compressor = self.ingest_compressor
+		if compressor is None:
+			return
+		for kept_log in compressor.flush():
+			await self.db.add_battery_state_log(kept_log)
+		logger.info("ingest compressor kept %d of %d battery logs (ratio %.2f)",
+			compressor.kept_count, compressor.received_count, compressor.compression_ratio)
+	
+	def _when_log_written(self, tablename: str, logtime: datetime.datetime):
+		if self.on_data_changed is None:
+			return
+		# naive times are local times, like they are when logs are written to the DB
+		logtime = logtime.astimezone(datetime.timezone.utc)
+		if self._changed_time_ranges is None:
+			self._changed_time_ranges = dict()
+			asyncio.get_running_loop().call_soon(self._notify_data_changed)
+		time_range = self._changed_time_ranges.get(tablename, None)
+		if time_range is None:
+			self._changed_time_ranges[tablename] = [logtime, logtime]
+		else:
+			time_range[0] = min(time_range[0], logtime)
+			time_range[1] = max(time_range[1], logtime)
+	
+	def _notify_data_changed(self):
+		changed_time_ranges = self._changed_time_ranges
+		self._changed_time_ranges = None
+		on_data_changed = self.on_data_changed
+		if on_data_changed is None or changed_time_ranges is None:
+			return
+		try:
+			on_data_changed({tablename: [since.isoformat(), until.isoformat()] for (tablename, (since, until)) in changed_time_ranges.items()})
+		except BaseException as error:
+			logger.exception(error)
 	
 	def _when_system_suspended(self):
 		now = datetime.datetime.utcnow()
@@ -152,7 +480,7 @@ class Plugin:
 		if loop is None:
 			logger.error("called _when_system_suspended, but no event loop available to queue action to")
 			return
-		loop.call_soon_threadsafe(lambda:logger.info("system was suspended at {1}".format(now.isoformat())))
+		logger.info("system was suspended at %s", now)
 		self._task_threadsafe(loop, lambda:self.db.add_system_event_log(SystemEventLog(now, SystemEventTypes.SUSPEND)))
 
 	def _when_system_resumed(self):
@@ -161,7 +489,7 @@ class Plugin:
 		if loop is None:
 			logger.error("called _when_system_resumed, but no event loop available to queue action to")
 			return
-		loop.call_soon_threadsafe(lambda:logger.info("system was resumed at {1}".format(now.isoformat())))
+		logger.info("system was resumed at %s", now)
 		self._task_threadsafe(loop, lambda:self.db.add_system_event_log(SystemEventLog(now, SystemEventTypes.RESUME)))
 	
 	def _when_system_shutdown(self):
@@ -170,5 +498,5 @@ class Plugin:
 		if loop is None:
 			logger.error("called _when_system_resumed, but no event loop available to queue action to")
 			return
-		loop.call_soon_threadsafe(lambda:logger.info("system was shutdown at {1}".format(now.isoformat())))
+		logger.info("system was shutdown at %s", now)
 		self._task_threadsafe(loop, lambda:self.db.add_system_event_log(SystemEventLog(now, SystemEventTypes.SHUTDOWN)))
@@ -1,14 +1,15 @@
-from typing import List, Iterable, Tuple, Callable
+from typing import List, Iterable, Tuple, Callable, Dict, AsyncIterator
 from dataclasses import dataclass
 import os
-import asyncio
-import threading
 import datetime
 import logging
 import sqlite3
+import time
 
-from upower_monitor import UPowerDeviceInfo
-from utils import AsyncValue
+from upower_monitor import UPowerDeviceInfo, BatteryChanges
+from utils import SerialThreadExecutor
+from backend_stats import backend_stats
+from tracing import tracer, current_trace_id
 
 logger = logging.getLogger()
 
@@ -117,6 +118,25 @@ class BatteryStateLog:
 			percent_current = percent_current,
 			percent_capacity = percent_capacity)
 	
+	# the logged values of this state, excluding the log time
+	def values_tuple(self) -> tuple:
+		return (
+			self.device_path,
+			self.state,
+			self.energy_Wh,
+			self.energy_empty_Wh,
+			self.energy_full_Wh,
+			self.energy_full_design_Wh,
+			self.energy_rate_W,
+			self.voltage_V,
+			self.seconds_till_full,
+			self.seconds_till_empty,
+			self.percent_current,
+			self.percent_capacity)
+	
+	def has_same_values(self, other: 'BatteryStateLog') -> bool:
+		return self.values_tuple() == other.values_tuple()
+	
 	def to_dbtuple(self) -> tuple:
 		return (
 			self.device_path,
@@ -224,12 +244,24 @@ SystemEventTypes: _SystemEventTypes = _SystemEventTypes()
 
 
 class PowerHistoryDB:
-	db_loop: asyncio.AbstractEventLoop = None
+	# runs the DB operations on a single thread, which is the only thread that uses the connection
+	_executor: SerialThreadExecutor = None
 	connection: sqlite3.Connection = None
 	cursor: sqlite3.Cursor = None
+	# skip battery logs whose values match the previous log for the device
+	skip_unchanged_logs: bool = True
+	# an unchanged battery log is still written if the previous log is older than this
+	unchanged_log_interval: datetime.timedelta = datetime.timedelta(minutes=10)
+	skipped_log_count: int = 0
+	# DB operations that were submitted and haven't finished
+	pending_op_count: int = 0
+	# called on the event loop after a log is written, with the name of its table and its time
+	on_log_written: Callable[[str,datetime.datetime],None] = None
+	_last_battery_logs: Dict[str,BatteryStateLog]
 
 	def __init__(self, dir: str):
 		self.dir = dir
+		self._last_battery_logs = dict()
 	
 	def _setup_db(self):
 		self._commit_sql(BatteryStateLog.get_sql_createtable(), parameters=[])
@@ -237,17 +269,34 @@ class PowerHistoryDB:
 		for sql_mig in BatteryStateLog.get_sql_migrations(column_names=self._get_column_names(BatteryStateLog.get_sql_tablename())):
 			self._commit_sql(sql_mig)
 	
-	def _prepare_db_loop(self):
-		if self.db_loop is not None:
+	def _prepare_executor(self):
+		if self._executor is not None:
 			return
-		db_loop = asyncio.new_event_loop()
-		loop_thread = threading.Thread(target=db_loop.run_forever)
-		self.db_loop = db_loop
-		loop_thread.start()
+		self._executor = SerialThreadExecutor("power-history-db")
 	
-	async def _db_loop_op(self, callable: Callable):
-		self._prepare_db_loop()
-		return await AsyncValue.run_on_loop(self.db_loop, callable)
+	# run a DB operation on the DB thread
+	async def _db_op(self, callable: Callable):
+		self._prepare_executor()
+		submit_time = time.perf_counter()
+		# the DB thread doesn't get the context of the calling task, so the trace is passed along explicitly
+		trace_id = current_trace_id.get()
+		def timed_callable():
+			# time spent waiting behind other DB operations, then running this one
+			start_time = time.perf_counter()
+			backend_stats.record("db.queue_wait", start_time - submit_time)
+			try:
+				return callable()
+			finally:
+				end_time = time.perf_counter()
+				backend_stats.record("db.exec", end_time - start_time)
+				if trace_id is not None:
+					tracer.record_span("db.queue_wait", trace_id, submit_time, start_time)
+					tracer.record_span("db.exec", trace_id, start_time, end_time)
+		self.pending_op_count += 1
+		try:
+			return await self._executor.run(timed_callable)
+		finally:
+			self.pending_op_count -= 1
 	
 	def _fetch_sql(self, sql: str, parameters: list) -> list:
 		connection = self.connection
@@ -259,6 +308,19 @@ class PowerHistoryDB:
 		cursor.execute(sql, parameters)
 		return cursor.fetchall()
 	
+	# open a separate cursor for a query whose rows are fetched in chunks, so other queries can run in between
+	def _open_sql_cursor(self, sql: str, parameters: list) -> sqlite3.Cursor:
+		connection = self.connection
+		if connection is None:
+			raise RuntimeError("No connection available to run query")
+		cursor = connection.cursor()
+		try:
+			cursor.execute(sql, parameters)
+		except:
+			cursor.close()
+			raise
+		return cursor
+	
 	def _commit_sql(self, sql: str, parameters: list = None):
 		connection = self.connection
 		cursor = self.cursor
@@ -281,10 +343,25 @@ class PowerHistoryDB:
 		cursor.fetchall()
 		return column_names
 	
+	def _when_log_written(self, tablename: str, logtime: datetime.datetime):
+		on_log_written = self.on_log_written
+		if on_log_written is None:
+			return
+		try:
+			on_log_written(tablename, logtime)
+		except BaseException as error:
+			logger.exception(error)
+	
 
 
+	def stats(self) -> dict:
+		return {
+			"pending_ops": self.pending_op_count,
+			"skipped_logs": self.skipped_log_count
+		}
+	
 	async def connect(self):
-		return await self._db_loop_op(self._connect)
+		return await self._db_op(self._connect)
 	def _connect(self):
 		# connect to DB
 		if self.connection is None:
@@ -300,11 +377,14 @@ class PowerHistoryDB:
 		self._setup_db()
 	
 	async def close(self):
-		if self.db_loop is None:
+		executor = self._executor
+		if executor is None:
 			return
-		await self._db_loop_op(self._close)
-		self.db_loop.close()
-		self.db_loop = None
+		await self._db_op(self._close)
+		if self._executor is executor:
+			self._executor = None
+		# the thread is idle once the last operation has finished, so it exits without being waited for
+		executor.shutdown()
 	def _close(self):
 		# close cursor
 		if self.cursor is not None:
@@ -314,9 +394,6 @@ class PowerHistoryDB:
 		if self.connection is not None:
 			self.connection.close()
 			self.connection = None
-		# close loop
-		if self.db_loop is not None:
-			self.db_loop.stop()
 	
 	def _param_string(self, arg_count: int):
 		args=[]
@@ -326,16 +403,54 @@ class PowerHistoryDB:
 	
 
 	
-	async def log_device_info(self, logtime_utc: datetime.datetime, device_path: str, device_info: UPowerDeviceInfo):
+	async def log_device_info(self, logtime_utc: datetime.datetime, device_path: str, device_info: UPowerDeviceInfo, changes: BatteryChanges = BatteryChanges.ALL):
 		device_type = device_info.get_device_type()
 		if device_type == 'battery':
+			if self.skip_unchanged_logs and (changes & BatteryChanges.BATTERY) == BatteryChanges.NONE \
+				and self._is_recently_logged(device_path, logtime_utc):
+				# none of the logged fields changed, so avoid building the log
+				self.skipped_log_count += 1
+				return
 			batt_log = BatteryStateLog.from_device_info(logtime_utc, device_path, device_info)
-			await self.add_battery_state_log(batt_log)
+			await self.log_battery_state(batt_log)
 		else:
 			logger.error("Unknown device type for "+device_path+" (info = "+str(device_info.info)+")")
 	
+	async def log_battery_state(self, batt_state_log: BatteryStateLog):
+		if self.skip_unchanged_logs and self._is_unchanged_log(batt_state_log):
+			self.skipped_log_count += 1
+			return
+		# remember the log before awaiting the insert, so an identical log that arrives during the insert is skipped
+		device_path = batt_state_log.device_path
+		prev_log = self._last_battery_logs.get(device_path, None)
+		self._last_battery_logs[device_path] = batt_state_log
+		try:
+			await self.add_battery_state_log(batt_state_log)
+		except BaseException:
+			# only a written log lets the next identical logs be skipped
+			if self._last_battery_logs.get(device_path, None) is batt_state_log:
+				if prev_log is None:
+					self._last_battery_logs.pop(device_path)
+				else:
+					self._last_battery_logs[device_path] = prev_log
+			raise
+	
+	def _is_recently_logged(self, device_path: str, logtime_utc: datetime.datetime) -> bool:
+		last_log = self._last_battery_logs.get(device_path, None)
+		if last_log is None:
+			return False
+		return (logtime_utc.astimezone(tzinfo_utc) - last_log.time.astimezone(tzinfo_utc)) < self.unchanged_log_interval
+	
+	def _is_unchanged_log(self, batt_state_log: BatteryStateLog) -> bool:
+		last_log = self._last_battery_logs.get(batt_state_log.device_path, None)
+		if last_log is None or not last_log.has_same_values(batt_state_log):
+			return False
+		return self._is_recently_logged(batt_state_log.device_path, batt_state_log.time)
+	
 	async def add_battery_state_log(self, batt_state_log: BatteryStateLog) -> list:
-		return await self._db_loop_op(lambda:self._add_battery_state_log(batt_state_log))
+		result = await self._db_op(lambda:self._add_battery_state_log(batt_state_log))
+		self._when_log_written(BatteryStateLog.get_sql_tablename(), batt_state_log.time)
+		return result
 	def _add_battery_state_log(self, batt_state_log: BatteryStateLog) -> list:
 		tblname = BatteryStateLog.get_sql_tablename()
 		data = batt_state_log.to_dbtuple()
@@ -350,7 +465,7 @@ class PowerHistoryDB:
 		time_end_incl: bool = False,
 		group_by_interval: Tuple[datetime.datetime, datetime.timedelta] = None,
 		prefer_group_first: bool = True) -> List[BatteryStateLog]:
-		return await self._db_loop_op(lambda:self._get_battery_state_logs(
+		return await self._db_op(lambda:self._get_battery_state_logs(
 			time_start = time_start,
 			time_start_incl = time_start_incl,
 			time_end = time_end,
@@ -364,6 +479,57 @@ class PowerHistoryDB:
 		time_end_incl: bool = False,
 		group_by_interval: Tuple[datetime.datetime, datetime.timedelta] = None,
 		prefer_group_first: bool = True) -> List[BatteryStateLog]:
+		(sql, params) = self._battery_state_logs_query(
+			time_start = time_start,
+			time_start_incl = time_start_incl,
+			time_end = time_end,
+			time_end_incl = time_end_incl,
+			group_by_interval = group_by_interval,
+			prefer_group_first = prefer_group_first)
+		records = self._fetch_sql(sql, params)
+		batt_state_logs = []
+		for record in records:
+			batt_state_logs.append(BatteryStateLog.from_dbtuple(record))
+		return batt_state_logs
+	
+	# get battery state logs in chunks of up to chunk_size logs, without loading every matching log at once
+	async def iter_battery_state_logs(self,
+		time_start: datetime.datetime = None,
+		time_start_incl: bool = True,
+		time_end: datetime.datetime = None,
+		time_end_incl: bool = False,
+		group_by_interval: Tuple[datetime.datetime, datetime.timedelta] = None,
+		prefer_group_first: bool = True,
+		chunk_size: int = 1000) -> AsyncIterator[List[BatteryStateLog]]:
+		(sql, params) = self._battery_state_logs_query(
+			time_start = time_start,
+			time_start_incl = time_start_incl,
+			time_end = time_end,
+			time_end_incl = time_end_incl,
+			group_by_interval = group_by_interval,
+			prefer_group_first = prefer_group_first)
+		cursor = await self._db_op(lambda:self._open_sql_cursor(sql, params))
+		try:
+			while True:
+				batt_state_logs = await self._db_op(lambda:self._fetch_battery_state_logs_chunk(cursor, chunk_size))
+				if len(batt_state_logs) == 0:
+					break
+				yield batt_state_logs
+		finally:
+			await self._db_op(cursor.close)
+	def _fetch_battery_state_logs_chunk(self, cursor: sqlite3.Cursor, chunk_size: int) -> List[BatteryStateLog]:
+		batt_state_logs = []
+		for record in cursor.fetchmany(chunk_size):
+			batt_state_logs.append(BatteryStateLog.from_dbtuple(record))
+		return batt_state_logs
+	
+	def _battery_state_logs_query(self,
+		time_start: datetime.datetime = None,
+		time_start_incl: bool = True,
+		time_end: datetime.datetime = None,
+		time_end_incl: bool = False,
+		group_by_interval: Tuple[datetime.datetime, datetime.timedelta] = None,
+		prefer_group_first: bool = True) -> Tuple[str, list]:
 		tblname = BatteryStateLog.get_sql_tablename()
 		params = []
 		sql = 'SELECT *'
@@ -402,14 +568,12 @@ class PowerHistoryDB:
 				sql += 'MAX(time)'
 		sql += ' ORDER BY time'
 		#logger.debug("executing sql:\n"+sql+"\nparams: "+str(params))
-		records = self._fetch_sql(sql, params)
-		batt_state_logs = []
-		for record in records:
-			batt_state_logs.append(BatteryStateLog.from_dbtuple(record))
-		return batt_state_logs
+		return (sql, params)
 	
 	async def add_system_event_log(self, system_evt_log: SystemEventLog) -> list:
-		return await self._db_loop_op(lambda:self._add_system_event_log(system_evt_log))
+		result = await self._db_op(lambda:self._add_system_event_log(system_evt_log))
+		self._when_log_written(SystemEventLog.get_sql_tablename(), system_evt_log.time)
+		return result
 	def _add_system_event_log(self, system_evt_log: SystemEventLog) -> list:
 		tblname = SystemEventLog.get_sql_tablename()
 		data = system_evt_log.to_dbtuple()
@@ -421,7 +585,7 @@ class PowerHistoryDB:
 		time_start_incl: bool = True,
 		time_end: datetime.datetime = None,
 		time_end_incl: bool = False) -> List[SystemEventLog]:
-		return await self._db_loop_op(lambda:self._get_system_event_logs(
+		return await self._db_op(lambda:self._get_system_event_logs(
 			time_start = time_start,
 			time_start_incl = time_start_incl,
 			time_end = time_end,
@@ -0,0 +1,158 @@
+from typing import Dict, List
+import os
+import sys
+import time
+import asyncio
+import cProfile
+import datetime
+import threading
+import tracemalloc
+import collections
+import logging
+
+logger = logging.getLogger()
+
+PROFILE_MODE_CPROFILE = 'cprofile'
+PROFILE_MODE_SAMPLE = 'sample'
+PROFILE_MODES = [PROFILE_MODE_CPROFILE, PROFILE_MODE_SAMPLE]
+
+
+
+# Stack sampler
+#  Records the stack of every thread at a fixed interval from a separate thread, and counts each distinct stack.
+#  The counts are written in the collapsed stack format ("thread;outer;...;inner count" per line), which
+#  flamegraph.pl and speedscope can read. Unlike cProfile, this sees every thread, including the DB and
+#  monitor reader threads, and costs nothing between samples.
+
+class StackSampler:
+	interval: float = 0.005
+	sample_count: int = 0
+	_stacks: Dict[str,int]
+	_thread: threading.Thread = None
+	_stop_evt: threading.Event = None
+
+	def __init__(self, interval: float = None):
+		if interval is not None:
+			self.interval = interval
+		self._stacks = collections.defaultdict(int)
+
+	def start(self):
+		if self._thread is not None:
+			return
+		self._stop_evt = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		thread = self._thread
+		if thread is None:
+			return
+		self._stop_evt.set()
+		thread.join()
+		self._thread = None
+
+	def write_collapsed(self, path: str):
+		with open(path, 'w') as out_file:
+			for (stack, count) in sorted(self._stacks.items(), key=lambda item: item[1], reverse=True):
+				out_file.write("{} {}\n".format(stack, count))
+
+	def _run(self):
+		own_thread_id = threading.get_ident()
+		stop_evt = self._stop_evt
+		while not stop_evt.wait(self.interval):
+			thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+			for (thread_id, frame) in sys._current_frames().items():
+				if thread_id == own_thread_id:
+					continue
+				self._stacks[self._collapse_stack(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+			self.sample_count += 1
+
+	def _collapse_stack(self, thread_name: str, frame) -> str:
+		names = list()
+		while frame is not None:
+			code = frame.f_code
+			names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+			frame = frame.f_back
+		names.append(thread_name)
+		names.reverse()
+		return ";".join(names)
+
+
+
+# Profiling session
+#  Profiles the process for a number of seconds with cProfile (event loop thread only, exact call counts) or the
+#  stack sampler (all threads), optionally tracing memory allocations, and writes the results into a directory:
+#  {name}.pstats or {name}.collapsed for CPU time, and {name}.tracemalloc plus a {name}-memory.txt summary.
+
+class ProfilingSession:
+	dir: str
+	mode: str
+	trace_memory: bool
+	# number of allocation sites listed in the memory summary
+	memory_top_count: int = 50
+	_started_tracemalloc: bool = False
+
+	def __init__(self, dir: str, mode: str = PROFILE_MODE_SAMPLE, trace_memory: bool = True):
+		if mode not in PROFILE_MODES:
+			raise ValueError("Unknown profile mode "+str(mode))
+		self.dir = dir
+		self.mode = mode
+		self.trace_memory = trace_memory
+
+	# profile for the given number of seconds, returning the paths of the written files
+	async def run(self, seconds: float) -> List[str]:
+		os.makedirs(self.dir, exist_ok=True)
+		name = "profile-"+datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+		loop = asyncio.get_running_loop()
+		if self.trace_memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self._started_tracemalloc = True
+		profile = None
+		sampler = None
+		try:
+			# cProfile only sees the thread it was enabled on, which is the event loop thread here
+			if self.mode == PROFILE_MODE_CPROFILE:
+				profile = cProfile.Profile()
+				profile.enable()
+			else:
+				sampler = StackSampler()
+				sampler.start()
+			start_time = time.monotonic()
+			try:
+				await asyncio.sleep(seconds)
+			finally:
+				if profile is not None:
+					profile.disable()
+				if sampler is not None:
+					await loop.run_in_executor(None, sampler.stop)
+			elapsed = time.monotonic() - start_time
+			snapshot = tracemalloc.take_snapshot() if self.trace_memory else None
+		finally:
+			if self._started_tracemalloc:
+				tracemalloc.stop()
+				self._started_tracemalloc = False
+		# write results off the event loop
+		paths = await loop.run_in_executor(None, self._write_results, name, profile, sampler, snapshot)
+		logger.info("profiled for {:.1f} seconds, wrote {}".format(elapsed, ", ".join(paths)))
+		return paths
+
+	def _write_results(self, name: str, profile: cProfile.Profile, sampler: StackSampler, snapshot: tracemalloc.Snapshot) -> List[str]:
+		paths = list()
+		base_path = os.path.join(self.dir, name)
+		if profile is not None:
+			profile.dump_stats(base_path+".pstats")
+			paths.append(base_path+".pstats")
+		if sampler is not None:
+			sampler.write_collapsed(base_path+".collapsed")
+			paths.append(base_path+".collapsed")
+		if snapshot is not None:
+			snapshot.dump(base_path+".tracemalloc")
+			paths.append(base_path+".tracemalloc")
+			top_stats = snapshot.statistics('lineno')
+			with open(base_path+"-memory.txt", 'w') as out_file:
+				total_size = sum(stat.size for stat in top_stats)
+				out_file.write("total traced: {:.1f} KiB in {} allocation sites\n".format(total_size / 1024, len(top_stats)))
+				for stat in top_stats[:self.memory_top_count]:
+					out_file.write(str(stat)+"\n")
+			paths.append(base_path+"-memory.txt")
+		return paths
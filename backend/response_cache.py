@@ -0,0 +1,206 @@
+from typing import Any, Awaitable, Callable, Dict, Optional
+import json
+import math
+import time
+import asyncio
+import datetime
+import collections
+import logging
+
+logger = logging.getLogger()
+
+# seconds a cached response is used for
+RESPONSE_CACHE_TTL = 30.0
+# number of responses kept, after which the least recently used response is dropped
+RESPONSE_CACHE_MAX_ENTRIES = 32
+# seconds that the times of queries are rounded to, so queries for the last hour made a few seconds apart share a result
+RESPONSE_CACHE_TIME_BUCKET = 30.0
+# query arguments that are rounded down to the start of their bucket
+CACHE_START_TIME_ARGS = ("time_start", "group_by_interval_start")
+# query arguments that are rounded up to the end of their bucket
+CACHE_END_TIME_ARGS = ("time_end",)
+
+# parse a time of a query or a change notification, or return None if it isn't given or can't be parsed
+def parse_cache_time(value: Any) -> Optional[datetime.datetime]:
+	if not isinstance(value, str):
+		return None
+	try:
+		parsed = datetime.datetime.fromisoformat(value)
+	except ValueError:
+		return None
+	# naive times are local times, like they are when logs are written to the DB
+	return parsed.astimezone(datetime.timezone.utc)
+
+# round an ISO 8601 time down (or up) to a multiple of a number of seconds, keeping values that aren't times as they are
+def round_cache_time(value: Any, bucket_seconds: float, round_up: bool = False) -> Any:
+	parsed = parse_cache_time(value)
+	if parsed is None:
+		return value
+	rounding = math.ceil if round_up else math.floor
+	timestamp = rounding(parsed.timestamp() / bucket_seconds) * bucket_seconds
+	return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+# whether the time range of a query overlaps a range of changed data, with None for an open end
+def time_ranges_overlap(time_start: datetime.datetime, time_end: datetime.datetime, changed_since: datetime.datetime, changed_until: datetime.datetime) -> bool:
+	if time_end is not None and changed_since is not None and changed_since > time_end:
+		return False
+	if time_start is not None and changed_until is not None and changed_until < time_start:
+		return False
+	return True
+
+
+
+class _CacheEntry:
+	__slots__ = ('data', 'expire_time', 'table_name', 'time_start', 'time_end')
+
+	def __init__(self, data: Any, expire_time: float, table_name: str, time_start: datetime.datetime, time_end: datetime.datetime):
+		self.data = data
+		self.expire_time = expire_time
+		self.table_name = table_name
+		self.time_start = time_start
+		self.time_end = time_end
+
+# a fetch that callers with the same key wait for
+class _CacheFlight:
+	__slots__ = ('task', 'table_name', 'time_start', 'time_end', 'invalidated')
+
+	def __init__(self, table_name: str, time_start: datetime.datetime, time_end: datetime.datetime):
+		self.task = None
+		self.table_name = table_name
+		self.time_start = time_start
+		self.time_end = time_end
+		# set when data the fetch reads changed while it was running, so its result isn't cached
+		self.invalidated = False
+
+
+
+# Response cache
+#  Keeps the results of recent queries for a number of seconds, keyed on the method name and its arguments, and
+#  dropping the least recently used results once it's full. Callers asking for a result that's already being fetched
+#  wait for the same fetch. The time arguments of queries are rounded to a bucket of seconds, so queries relative
+#  to the current time share a result until the next bucket starts. Results are dropped early when the data of their
+#  table changes within the time range given by their time_start and time_end arguments, where a query without a
+#  time_end covers the times until it was fetched. Logs written after a fetch are newer than anything the query
+#  read, so they're only returned once the result expires or the next bucket starts. Cached results are shared
+#  between callers, so they must not be modified.
+
+class ResponseCache:
+	ttl: float = RESPONSE_CACHE_TTL
+	max_entries: int = RESPONSE_CACHE_MAX_ENTRIES
+	time_bucket: float = RESPONSE_CACHE_TIME_BUCKET
+	hit_count: int = 0
+	miss_count: int = 0
+	# callers that waited for a fetch started by another caller
+	shared_count: int = 0
+	invalidated_count: int = 0
+	expired_count: int = 0
+	evicted_count: int = 0
+	_entries: 'collections.OrderedDict[str,_CacheEntry]'
+	_flights: Dict[str,_CacheFlight]
+
+	def __init__(self, ttl: float = None, max_entries: int = None, time_bucket: float = None):
+		if ttl is not None:
+			self.ttl = ttl
+		if max_entries is not None:
+			self.max_entries = max_entries
+		if time_bucket is not None:
+			self.time_bucket = time_bucket
+		self._entries = collections.OrderedDict()
+		self._flights = dict()
+
+	# get the arguments of a call with its times rounded to the time bucket, which the call should be fetched with
+	def round_time_args(self, args: dict) -> dict:
+		if not args:
+			return args
+		rounded_args = dict(args)
+		for name in CACHE_START_TIME_ARGS:
+			if name in rounded_args:
+				rounded_args[name] = round_cache_time(rounded_args[name], self.time_bucket)
+		for name in CACHE_END_TIME_ARGS:
+			if name in rounded_args:
+				rounded_args[name] = round_cache_time(rounded_args[name], self.time_bucket, round_up=True)
+		return rounded_args
+
+	# get the cache key of a call, which ignores the order of the arguments and arguments that are None
+	@staticmethod
+	def make_key(method_name: str, args: dict) -> str:
+		normalized_args = {name: value for (name, value) in (args or dict()).items() if value is not None}
+		return method_name+":"+json.dumps(normalized_args, sort_keys=True, separators=(',', ':'), default=str)
+
+	# get the cached result of a call, or fetch it if it isn't cached
+	#  The fetch should use the arguments from round_time_args.
+	#  table_name: the table the result is read from, so changes to it drop the result
+	async def get(self, method_name: str, args: dict, fetch: Callable[[],Awaitable[Any]], table_name: str = None) -> Any:
+		args = self.round_time_args(args)
+		key = self.make_key(method_name, args)
+		entry = self._entries.get(key, None)
+		if entry is not None:
+			if entry.expire_time > time.monotonic():
+				self._entries.move_to_end(key)
+				self.hit_count += 1
+				return entry.data
+			self._entries.pop(key)
+			self.expired_count += 1
+		flight = self._flights.get(key, None)
+		if flight is not None:
+			self.shared_count += 1
+		else:
+			self.miss_count += 1
+			time_end = parse_cache_time((args or dict()).get("time_end", None))
+			if time_end is None:
+				time_end = datetime.datetime.now(datetime.timezone.utc)
+			flight = _CacheFlight(
+				table_name = table_name,
+				time_start = parse_cache_time((args or dict()).get("time_start", None)),
+				time_end = time_end)
+			flight.task = asyncio.create_task(self._fetch(key, flight, fetch))
+			self._flights[key] = flight
+		# a caller that stops waiting doesn't cancel the fetch for the other callers
+		return await asyncio.shield(flight.task)
+
+	# drop the results read from a table within a range of changed times, with None for an open end
+	def invalidate(self, table_name: str, changed_since: datetime.datetime = None, changed_until: datetime.datetime = None):
+		for (key, entry) in list(self._entries.items()):
+			if entry.table_name == table_name and time_ranges_overlap(entry.time_start, entry.time_end, changed_since, changed_until):
+				self._entries.pop(key)
+				self.invalidated_count += 1
+		for flight in self._flights.values():
+			if flight.table_name == table_name and time_ranges_overlap(flight.time_start, flight.time_end, changed_since, changed_until):
+				flight.invalidated = True
+
+	# drop all results, including the results of fetches that are still running
+	def clear(self):
+		self._entries.clear()
+		for flight in self._flights.values():
+			flight.invalidated = True
+
+	def stats(self) -> dict:
+		return {
+			"entries": len(self._entries),
+			"fetching": len(self._flights),
+			"hits": self.hit_count,
+			"misses": self.miss_count,
+			"shared": self.shared_count,
+			"invalidated": self.invalidated_count,
+			"expired": self.expired_count,
+			"evicted": self.evicted_count
+		}
+
+	async def _fetch(self, key: str, flight: _CacheFlight, fetch: Callable[[],Awaitable[Any]]) -> Any:
+		try:
+			data = await fetch()
+			if not flight.invalidated:
+				self._entries[key] = _CacheEntry(
+					data = data,
+					expire_time = time.monotonic() + self.ttl,
+					table_name = flight.table_name,
+					time_start = flight.time_start,
+					time_end = flight.time_end)
+				self._entries.move_to_end(key)
+				while len(self._entries) > self.max_entries:
+					self._entries.popitem(last=False)
+					self.evicted_count += 1
+			return data
+		finally:
+			if self._flights.get(key, None) is flight:
+				self._flights.pop(key)
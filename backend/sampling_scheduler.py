@@ -0,0 +1,307 @@
+from typing import Dict, Optional
+from dataclasses import dataclass
+import os
+import time
+import asyncio
+import inspect
+import datetime
+import logging
+
+from upower_monitor import UPowerMonitor, UPowerDeviceInfo, BatteryChanges
+
+logger = logging.getLogger()
+
+# directory of the kernel's power supplies, named by the native-path of their upower device
+POWER_SUPPLY_DIR = "/sys/class/power_supply"
+
+# upower states for the statuses of the kernel's power supplies
+POWER_SUPPLY_STATES: Dict[str,str] = {
+	"Charging": "charging",
+	"Discharging": "discharging",
+	"Full": "fully-charged",
+	"Not charging": "pending-charge",
+	"Unknown": "unknown"
+}
+
+# read the current values of a battery from its power supply directory, as device info to merge into its upower info
+#  The driver reads the fuel gauge each time the uevent file is read, unlike `upower --show-info`, which returns the
+#  values that upower cached on its last refresh. Charge values are converted to energy with the design voltage,
+#  like upower does. Returns None if the values can't be read.
+def read_power_supply_info(supply_dir: str) -> Optional[UPowerDeviceInfo]:
+	try:
+		with open(supply_dir+"/uevent", "r") as uevent_file:
+			uevent_lines = uevent_file.read().splitlines()
+	except OSError as error:
+		logger.error("Couldn't read power supply "+supply_dir+": "+str(error))
+		return None
+	props = dict()
+	for line in uevent_lines:
+		(key, separator, val) = line.partition("=")
+		if separator and key.startswith("POWER_SUPPLY_"):
+			props[key[len("POWER_SUPPLY_"):]] = val
+	# the kernel reports values in micro units
+	def read_prop(name: str) -> Optional[float]:
+		try:
+			return float(props[name]) / 1000000
+		except (KeyError, ValueError):
+			return None
+	voltage_V = read_prop("VOLTAGE_NOW")
+	voltage_design_V = read_prop("VOLTAGE_MIN_DESIGN") or read_prop("VOLTAGE_MAX_DESIGN") or voltage_V
+	def read_energy_prop(name: str) -> Optional[float]:
+		energy_Wh = read_prop("ENERGY_"+name)
+		if energy_Wh is None and voltage_design_V is not None:
+			charge_Ah = read_prop("CHARGE_"+name)
+			if charge_Ah is not None:
+				energy_Wh = charge_Ah * voltage_design_V
+		return energy_Wh
+	energy_Wh = read_energy_prop("NOW")
+	energy_full_Wh = read_energy_prop("FULL")
+	energy_full_design_Wh = read_energy_prop("FULL_DESIGN")
+	energy_rate_W = read_prop("POWER_NOW")
+	if energy_rate_W is None:
+		current_A = read_prop("CURRENT_NOW")
+		if current_A is not None and voltage_design_V is not None:
+			energy_rate_W = current_A * voltage_design_V
+	batt_info = dict()
+	state = POWER_SUPPLY_STATES.get(props.get("STATUS", None), None)
+	if state is not None:
+		batt_info["state"] = state
+	if energy_Wh is not None:
+		batt_info["energy"] = "{:.3f} Wh".format(energy_Wh)
+	if energy_full_Wh is not None:
+		batt_info["energy-full"] = "{:.3f} Wh".format(energy_full_Wh)
+	if energy_full_design_Wh is not None:
+		batt_info["energy-full-design"] = "{:.3f} Wh".format(energy_full_design_Wh)
+	if energy_rate_W is not None:
+		batt_info["energy-rate"] = "{:.3f} W".format(abs(energy_rate_W))
+	if voltage_V is not None:
+		batt_info["voltage"] = "{:.3f} V".format(voltage_V)
+	if energy_Wh is not None and energy_full_Wh:
+		batt_info["percentage"] = "{:.1f}%".format(min(100.0, energy_Wh / energy_full_Wh * 100))
+	elif "CAPACITY" in props:
+		batt_info["percentage"] = props["CAPACITY"]+"%"
+	if energy_full_Wh is not None and energy_full_design_Wh:
+		batt_info["capacity"] = "{:.1f}%".format(energy_full_Wh / energy_full_design_Wh * 100)
+	if len(batt_info) == 0:
+		return None
+	return UPowerDeviceInfo({"battery": batt_info})
+
+
+
+@dataclass
+class _DeviceSampleState:
+	# monotonic time of the last observed sample
+	last_sample_time: float
+	# monotonic time of the last sample that was recorded
+	last_record_time: float
+	state: str
+	energy_rate_W: float
+	interval: float
+
+
+
+# Adaptive sampling scheduler
+#  Reads the kernel power supplies of battery devices between upower events, sampling quickly when the draw rate
+#  changes fast or the battery is discharging quickly, and backing off while fully charged or stable.
+#  The same interval is used to thin out updates without any changes, and updates with changes are always recorded.
+#  Devices without a power supply directory aren't polled, since upower has nothing fresher than its events.
+
+class AdaptiveSampler:
+	monitor: UPowerMonitor
+	power_supply_dir: str = POWER_SUPPLY_DIR
+	# bounds for the time between samples of a device, in seconds
+	min_interval: float = 5.0
+	max_interval: float = 300.0
+	# multiplier applied to the interval each time a device is found to be stable
+	backoff_factor: float = 2.0
+	# maximum number of polls in an hour, across all devices
+	wakeup_budget_per_hour: int = 240
+	# sample often enough that the draw rate moves by no more than this between samples
+	rate_resolution_W: float = 0.5
+	# sample often enough that no more than this much energy is used between samples
+	energy_resolution_Wh: float = 0.05
+	# draw rates below this are treated as idle
+	idle_rate_W: float = 1.0
+	poll_count: int = 0
+	skipped_record_count: int = 0
+	_devices: Dict[str,_DeviceSampleState]
+	_budget_tokens: float
+	_budget_time: float
+	_task: asyncio.Task = None
+	_reschedule_evt: asyncio.Event = None
+
+	def __init__(self, monitor: UPowerMonitor):
+		self.monitor = monitor
+		self._devices = dict()
+		self._budget_tokens = self.wakeup_budget_per_hour
+		self._budget_time = time.monotonic()
+
+	def start(self):
+		if self._task is not None:
+			logger.warn("called AdaptiveSampler.start when it is already started")
+			return
+		self._reschedule_evt = asyncio.Event()
+		self._task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		task = self._task
+		if task is None:
+			return
+		task.cancel()
+		await asyncio.wait([task])
+		if self._task is task:
+			self._task = None
+
+	def stats(self) -> dict:
+		return {
+			"polls": self.poll_count,
+			"skipped_records": self.skipped_record_count,
+			"intervals": {device_path: device.interval for (device_path, device) in self._devices.items()}
+		}
+
+	# update the sampling interval of a device from a new sample
+	def observe(self, device_path: str, device_info: UPowerDeviceInfo):
+		batt_info = device_info.battery_info
+		if batt_info is None:
+			return
+		now = time.monotonic()
+		state = batt_info.state
+		energy_rate_W = batt_info.energy_rate_W
+		device = self._devices.get(device_path, None)
+		if device is None:
+			self._devices[device_path] = _DeviceSampleState(
+				last_sample_time = now,
+				last_record_time = None,
+				state = state,
+				energy_rate_W = energy_rate_W,
+				interval = self.min_interval)
+			self._wake()
+			return
+		device.interval = self._get_next_interval(device, now, state, energy_rate_W)
+		device.last_sample_time = now
+		device.state = state
+		device.energy_rate_W = energy_rate_W
+		self._wake()
+
+	# check if an observed sample is worth recording
+	#  Samples with any changes are always recorded, so only unchanged samples are thinned out to the interval.
+	def should_record(self, device_path: str, changes: BatteryChanges) -> bool:
+		device = self._devices.get(device_path, None)
+		if device is None:
+			return True
+		now = time.monotonic()
+		if device.last_record_time is None or changes != BatteryChanges.NONE \
+			or (now - device.last_record_time) >= device.interval:
+			device.last_record_time = now
+			return True
+		self.skipped_record_count += 1
+		return False
+
+	def _get_next_interval(self, device: _DeviceSampleState, now: float, state: str, energy_rate_W: float) -> float:
+		if state != device.state:
+			# sample quickly after a state transition
+			return self.min_interval
+		if state == 'fully-charged':
+			return min(self.max_interval, device.interval * self.backoff_factor)
+		candidates = []
+		# sample faster if the draw rate is changing quickly
+		elapsed = now - device.last_sample_time
+		if energy_rate_W is not None and device.energy_rate_W is not None and elapsed > 0:
+			rate_change = abs(energy_rate_W - device.energy_rate_W) / elapsed
+			if rate_change > 0:
+				candidates.append(self.rate_resolution_W / rate_change)
+		# sample faster if the battery is discharging quickly
+		if state == 'discharging' and energy_rate_W is not None and energy_rate_W >= self.idle_rate_W:
+			candidates.append((self.energy_resolution_Wh * 3600) / energy_rate_W)
+		if len(candidates) == 0:
+			# stable, so back off
+			return min(self.max_interval, device.interval * self.backoff_factor)
+		interval = min(candidates)
+		# back off gradually instead of jumping straight to a long interval
+		interval = min(interval, device.interval * self.backoff_factor)
+		return max(self.min_interval, min(self.max_interval, interval))
+
+	def _wake(self):
+		if self._reschedule_evt is not None:
+			self._reschedule_evt.set()
+
+	def _take_budget_token(self) -> float:
+		# refill tokens for the time since the last poll, returning the delay until a token is available
+		now = time.monotonic()
+		refill_rate = self.wakeup_budget_per_hour / 3600
+		self._budget_tokens = min(self.wakeup_budget_per_hour, self._budget_tokens + ((now - self._budget_time) * refill_rate))
+		self._budget_time = now
+		if self._budget_tokens >= 1:
+			self._budget_tokens -= 1
+			return 0
+		return (1 - self._budget_tokens) / refill_rate
+
+	async def _run(self):
+		while True:
+			# find the next device due for a sample
+			now = time.monotonic()
+			next_device_path = None
+			next_time = None
+			for (device_path, device) in self._devices.items():
+				device_time = device.last_sample_time + device.interval
+				if next_time is None or device_time < next_time:
+					next_device_path = device_path
+					next_time = device_time
+			self._reschedule_evt.clear()
+			if next_device_path is None or next_time > now:
+				# wait for the next sample to be due, or for a new sample to reschedule it
+				timeout = None if next_time is None else (next_time - now)
+				try:
+					await asyncio.wait_for(self._reschedule_evt.wait(), timeout=timeout)
+				except asyncio.TimeoutError:
+					pass
+				continue
+			# wait for the wakeup budget to allow another poll
+			budget_delay = self._take_budget_token()
+			if budget_delay > 0:
+				await asyncio.sleep(budget_delay)
+				continue
+			try:
+				await self._poll_device(next_device_path)
+			except asyncio.CancelledError:
+				raise
+			except BaseException as error:
+				logger.exception(error)
+				# don't retry a failing device immediately
+				device = self._devices.get(next_device_path, None)
+				if device is not None:
+					device.last_sample_time = time.monotonic()
+
+	async def _poll_device(self, device_path: str):
+		supply_dir = self._get_power_supply_dir(device_path)
+		# reading the fuel gauge only takes a few milliseconds, and polls are limited by the wakeup budget,
+		#  so it's read on the event loop
+		device_info = read_power_supply_info(supply_dir) if supply_dir is not None else None
+		if device_info is None:
+			# don't retry the device until upower reports it again
+			device = self._devices.get(device_path, None)
+			if device is not None:
+				device.last_sample_time = time.monotonic()
+				device.interval = self.max_interval
+			return
+		self.poll_count += 1
+		logtime_utc = datetime.datetime.utcnow()
+		prev_device_info = self.monitor.device_infos.get(device_path, None)
+		result = self.monitor.update_device_info(logtime_utc, device_path, device_info)
+		if prev_device_info is not None and self.monitor.device_infos.get(device_path, None) is prev_device_info:
+			# the update was suppressed as unchanged, so it still needs to be observed to back off
+			self.observe(device_path, prev_device_info)
+		if inspect.isawaitable(result):
+			await result
+
+	def _get_power_supply_dir(self, device_path: str) -> Optional[str]:
+		device_info = self.monitor.device_infos.get(device_path, None)
+		if device_info is None:
+			return None
+		native_path = device_info.info.get("native-path", None)
+		if not isinstance(native_path, str) or len(native_path) == 0 or "/" in native_path:
+			return None
+		supply_dir = self.power_supply_dir+"/"+native_path
+		if not os.path.isdir(supply_dir):
+			return None
+		return supply_dir
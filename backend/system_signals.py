@@ -1,12 +1,13 @@
 import sys
 import signal
 import asyncio
-import dbussy
 import datetime
 import threading
 import logging
 from typing import Callable
 
+from utils import try_logexcept_awaitable
+
 logger = logging.getLogger()
 
 def log_info(info: str):
@@ -31,7 +32,9 @@ def log_error(error: str):
 class SystemSignalListener:
 	_thread: threading.Thread = None
 	_loop: asyncio.AbstractEventLoop = None
-	_conn: dbussy.Connection = None
+	# listens on the event loop it was started from, when listening without a thread
+	_task: asyncio.Task = None
+	_conn: 'dbussy.Connection' = None
 	_listening: bool = False
 	
 	on_system_suspend: Callable[[],None]
@@ -48,6 +51,8 @@ class SystemSignalListener:
 		try:
 			if not self._listening:
 				return
+			# import dbussy once listening starts, so loading it doesn't hold up starting the plugin
+			import dbussy
 			# create dbus connection
 			self._conn = await dbussy.Connection.bus_get_async(dbussy.DBUS.BUS_SESSION, private=True, loop=loop)
 			self._conn.bus_add_match({
@@ -67,6 +72,9 @@ class SystemSignalListener:
 				try:
 					message: dbussy.Message = await self._conn.receive_message_async()
 				except BaseException as error:
+					# receiving stops with an error when listening is stopped
+					if not self._listening:
+						break
 					# log error and delay for 2 seconds before retrying
 					log_error("Error while receiving dbus message:\n"+str(error))
 					for i in range(20):
@@ -115,7 +123,7 @@ class SystemSignalListener:
 
 	
 	def listen(self):
-		if self._thread is not None and self._thread.is_alive():
+		if self._task is not None or (self._thread is not None and self._thread.is_alive()):
 			log_warning("Starting SystemSignalListener while already listening")
 			return
 		self._loop = asyncio.new_event_loop()
@@ -139,12 +147,39 @@ class SystemSignalListener:
 		if loop is self._loop:
 			self._loop = None
 	
+	# start listening on the running event loop, without a separate thread
+	#  Signal handlers are called on the event loop.
+	async def listen_async(self):
+		if self._task is not None or (self._thread is not None and self._thread.is_alive()):
+			log_warning("Starting SystemSignalListener while already listening")
+			return
+		self._listening = True
+		self._task = asyncio.create_task(try_logexcept_awaitable(self.run_async(loop=asyncio.get_running_loop())))
+	
+	async def unlisten_async(self):
+		task = self._task
+		if task is None:
+			# a listener thread can take until D-Bus returns to stop, so wait for it without blocking the event loop
+			if self._thread is not None:
+				await asyncio.get_running_loop().run_in_executor(None, self.unlisten)
+			return
+		self._listening = False
+		self._close_conn()
+		task.cancel()
+		await asyncio.wait([task])
+		if self._task is task:
+			self._task = None
+	
 	def wait(self):
 		thread = self._thread
 		if thread is not None:
 			thread.join()
 	
 	async def wait_async(self):
+		task = self._task
+		if task is not None:
+			await asyncio.wait([task])
+			return
 		thread = self._thread
 		while thread is not None and thread.is_alive():
 			await asyncio.sleep(0.1)
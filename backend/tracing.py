@@ -0,0 +1,153 @@
+from typing import Any, Dict, List, Optional
+from contextlib import contextmanager
+import os
+import json
+import time
+import threading
+import contextvars
+import collections
+import logging
+
+logger = logging.getLogger()
+
+# the trace of the request being handled in the current task, or None when it isn't being traced
+current_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_trace_id", default=None)
+
+# offset from the perf_counter clock to the wall clock, so spans from both processes line up
+_WALL_CLOCK_OFFSET = time.time() - time.perf_counter()
+
+def new_trace_id() -> str:
+	return os.urandom(8).hex()
+
+def perf_to_us(perf_time: float) -> int:
+	return int((perf_time + _WALL_CLOCK_OFFSET) * 1000000)
+
+
+
+# Span
+#  A timed stage of a traced request. start_us is microseconds since the epoch.
+
+class TraceSpan:
+	__slots__ = ('name', 'trace_id', 'start_us', 'duration_us', 'thread_id', 'args')
+
+	def __init__(self, name: str, trace_id: str, start_us: int, duration_us: int, thread_id: int, args: Dict[str,Any] = None):
+		self.name = name
+		self.trace_id = trace_id
+		self.start_us = start_us
+		self.duration_us = duration_us
+		self.thread_id = thread_id
+		self.args = args
+
+	# get the span as a complete event of the Chrome trace_event format
+	def to_trace_event(self, pid: int) -> dict:
+		args = {"trace_id": self.trace_id}
+		if self.args is not None:
+			args.update(self.args)
+		return {
+			"name": self.name,
+			"cat": "battery-analytics",
+			"ph": "X",
+			"ts": self.start_us,
+			"dur": self.duration_us,
+			"pid": pid,
+			"tid": self.thread_id,
+			"args": args
+		}
+
+
+
+# Tracer
+#  Keeps the spans of the most recent traces in a ring buffer, and exports them in the Chrome trace_event format,
+#  which can be opened in chrome://tracing or https://ui.perfetto.dev. Spans are only recorded for tasks running
+#  within a trace, so untraced requests only pay for a context variable lookup.
+
+class Tracer:
+	process_name: str
+	max_traces: int = 64
+	max_spans_per_trace: int = 256
+	_traces: 'collections.OrderedDict[str,List[TraceSpan]]'
+	_lock: threading.Lock
+
+	def __init__(self, process_name: str = None):
+		self.process_name = process_name or "python"
+		self._traces = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	# record a span that started and ended at the given perf_counter times
+	def record_span(self, name: str, trace_id: str, start_time: float, end_time: float, args: Dict[str,Any] = None):
+		span = TraceSpan(
+			name = name,
+			trace_id = trace_id,
+			start_us = perf_to_us(start_time),
+			duration_us = max(0, int((end_time - start_time) * 1000000)),
+			thread_id = threading.get_native_id(),
+			args = args)
+		with self._lock:
+			spans = self._traces.get(trace_id, None)
+			if spans is None:
+				spans = list()
+				self._traces[trace_id] = spans
+				# drop the oldest trace once the buffer is full
+				if len(self._traces) > self.max_traces:
+					self._traces.popitem(last=False)
+			if len(spans) < self.max_spans_per_trace:
+				spans.append(span)
+
+	# time a block as a span of the current trace
+	@contextmanager
+	def span(self, name: str, args: Dict[str,Any] = None):
+		trace_id = current_trace_id.get()
+		if trace_id is None:
+			yield
+			return
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record_span(name, trace_id, start_time, time.perf_counter(), args)
+
+	# start a new trace in the current context and time a block as its root span
+	@contextmanager
+	def trace(self, name: str, args: Dict[str,Any] = None):
+		trace_id = new_trace_id()
+		token = current_trace_id.set(trace_id)
+		start_time = time.perf_counter()
+		try:
+			yield trace_id
+		finally:
+			self.record_span(name, trace_id, start_time, time.perf_counter(), args)
+			current_trace_id.reset(token)
+
+	def trace_ids(self) -> List[str]:
+		with self._lock:
+			return list(self._traces.keys())
+
+	def clear(self):
+		with self._lock:
+			self._traces.clear()
+
+	# get the recorded spans as Chrome trace events, with a metadata event naming the process
+	def trace_events(self) -> List[dict]:
+		pid = os.getpid()
+		with self._lock:
+			spans = [span for trace_spans in self._traces.values() for span in trace_spans]
+		events = [{
+			"name": "process_name",
+			"ph": "M",
+			"pid": pid,
+			"args": {"name": self.process_name}
+		}]
+		events.extend(span.to_trace_event(pid) for span in spans)
+		return events
+
+tracer: Tracer = Tracer()
+
+
+
+# write trace events to a JSON file in the Chrome trace_event format
+def write_trace_file(path: str, events: List[dict]):
+	dir_path = os.path.dirname(path)
+	if len(dir_path) > 0:
+		os.makedirs(dir_path, exist_ok=True)
+	with open(path, 'w') as trace_file:
+		json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
@@ -1,17 +1,26 @@
 #!/usr/bin/env python3
-from typing import IO, Tuple, Dict, List, Callable
+from typing import IO, Tuple, Dict, List, Callable, Deque, Optional, Awaitable
 from dataclasses import dataclass
 import os
+import enum
 import datetime
+import time
 import logging
 import asyncio
+import inspect
 import threading
 import subprocess
+import collections
 
 from utils import skip_to_occurance_of_chars, get_line_end_index, get_next_line_index, merge_dict
+from monitor_replay import MonitorRecorder
+from backend_stats import backend_stats
 
 logger = logging.getLogger()
 
+# environment variable with a path that the raw monitor output is recorded to, for replaying with monitor_replay.py
+MONITOR_RECORD_PATH_ENV = "BATTERY_ANALYTICS_MONITOR_RECORD_PATH"
+
 
 def read_value_in_units(val_str: str, unit: str, conversions: Dict[str, float], defaultunit: str = None):
 	if val_str is None:
@@ -266,6 +275,56 @@ class UPowerDeviceBatteryInfo:
 
 
 
+class BatteryChanges(enum.IntFlag):
+	NONE = 0
+	STATE = enum.auto()
+	ENERGY = enum.auto()
+	ENERGY_EMPTY = enum.auto()
+	ENERGY_FULL = enum.auto()
+	ENERGY_FULL_DESIGN = enum.auto()
+	ENERGY_RATE = enum.auto()
+	VOLTAGE = enum.auto()
+	TIME_TILL_FULL = enum.auto()
+	TIME_TILL_EMPTY = enum.auto()
+	PERCENT_CURRENT = enum.auto()
+	PERCENT_CAPACITY = enum.auto()
+	# a field outside of the logged battery fields changed
+	OTHER = enum.auto()
+	BATTERY = STATE | ENERGY | ENERGY_EMPTY | ENERGY_FULL | ENERGY_FULL_DESIGN | ENERGY_RATE | VOLTAGE \
+		| TIME_TILL_FULL | TIME_TILL_EMPTY | PERCENT_CURRENT | PERCENT_CAPACITY
+	ALL = BATTERY | OTHER
+
+# maps the keys of the upower "battery" section to their change flag
+BATTERY_INFO_CHANGE_FLAGS: Dict[str, BatteryChanges] = {
+	"state": BatteryChanges.STATE,
+	"energy": BatteryChanges.ENERGY,
+	"energy-empty": BatteryChanges.ENERGY_EMPTY,
+	"energy-full": BatteryChanges.ENERGY_FULL,
+	"energy-full-design": BatteryChanges.ENERGY_FULL_DESIGN,
+	"energy-rate": BatteryChanges.ENERGY_RATE,
+	"voltage": BatteryChanges.VOLTAGE,
+	"time to full": BatteryChanges.TIME_TILL_FULL,
+	"time to empty": BatteryChanges.TIME_TILL_EMPTY,
+	"percentage": BatteryChanges.PERCENT_CURRENT,
+	"capacity": BatteryChanges.PERCENT_CAPACITY
+}
+
+# keys that change on every update without carrying any new information
+IGNORED_CHANGE_KEYS = {"updated"}
+
+def info_value_changed(val, patch_val) -> bool:
+	if patch_val is None:
+		# merge_dict ignores None values, so they can never cause a change
+		return False
+	if isinstance(patch_val, dict) and isinstance(val, dict):
+		for key in patch_val:
+			if info_value_changed(val.get(key, None), patch_val[key]):
+				return True
+		return False
+	return val != patch_val
+
+
+
 @dataclass
 class UPowerDeviceInfo:
 	def __init__(self, info: dict):
@@ -380,6 +439,20 @@ class UPowerDeviceInfo:
 			line_count += 1
 		return (info, offset)
 	
+	# parse the "updated" field, which upower prints in UTC since it's run with TZ=UTC
+	def get_updated_time(self, tzinfo_utc: datetime.tzinfo) -> datetime.datetime:
+		updated_date_str = self.info.get("updated", None)
+		if not isinstance(updated_date_str, str):
+			return None
+		if updated_date_str.endswith(")"):
+			parenth_start = updated_date_str.rfind("(", 0, len(updated_date_str)-1)
+			if parenth_start != -1:
+				updated_date_str = updated_date_str[0:parenth_start].strip()
+		logtime_utc = datetime.datetime.strptime(updated_date_str, "%a %d %b %Y %I:%M:%S %p %Z")
+		if logtime_utc is not None:
+			logtime_utc = logtime_utc.astimezone(tzinfo_utc)
+		return logtime_utc
+	
 	def copy(self) -> 'UPowerDeviceInfo':
 		new_info = dict()
 		for key in self.info:
@@ -395,6 +468,25 @@ class UPowerDeviceInfo:
 	def merge_from(self, other_info: 'UPowerDeviceInfo'):
 		self.info = merge_dict(self.info, other_info.info, copy=False, copy_inner=True)
 	
+	# get the fields that would change if the given info was merged into this info
+	def get_changes(self, patch_info: 'UPowerDeviceInfo') -> BatteryChanges:
+		changes = BatteryChanges.NONE
+		for key in patch_info.info:
+			if key in IGNORED_CHANGE_KEYS:
+				continue
+			patch_val = patch_info.info[key]
+			val = self.info.get(key, None)
+			if key == 'battery' and isinstance(patch_val, dict) and isinstance(val, dict):
+				for batt_key in patch_val:
+					if info_value_changed(val.get(batt_key, None), patch_val[batt_key]):
+						changes |= BATTERY_INFO_CHANGE_FLAGS.get(batt_key, BatteryChanges.OTHER)
+			elif info_value_changed(val, patch_val):
+				if key == 'battery':
+					changes |= BatteryChanges.ALL
+				else:
+					changes |= BatteryChanges.OTHER
+		return changes
+	
 	@property
 	def battery_info(self) -> UPowerDeviceBatteryInfo:
 		batt_info = self.info.get("battery", None)
@@ -406,15 +498,51 @@ class UPowerDeviceInfo:
 
 class UPowerMonitor:
 	update_devices_on_start: bool = False
+	# don't call when_device_updated for updates without any changes
+	#  Listeners that need to log a stable device now and then have to do it on their own, like the plugin's log heartbeat.
+	suppress_unchanged_updates: bool = True
+	# if set, the raw monitor output is recorded to this path for replaying later
+	#  If not set, the path in the MONITOR_RECORD_PATH_ENV environment variable is used, which is read when the monitor starts.
+	record_path: str = None
 	main_loop: asyncio.AbstractEventLoop
 	monitor_proc: subprocess.Popen = None
 	monitor_reader_thread: threading.Thread = None
 	last_logtime: datetime.datetime = None
 	device_infos: Dict[str,UPowerDeviceInfo] = dict()
-	when_device_updated: Callable[[datetime.datetime, str, UPowerDeviceInfo], None] = None
+	# if the listener returns an awaitable, the async reader waits for it before dispatching the next event
+	when_device_updated: Callable[[datetime.datetime, str, UPowerDeviceInfo, BatteryChanges], Optional[Awaitable]] = None
+	# async reader
+	async_monitor_proc: asyncio.subprocess.Process = None
+	monitor_queue_size: int = 32
+	coalesced_event_count: int = 0
+	_monitor_reader_task: asyncio.Task = None
+	_monitor_dispatch_task: asyncio.Task = None
+	_event_queue: Deque[Tuple[datetime.datetime, UPowerMonitorEventHeader, UPowerDeviceInfo]]
+	_coalesced_events: Dict[str,Tuple[datetime.datetime, UPowerMonitorEventHeader, UPowerDeviceInfo]]
+	_events_ready: asyncio.Event
+	# set while no events are queued or being dispatched
+	_events_drained: asyncio.Event
 	
 	def __init__(self):
 		self.main_loop = asyncio.get_running_loop()
+		self._event_queue = collections.deque()
+		self._coalesced_events = dict()
+		self._events_ready = asyncio.Event()
+		self._events_drained = asyncio.Event()
+		self._events_drained.set()
+	
+	def stats(self) -> dict:
+		return {
+			"queued_events": len(self._event_queue),
+			"coalesced_pending": len(self._coalesced_events),
+			"coalesced": self.coalesced_event_count
+		}
+	
+	# get the path that the monitor output should be recorded to, or None if it shouldn't be recorded
+	def get_record_path(self) -> Optional[str]:
+		if self.record_path is not None:
+			return self.record_path
+		return os.environ.get(MONITOR_RECORD_PATH_ENV, None) or None
 	
 	def fetch_devices(self) -> List[str]:
 		proc = subprocess.Popen(
@@ -429,6 +557,16 @@ class UPowerMonitor:
 			devices[i] = devices[i].strip()
 		return devices
 	
+	async def fetch_devices_async(self) -> List[str]:
+		proc = await asyncio.create_subprocess_exec(
+			'upower', '--enumerate',
+			stdout=asyncio.subprocess.PIPE)
+		(output, _) = await proc.communicate()
+		output_str = output.decode('utf-8').strip()
+		if len(output_str) == 0:
+			return []
+		return [device.strip() for device in output_str.split('\n')]
+	
 	def fetch_device_info(self, name: str) -> UPowerDeviceInfo:
 		# attach UTC timezone for more correct date reading
 		procenv = os.environ.copy()
@@ -446,17 +584,7 @@ class UPowerMonitor:
 			logger.error("Couldn't parse device info from output chunk "+output_str)
 		return info
 	
-	def start(self):
-		if self.monitor_proc is not None and self.monitor_proc.poll() is None \
-			and self.monitor_reader_thread is not None and self.monitor_reader_thread.is_alive():
-			# upower monitor is already running
-			logger.warn("called UPowerMonitor.start when it is already started")
-			return
-		if self.monitor_proc is not None or self.monitor_reader_thread is not None:
-			# upower process was killed or is ended
-			# stop to ensure process is dead
-			self.stop()
-		# get initial device info
+	def _fetch_initial_device_infos(self):
 		devices = self.fetch_devices()
 		device_count = len(devices)
 		if device_count == 0:
@@ -472,8 +600,57 @@ class UPowerMonitor:
 				continue
 			device_infos[device_path] = device_info
 			if self.update_devices_on_start and self.when_device_updated is not None:
-				self.when_device_updated(now, device_path, device_info)
+				self.when_device_updated(now, device_path, device_info, BatteryChanges.ALL)
+		self.device_infos = device_infos
+	
+	# same as _fetch_initial_device_infos, but without blocking the event loop, and fetching devices concurrently
+	async def _fetch_initial_device_infos_async(self):
+		devices = await self.fetch_devices_async()
+		if len(devices) == 0:
+			logger.warn("didn't find any power devices")
+		else:
+			logger.info("found %d initial devices:\n- %s", len(devices), "\n- ".join(devices))
+		now = datetime.datetime.utcnow()
+		fetched_infos = await asyncio.gather(*[self.fetch_device_info_async(device_path) for device_path in devices])
+		device_infos = dict()
+		for (device_path, device_info) in zip(devices, fetched_infos):
+			if device_info is None:
+				logger.error("Couldn't fetch info for device "+device_path)
+				continue
+			device_infos[device_path] = device_info
+			if self.update_devices_on_start and self.when_device_updated is not None:
+				self.when_device_updated(now, device_path, device_info, BatteryChanges.ALL)
 		self.device_infos = device_infos
+	
+	async def fetch_device_info_async(self, name: str) -> UPowerDeviceInfo:
+		# attach UTC timezone for more correct date reading
+		procenv = os.environ.copy()
+		procenv["TZ"] = "UTC"
+		# run upower process
+		proc = await asyncio.create_subprocess_exec(
+			'upower', '--show-info', name,
+			env=procenv,
+			stdout=asyncio.subprocess.PIPE)
+		# parse output
+		(output, _) = await proc.communicate()
+		output_str = output.decode('utf-8')
+		(info, offset) = UPowerDeviceInfo.parse(output_str, 0)
+		if info is None:
+			logger.error("Couldn't parse device info from output chunk "+output_str)
+		return info
+	
+	def start(self):
+		if self.monitor_proc is not None and self.monitor_proc.poll() is None \
+			and self.monitor_reader_thread is not None and self.monitor_reader_thread.is_alive():
+			# upower monitor is already running
+			logger.warn("called UPowerMonitor.start when it is already started")
+			return
+		if self.monitor_proc is not None or self.monitor_reader_thread is not None:
+			# upower process was killed or is ended
+			# stop to ensure process is dead
+			self.stop()
+		# get initial device info
+		self._fetch_initial_device_infos()
 		# attach UTC timezone for more correct date reading
 		procenv = os.environ.copy()
 		procenv["TZ"] = "UTC"
@@ -484,6 +661,9 @@ class UPowerMonitor:
 			stdout = subprocess.PIPE)
 		# read monitor output on separate thread
 		monitor_stdout = self.monitor_proc.stdout
+		record_path = self.get_record_path()
+		if record_path is not None:
+			monitor_stdout = MonitorRecorder(monitor_stdout, record_path)
 		self.monitor_reader_thread = threading.Thread(target=self._consume_monitor_output, args=(monitor_stdout, ))
 		self.monitor_reader_thread.start()
 
@@ -499,25 +679,134 @@ class UPowerMonitor:
 			if self.monitor_reader_thread is thread:
 				self.monitor_reader_thread = None
 	
-	def on_monitor_device_update(self, logtime_utc: datetime.datetime, header: UPowerMonitorEventHeader, new_info: UPowerDeviceInfo):
+	# start the monitor, reading its output on the event loop instead of a separate thread
+	async def start_async(self):
+		if self.async_monitor_proc is not None and self.async_monitor_proc.returncode is None:
+			# upower monitor is already running
+			logger.warn("called UPowerMonitor.start_async when it is already started")
+			return
+		if self.async_monitor_proc is not None or self._monitor_reader_task is not None:
+			# upower process was killed or is ended
+			await self.stop_async()
+		# get initial device info
+		await self._fetch_initial_device_infos_async()
+		# attach UTC timezone for more correct date reading
+		procenv = os.environ.copy()
+		procenv["TZ"] = "UTC"
+		# run monitor process
+		proc = await asyncio.create_subprocess_exec(
+			'upower', '--monitor-detail',
+			env=procenv,
+			stdout=asyncio.subprocess.PIPE)
+		self.async_monitor_proc = proc
+		# read and dispatch monitor output on the event loop
+		recorder = None
+		record_path = self.get_record_path()
+		if record_path is not None:
+			recorder = MonitorRecorder(None, record_path)
+		self._monitor_dispatch_task = asyncio.create_task(self._dispatch_monitor_events())
+		self._monitor_reader_task = asyncio.create_task(self._read_monitor_stream(proc, proc.stdout, recorder))
+	
+	# stop the monitor
+	#  flush_timeout: seconds to keep dispatching the events that were already read, after which any events still
+	#   queued are dropped (by default they're dropped right away)
+	async def stop_async(self, flush_timeout: float = None):
+		proc = self.async_monitor_proc
+		reader_task = self._monitor_reader_task
+		dispatch_task = self._monitor_dispatch_task
+		# kill upower process
+		if proc is not None:
+			if proc.returncode is None:
+				proc.kill()
+			await proc.wait()
+			if self.async_monitor_proc is proc:
+				self.async_monitor_proc = None
+		# wait for reader to reach the end of the output
+		if reader_task is not None:
+			await asyncio.wait([reader_task])
+			if self._monitor_reader_task is reader_task:
+				self._monitor_reader_task = None
+		# stop dispatching events, once the queued events are dispatched if they're flushed
+		if dispatch_task is not None:
+			if flush_timeout is not None and not self._events_drained.is_set():
+				try:
+					await asyncio.wait_for(self._events_drained.wait(), flush_timeout)
+				except asyncio.TimeoutError:
+					logger.warning("dropping %d monitor events that weren't dispatched in time", len(self._event_queue) + len(self._coalesced_events))
+			dispatch_task.cancel()
+			await asyncio.wait([dispatch_task])
+			if self._monitor_dispatch_task is dispatch_task:
+				self._monitor_dispatch_task = None
+		self._event_queue.clear()
+		self._coalesced_events.clear()
+		self._events_drained.set()
+	
+	def on_monitor_device_update(self, logtime_utc: datetime.datetime, header: UPowerMonitorEventHeader, new_info: UPowerDeviceInfo) -> Optional[Awaitable]:
 		device_path = header.event_value
 		if device_path is not None and len(device_path) > 0:
-			if device_path in self.device_infos:
-				new_device_info = self.device_infos[device_path].copy()
-				new_device_info.merge_from(new_info)
-			else:
-				logger.warn("new device entry "+device_path)
-				new_device_info = new_info
-			self.device_infos[device_path] = new_device_info
-			# call device update event property
-			if self.when_device_updated is not None:
-				self.when_device_updated(logtime_utc, device_path, new_device_info)
+			return self.update_device_info(logtime_utc, device_path, new_info)
+		return None
+	
+	def update_device_info(self, logtime_utc: datetime.datetime, device_path: str, new_info: UPowerDeviceInfo) -> Optional[Awaitable]:
+		prev_device_info = self.device_infos.get(device_path, None)
+		if prev_device_info is not None:
+			changes = prev_device_info.get_changes(new_info)
+			if changes == BatteryChanges.NONE and self.suppress_unchanged_updates:
+				# only the update time changed (or the event was a duplicate), so there is nothing to report
+				logger.debug("ignoring unchanged update for %s", device_path)
+				return None
+			new_device_info = prev_device_info.copy()
+			new_device_info.merge_from(new_info)
+		else:
+			logger.warn("new device entry "+device_path)
+			new_device_info = new_info
+			changes = BatteryChanges.ALL
+		self.device_infos[device_path] = new_device_info
+		# call device update event property
+		if self.when_device_updated is not None:
+			return self.when_device_updated(logtime_utc, device_path, new_device_info, changes)
+		return None
 	
 	def on_monitor_end(self):
 		exit_code = self.monitor_proc.poll()
 		self.monitor_proc = None
 		logger.info("upower monitor exited with code "+str(exit_code))
 	
+	# parse a chunk of monitor output into its header, device info, and UTC log time
+	def _parse_monitor_chunk(self, chunk_str: str, utcnow: datetime.datetime) -> Tuple[UPowerMonitorEventHeader, UPowerDeviceInfo, datetime.datetime]:
+		tzinfo_utc = utcnow.tzinfo
+		offset = 0
+		# read chunk header
+		(header, offset) = UPowerMonitorEventHeader.parse(chunk_str, offset)
+		if header is None:
+			logger.error("No header found for monitor output:\n"+chunk_str)
+			return None
+		# read device info
+		(device_info, offset) = UPowerDeviceInfo.parse(chunk_str, offset)
+		if device_info is None:
+			logger.error("failed to read chunk:\n"+chunk_str)
+			return None
+		# parse timestamp
+		logtime_utc = device_info.get_updated_time(tzinfo_utc)
+		if logtime_utc is None:
+			h_tm = header.logtime
+			tm_from_now = datetime.datetime(year=utcnow.year, month=utcnow.month, day=utcnow.day, hour=h_tm.hour, minute=h_tm.minute, second=h_tm.second, microsecond=h_tm.microsecond, tzinfo=tzinfo_utc)
+			tm_from_yesterday = tm_from_now - datetime.timedelta(days=1)
+			zero_deltatime = datetime.timedelta()
+			diff_from_now = utcnow - tm_from_now
+			if diff_from_now < zero_deltatime:
+				diff_from_now = -diff_from_now
+			diff_from_yesterday = utcnow - tm_from_yesterday
+			if diff_from_yesterday < zero_deltatime:
+				diff_from_yesterday = -diff_from_yesterday
+			if diff_from_yesterday < diff_from_now:
+				logtime_utc = tm_from_yesterday
+			else:
+				logtime_utc = tm_from_now
+		logger.debug("got event %s for %s at timestamp %s", header.event_type, header.event_value, logtime_utc)
+		return (header, device_info, logtime_utc)
+	
+	# consume output from the monitor process (or anything else with a compatible readline)
 	def _consume_monitor_output(self, stdout: IO[bytes]):
 		is_first_line = True
 		reading_chunks = True
@@ -526,7 +815,6 @@ class UPowerMonitor:
 			# read a line
 			line = stdout.readline()
 			utcnow = datetime.datetime.utcnow()
-			tzinfo_utc = utcnow.tzinfo
 			if not line:
 				reading_chunks = False
 				break
@@ -548,50 +836,120 @@ class UPowerMonitor:
 						# read chunk
 						chunk_str = "".join(lines)
 						lines.clear()
-						offset = 0
-						# read chunk header
-						(header, offset) = UPowerMonitorEventHeader.parse(chunk_str, offset)
-						if header is None:
-							logger.error("No header found for monitor output:\n"+chunk_str)
-						else:
-							# read device info
-							(device_info, offset) = UPowerDeviceInfo.parse(chunk_str, offset)
-							if device_info is None:
-								logger.error("failed to read chunk:\n"+chunk_str)
-							else:
-								# parse timestamp
-								logtime_utc = None
-								if "updated" in device_info.info:
-									updated_date_str = device_info.info["updated"]
-									if isinstance(updated_date_str, str):
-										if updated_date_str.endswith(")"):
-											parenth_start = updated_date_str.rfind("(", 0, len(updated_date_str)-1)
-											if parenth_start != -1:
-												updated_date_str = updated_date_str[0:parenth_start].strip()
-										logtime_utc = datetime.datetime.strptime(updated_date_str, "%a %d %b %Y %I:%M:%S %p %Z")
-										if logtime_utc is not None:
-											logtime_utc = logtime_utc.astimezone(tzinfo_utc)
-								if logtime_utc is None:
-									h_tm = header.logtime
-									tm_from_now = datetime.datetime(year=utcnow.year, month=utcnow.month, day=utcnow.day, hour=h_tm.hour, minute=h_tm.minute, second=h_tm.second, microsecond=h_tm.microsecond, tzinfo=tzinfo_utc)
-									tm_from_yesterday = tm_from_now - datetime.timedelta(days=1)
-									zero_deltatime = datetime.timedelta()
-									diff_from_now = utcnow - tm_from_now
-									if diff_from_now < zero_deltatime:
-										diff_from_now = -diff_from_now
-									diff_from_yesterday = utcnow - tm_from_yesterday
-									if diff_from_yesterday < zero_deltatime:
-										diff_from_yesterday = -diff_from_yesterday
-									if diff_from_yesterday < diff_from_now:
-										logtime_utc = tm_from_yesterday
-									else:
-										logtime_utc = tm_from_now
-								# call update event
-								logger.debug("got event {} for {} at timestamp {}".format(header.event_type, str(header.event_value), logtime_utc.isoformat()))
-								self.main_loop.call_soon_threadsafe(lambda:self.on_monitor_device_update(logtime_utc, header, device_info))
+						parse_start = time.perf_counter()
+						event = self._parse_monitor_chunk(chunk_str, utcnow)
+						backend_stats.record("monitor.parse", time.perf_counter() - parse_start)
+						backend_stats.increment("monitor.events")
+						if event is not None:
+							# call update event
+							(header, device_info, logtime_utc) = event
+							self.main_loop.call_soon_threadsafe(self.on_monitor_device_update, logtime_utc, header, device_info)
 					else:
 						# ignore empty line
 						logger.info("Ignoring empty line")
 			except BaseException as error:
 				logger.exception(error)
 		self.main_loop.call_soon_threadsafe(lambda:self.on_monitor_end())
+	
+	# discard the rest of a chunk that's too long to buffer, up to and including the empty line that ends it
+	#  consumed: the number of bytes already searched for the end of the chunk
+	#  returns False if the output ended before the end of the chunk
+	async def _skip_oversized_chunk(self, stdout: asyncio.StreamReader, consumed: int) -> bool:
+		while True:
+			await stdout.readexactly(consumed)
+			try:
+				await stdout.readuntil(b"\n\n")
+				return True
+			except asyncio.LimitOverrunError as error:
+				consumed = error.consumed
+			except asyncio.IncompleteReadError:
+				return False
+	
+	# read chunks of monitor output from an asyncio stream and queue their events
+	async def _read_monitor_stream(self, proc: Optional[asyncio.subprocess.Process], stdout: asyncio.StreamReader, recorder: MonitorRecorder = None):
+		is_first_chunk = True
+		try:
+			while True:
+				# read a chunk, which ends with an empty line
+				try:
+					chunk = await stdout.readuntil(b"\n\n")
+				except asyncio.IncompleteReadError as error:
+					chunk = error.partial
+				except asyncio.LimitOverrunError as error:
+					logger.error("upower monitor chunk exceeded stream limit, skipping it")
+					backend_stats.increment("monitor.skipped_chunks")
+					if not await self._skip_oversized_chunk(stdout, error.consumed):
+						break
+					continue
+				if not chunk:
+					break
+				utcnow = datetime.datetime.utcnow()
+				try:
+					chunk_str = chunk.decode('utf-8')
+					if recorder is not None:
+						recorder.record(chunk_str)
+					chunk_str = chunk_str.lstrip("\r\n")
+					# ignore first line if not relevant
+					if is_first_chunk and len(chunk_str) > 0 and not chunk_str.startswith("["):
+						line_end = get_next_line_index(chunk_str, 0)
+						logger.info("Ignoring first line: "+chunk_str[0:line_end])
+						chunk_str = chunk_str[line_end:].lstrip("\r\n")
+					is_first_chunk = False
+					if len(chunk_str) == 0 or chunk_str.isspace():
+						continue
+					parse_start = time.perf_counter()
+					event = self._parse_monitor_chunk(chunk_str, utcnow)
+					backend_stats.record("monitor.parse", time.perf_counter() - parse_start)
+					backend_stats.increment("monitor.events")
+					if event is not None:
+						self._enqueue_monitor_event(*event)
+				except BaseException as error:
+					logger.exception(error)
+		finally:
+			if recorder is not None:
+				recorder.close()
+			if proc is not None:
+				exit_code = await proc.wait()
+				if self.async_monitor_proc is proc:
+					self.async_monitor_proc = None
+				logger.info("upower monitor exited with code "+str(exit_code))
+	
+	# queue a parsed monitor event, coalescing events per device once the queue is full
+	def _enqueue_monitor_event(self, header: UPowerMonitorEventHeader, device_info: UPowerDeviceInfo, logtime_utc: datetime.datetime):
+		if len(self._coalesced_events) > 0 or len(self._event_queue) >= self.monitor_queue_size:
+			# the listener is falling behind, so merge this event into any pending event for the device
+			#  (events keep coalescing until the dispatcher drains them, so they stay in order)
+			device_path = header.event_value
+			pending_event = self._coalesced_events.pop(device_path, None)
+			if pending_event is not None:
+				(_, _, pending_info) = pending_event
+				device_info = UPowerDeviceInfo(merge_dict(pending_info.info, device_info.info, copy=True, copy_inner=True))
+				self.coalesced_event_count += 1
+			self._coalesced_events[device_path] = (logtime_utc, header, device_info)
+		else:
+			self._event_queue.append((logtime_utc, header, device_info))
+		self._events_drained.clear()
+		self._events_ready.set()
+	
+	# dispatch queued monitor events, waiting for the listener before dispatching the next one
+	async def _dispatch_monitor_events(self):
+		while True:
+			await self._events_ready.wait()
+			if len(self._event_queue) > 0:
+				event = self._event_queue.popleft()
+			elif len(self._coalesced_events) > 0:
+				device_path = next(iter(self._coalesced_events))
+				event = self._coalesced_events.pop(device_path)
+			else:
+				self._events_ready.clear()
+				self._events_drained.set()
+				continue
+			(logtime_utc, header, device_info) = event
+			try:
+				result = self.on_monitor_device_update(logtime_utc, header, device_info)
+				if inspect.isawaitable(result):
+					await result
+			except asyncio.CancelledError:
+				raise
+			except BaseException as error:
+				logger.exception(error)
@@ -1,5 +1,10 @@
 from typing import Callable, Awaitable
+import os
+import sys
 import asyncio
+import threading
+import subprocess
+import collections
 import datetime
 import inspect
 import logging
@@ -55,6 +60,50 @@ def merge_dict(d: dict, patch: dict, copy: bool = True, copy_inner: bool = True)
 			d[key] = p_val
 	return d
 
+# wait for the child processes of asyncio subprocesses with pidfds on the event loop, instead of with a thread for
+# each child process, if the kernel supports pidfds (Python 3.12 and later already do this by default)
+#  This must be called before the event loop is started. Returns whether pidfds are used.
+def use_pidfd_child_watcher() -> bool:
+	if sys.version_info >= (3, 12) or not hasattr(asyncio, "PidfdChildWatcher") or not hasattr(os, "pidfd_open"):
+		return False
+	try:
+		os.close(os.pidfd_open(os.getpid()))
+	except OSError:
+		return False
+	asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+	return True
+
+# wait up to a number of seconds (or forever if None) for a child process started with subprocess.Popen to exit,
+# returning whether it did
+#  The exit is noticed through a pidfd on the event loop when the kernel supports it, instead of by polling.
+async def wait_process_exit(proc: subprocess.Popen, timeout: float = None) -> bool:
+	if proc.poll() is not None:
+		return True
+	loop = asyncio.get_running_loop()
+	try:
+		pidfd = os.pidfd_open(proc.pid)
+	except (AttributeError, OSError):
+		pidfd = None
+	if pidfd is None:
+		# wait on another thread instead
+		def wait_proc():
+			try:
+				proc.wait(timeout=timeout)
+			except subprocess.TimeoutExpired:
+				pass
+		await loop.run_in_executor(None, wait_proc)
+		return proc.poll() is not None
+	exited = loop.create_future()
+	loop.add_reader(pidfd, lambda:exited.done() or exited.set_result(None))
+	try:
+		await asyncio.wait_for(exited, timeout)
+	except asyncio.TimeoutError:
+		pass
+	finally:
+		loop.remove_reader(pidfd)
+		os.close(pidfd)
+	return proc.poll() is not None
+
 def try_logexcept(callable: Callable):
 	try:
 		callable()
@@ -84,6 +133,8 @@ class AsyncValue:
 	state: bool = None
 	result = None
 	error: BaseException = None
+	# set when the waiting caller was cancelled, so work that hasn't started yet can be skipped
+	cancelled: bool = False
 
 	def __init__(self):
 		self.loop = asyncio.get_event_loop()
@@ -113,6 +164,9 @@ class AsyncValue:
 
 	@classmethod
 	async def _main_sync(cls, val: 'AsyncValue', callable: Callable):
+		if val.cancelled:
+			val.reject(asyncio.CancelledError())
+			return
 		try:
 			if inspect.iscoroutinefunction(callable):
 				result = await callable()
@@ -129,4 +183,111 @@ class AsyncValue:
 	async def run_on_loop(cls, loop: asyncio.AbstractEventLoop, callable: Callable):
 		val = AsyncValue()
 		loop.call_soon_threadsafe(lambda:loop.create_task(cls._main_sync(val, callable)))
-		return await val.get()
+		try:
+			return await val.get()
+		except asyncio.CancelledError:
+			val.cancelled = True
+			raise
+
+
+
+# Serial thread executor
+#  Runs callables one at a time and in order on a single thread, so the event loop doesn't block on them. The thread
+#  sleeps in a read of a pipe that each submitted call writes to, and results are returned to the loop of the caller.
+#  This takes fewer context switches per call than a ThreadPoolExecutor, whose queue and future locks make the
+#  thread and the event loop take turns waiting on each other for the GIL.
+
+class SerialThreadExecutor:
+	name: str
+	_thread: threading.Thread = None
+	_calls: 'collections.deque[tuple]'
+	_wake_reader_fd: int = None
+	_wake_writer_fd: int = None
+	_shutdown: bool = False
+
+	def __init__(self, name: str):
+		self.name = name
+		self._calls = collections.deque()
+
+	@property
+	def pending_count(self) -> int:
+		return len(self._calls)
+
+	# run a callable on the thread, skipping it if the caller stops waiting before it starts
+	async def run(self, callable: Callable):
+		if self._shutdown:
+			raise RuntimeError("Executor "+self.name+" has been shut down")
+		self._prepare_thread()
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self._calls.append((loop, future, callable))
+		self._wake()
+		return await future
+
+	# stop the thread once the calls already submitted have run, optionally waiting for it to exit
+	def shutdown(self, wait: bool = False):
+		if self._shutdown:
+			return
+		self._shutdown = True
+		thread = self._thread
+		if thread is None:
+			return
+		self._calls.append(None)
+		self._wake()
+		os.close(self._wake_writer_fd)
+		self._wake_writer_fd = None
+		if wait:
+			thread.join()
+
+	def _prepare_thread(self):
+		if self._thread is not None:
+			return
+		(reader_fd, writer_fd) = os.pipe()
+		# a full pipe already wakes the thread, so further wakeups can be dropped
+		os.set_blocking(writer_fd, False)
+		self._wake_reader_fd = reader_fd
+		self._wake_writer_fd = writer_fd
+		self._thread = threading.Thread(target=self._run_calls, name=self.name)
+		self._thread.start()
+
+	def _wake(self):
+		try:
+			os.write(self._wake_writer_fd, b'\0')
+		except BlockingIOError:
+			pass
+
+	def _run_calls(self):
+		reader_fd = self._wake_reader_fd
+		try:
+			while True:
+				os.read(reader_fd, 4096)
+				while len(self._calls) > 0:
+					call = self._calls.popleft()
+					if call is None:
+						return
+					(loop, future, callable) = call
+					if future.cancelled():
+						continue
+					try:
+						result = callable()
+					except BaseException as error:
+						self._resolve(loop, future, None, error)
+					else:
+						self._resolve(loop, future, result, None)
+		finally:
+			os.close(reader_fd)
+
+	@staticmethod
+	def _resolve(loop: asyncio.AbstractEventLoop, future: asyncio.Future, result, error: BaseException):
+		def set_future():
+			if future.cancelled():
+				return
+			if error is not None:
+				future.set_exception(error)
+			else:
+				future.set_result(result)
+		try:
+			loop.call_soon_threadsafe(set_future)
+		except RuntimeError:
+			# the loop of the caller was closed
+			pass
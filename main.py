@@ -17,87 +17,328 @@ sys.path.extend(PYTHON_PATHS)
 
 import asyncio
 import subprocess
+import importlib.util
 import logging
 from dataclasses import dataclass
-from typing import Any, Dict, Callable
+from typing import Any, Awaitable, Dict, Callable
 
-logging.basicConfig(filename="/tmp/battery-analytics-decky-main.log",
-					format='[BatteryAnalytics] %(asctime)s %(levelname)s %(message)s',
-					filemode='w+',
-					force=True)
+from log_pipeline import setup_logging
+log_pipeline = setup_logging("/tmp/battery-analytics-decky-main.log",
+	level=logging.INFO) # can be changed to logging.DEBUG for debugging issues
 logger=logging.getLogger()
-logger.setLevel(logging.INFO) # can be changed to logging.DEBUG for debugging issues
 
-from pipetalk import PipeTalker
+from pipetalk import PipeTalker, PipeTalkRequest, PipeTalkData
+from backend_stats import backend_stats, StartupReport, LoopLagMonitor
+from tracing import tracer
+from paths import DAEMON_SOCKET_PATH, DAEMON_LOCK_PATH
+from daemon import DaemonLock, connect_daemon, send_pipes, get_backend_version
+from local_backend import LocalBackend
+from response_cache import ResponseCache, parse_cache_time
+from utils import wait_process_exit
+
+tracer.process_name = "main"
+
+# seconds to wait for a query to the backend before cancelling it
+BACKEND_QUERY_TIMEOUT = 60.0
+# seconds for the backend to unload and its process to exit, after which the process is killed
+BACKEND_UNLOAD_TIMEOUT = 3.0
+# seconds to wait for a killed backend process to exit
+BACKEND_KILL_TIMEOUT = 1.0
+# seconds to wait for a started backend daemon to accept connections
+DAEMON_START_TIMEOUT = 10.0
+# the table that the results of each cached backend query are read from
+CACHED_QUERY_TABLES = {
+	"get_battery_state_logs": "BatteryStateLog",
+	"get_system_event_logs": "SystemEventLog"
+}
+# name the backend plugin module is imported as when running in process, which can't be "plugin" like in the
+# backend process, because the plugin loader may have its own module with that name
+BACKEND_PLUGIN_MODULE_NAME = "battery_analytics_backend_plugin"
+
+# import the backend plugin module from its file
+def import_backend_plugin_module():
+	module = sys.modules.get(BACKEND_PLUGIN_MODULE_NAME, None)
+	if module is not None:
+		return module
+	spec = importlib.util.spec_from_file_location(BACKEND_PLUGIN_MODULE_NAME, PLUGIN_DIR+"/backend/plugin.py")
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[BACKEND_PLUGIN_MODULE_NAME] = module
+	try:
+		spec.loader.exec_module(module)
+	except:
+		sys.modules.pop(BACKEND_PLUGIN_MODULE_NAME, None)
+		raise
+	return module
 
 class Plugin:
 	proc: subprocess.Popen = None
+	# the pipetalker of the backend process, or a LocalBackend with the same request methods when running in process
 	proc_pipetalker: PipeTalker = None
+	loop_lag_monitor: LoopLagMonitor = None
+	startup_report: StartupReport = None
+	# attach to a backend daemon that keeps running when the plugin is unloaded, starting one if none is running,
+	# instead of running the backend as a child process
+	use_daemon: bool = False
+	# the backend daemon started by this plugin, which is reaped when it exits
+	daemon_proc: subprocess.Popen = None
+	_daemon_reap_task: asyncio.Task = None
+	# run the backend plugin on this event loop instead of in another process, if dbussy can be imported here
+	#  This skips the pipe and the encoding of every request and result, but the plugin loader's process then also
+	#  runs the backend's DB, device monitor and D-Bus threads.
+	in_process: bool = False
+	# recent query results, which the backend tells us to drop when the logs they were read from change
+	response_cache: ResponseCache = None
 	
 	# Asyncio-compatible long-running code, executed in a task when the plugin is loaded
+	#  The backend finishes starting its device monitor in the background after it's ready to serve queries.
 	async def _main(self):
 		logger.info("Loading Battery Analytics plugin")
+		startup_report = StartupReport()
+		self.startup_report = startup_report
 		try:
-			# start child process
-			backend_path = PLUGIN_DIR+"/backend"
-			procenv = os.environ.copy()
-			procenv["PYTHONPATH"] = ":".join(PYTHON_PATHS)
-			logger.info("starting subprocess "+backend_path)
-			proc = subprocess.Popen(
-				["python3", backend_path],
-				env=procenv,
-				stdin=subprocess.PIPE,
-				stdout=subprocess.PIPE)
-			self.proc = proc
-			# attach child process pipetalker
-			pipetalker = PipeTalker(
-				reader = proc.stdout,
-				writer = proc.stdin,
-				request_handler = None)
-			self.proc_pipetalker = pipetalker
-			pipetalker.listen()
+			if self.response_cache is None:
+				self.response_cache = ResponseCache()
+				backend_stats.add_source("response_cache", self.response_cache.stats)
+			# logs may have been written while no backend was attached
+			self.response_cache.clear()
+			if self.in_process and importlib.util.find_spec("dbussy") is None:
+				logger.warning("dbussy can't be imported in the plugin process, running the backend in a subprocess")
+				self.in_process = False
+			if self.in_process:
+				await self._start_local_backend(startup_report)
+			else:
+				await self._start_backend_process(startup_report)
 			# call _main
-			await pipetalker.request("_main")
+			with startup_report.phase("backend_main"):
+				await self.proc_pipetalker.request("_main")
+			startup_report.mark("ready")
+			logger.info("startup: %s", startup_report.summary())
+			# measure event loop lag
+			if self.loop_lag_monitor is None:
+				self.loop_lag_monitor = LoopLagMonitor()
+			self.loop_lag_monitor.start()
 			logger.info("Done loading Battery Analytics plugin")
 		except BaseException as error:
 			logger.exception(error)
 	
+	# start the backend in another process, or attach to the backend daemon, and connect a pipetalker to it
+	#  restart_stale_daemon: restart a daemon that was started from other backend files, like before an update
+	async def _start_backend_process(self, startup_report: StartupReport, restart_stale_daemon: bool = True):
+		backend_path = PLUGIN_DIR+"/backend"
+		procenv = os.environ.copy()
+		procenv["PYTHONPATH"] = ":".join(PYTHON_PATHS)
+		if self.use_daemon:
+			# connect to the backend daemon
+			with startup_report.phase("daemon_connect"):
+				(reader, writer) = await self._attach_daemon(backend_path, procenv)
+		else:
+			# start child process
+			logger.info("starting subprocess "+backend_path)
+			with startup_report.phase("spawn"):
+				proc = subprocess.Popen(
+					["python3", backend_path],
+					env=procenv,
+					stdin=subprocess.PIPE,
+					stdout=subprocess.PIPE)
+			self.proc = proc
+			(reader, writer) = (proc.stdout, proc.stdin)
+		# attach backend pipetalker
+		pipetalker = PipeTalker(
+			reader = reader,
+			writer = writer,
+			request_handler = self._handle_backend_request)
+		self.proc_pipetalker = pipetalker
+		backend_stats.add_source("pipetalk", pipetalker.stats)
+		backend_stats.add_source("logging", log_pipeline.stats)
+		await pipetalker.listen_async()
+		# switch to the fastest framing, codec and compression supported by the backend
+		#  This is answered once the backend process has started up and imported its modules.
+		with startup_report.phase("backend_start_and_negotiate"):
+			framing = await pipetalker.negotiate()
+		logger.info("using %s framing, %s codec and %s compression for backend pipe", framing, pipetalker.codec, pipetalker.compression)
+		# make sure the daemon runs the same backend as this plugin
+		if self.use_daemon and restart_stale_daemon:
+			with startup_report.phase("daemon_version_check"):
+				daemon_is_current = await self._is_daemon_current(pipetalker)
+			if not daemon_is_current:
+				await self._stop_stale_daemon(pipetalker)
+				await self._start_backend_process(startup_report, restart_stale_daemon=False)
+	
+	# create the backend plugin on this event loop
+	#  The backend shares this process's stats, tracer and log file.
+	async def _start_local_backend(self, startup_report: StartupReport):
+		logger.info("starting backend in process")
+		with startup_report.phase("backend_import"):
+			backend_plugin_module = import_backend_plugin_module()
+		backend_plugin = backend_plugin_module.Plugin()
+		backend_plugin.on_data_changed = self._when_backend_data_changed
+		local_backend = LocalBackend(backend_plugin, method_lanes=backend_plugin_module.PLUGIN_METHOD_LANES)
+		self.proc_pipetalker = local_backend
+		backend_stats.add_source("local_backend", local_backend.stats)
+		backend_stats.add_source("logging", log_pipeline.stats)
+	
 	# Function called first during the unload process, utilize this to handle your plugin being removed
 	async def _unload(self):
 		logger.info("Unloading Battery Analytics plugin")
 		try:
+			if self.loop_lag_monitor is not None:
+				await self.loop_lag_monitor.stop()
 			proc_pipetalker = self.proc_pipetalker
 			proc = self.proc
+			loop = asyncio.get_running_loop()
+			deadline = loop.time() + BACKEND_UNLOAD_TIMEOUT
+			# a backend daemon only detaches the client, and keeps running
+			if proc_pipetalker is not None and (proc is not None or self.use_daemon or isinstance(proc_pipetalker, LocalBackend)):
+				try:
+					await proc_pipetalker.request("_unload", timeout=BACKEND_UNLOAD_TIMEOUT)
+				except BaseException as error:
+					logger.error("Error unloading backend: "+str(error))
 			if proc is not None:
-				if proc_pipetalker is not None:
-					await proc_pipetalker.request("_unload")
-				# kill child process
+				# stop child process, waiting for it to exit until the deadline
 				proc.terminate()
-				# wait for 3.5 seconds for process to die
-				for i in range(35):
-					if proc.poll() is not None:
-						break
-					await asyncio.sleep(0.1)
-				# kill process if not dead
-				if proc.poll() is None:
+				if not await wait_process_exit(proc, max(0.0, deadline - loop.time())):
+					# kill process if not dead
+					logger.warning("backend process didn't exit in time, killing it")
 					proc.kill()
+					await wait_process_exit(proc, BACKEND_KILL_TIMEOUT)
 				if self.proc is proc:
 					self.proc = None
 			# wait for pipetalker to die
-			if proc_pipetalker is not None:
+			if isinstance(proc_pipetalker, PipeTalker):
 				await proc_pipetalker.unlisten()
-				if self.proc_pipetalker is proc_pipetalker:
-					self.proc_pipetalker = None
+				backend_stats.remove_source("pipetalk")
+			elif proc_pipetalker is not None:
+				backend_stats.remove_source("local_backend")
+			if proc_pipetalker is not None and self.proc_pipetalker is proc_pipetalker:
+				self.proc_pipetalker = None
+			if self.response_cache is not None:
+				self.response_cache.clear()
 			logger.info("Done unloading Battery Analytics plugin")
 		except BaseException as error:
 			logger.exception(error)
 	
+	# connect to the backend daemon, starting it if it isn't running, and get a reader and writer for the connection
+	async def _attach_daemon(self, backend_path: str, procenv: dict):
+		sock = await connect_daemon(DAEMON_SOCKET_PATH)
+		if sock is None:
+			logger.info("starting backend daemon "+backend_path)
+			# start the daemon in its own session, so it isn't stopped along with the plugin loader's process group
+			daemon_proc = subprocess.Popen(
+				["python3", backend_path, "--daemon"],
+				env=procenv,
+				stdin=subprocess.DEVNULL,
+				stdout=subprocess.DEVNULL,
+				stderr=subprocess.DEVNULL,
+				start_new_session=True)
+			self.daemon_proc = daemon_proc
+			self._daemon_reap_task = asyncio.create_task(self._reap_daemon(daemon_proc))
+			loop = asyncio.get_running_loop()
+			deadline = loop.time() + DAEMON_START_TIMEOUT
+			while sock is None:
+				if loop.time() >= deadline:
+					raise TimeoutError("Timed out waiting for backend daemon to start")
+				await asyncio.sleep(0.05)
+				sock = await connect_daemon(DAEMON_SOCKET_PATH)
+		else:
+			logger.info("attaching to running backend daemon")
+		return send_pipes(sock)
+	
+	# wait for a started daemon to exit, so it doesn't stay around as a zombie
+	async def _reap_daemon(self, daemon_proc: subprocess.Popen):
+		try:
+			await wait_process_exit(daemon_proc)
+			logger.info("backend daemon exited with code "+str(daemon_proc.returncode))
+		except BaseException as error:
+			logger.error("Error waiting for backend daemon: "+str(error))
+		finally:
+			if self.daemon_proc is daemon_proc:
+				self.daemon_proc = None
+	
+	# check if the attached daemon was started from the same backend files as this plugin
+	async def _is_daemon_current(self, pipetalker: PipeTalker) -> bool:
+		try:
+			daemon_info = await pipetalker.request("get_daemon_version", timeout=DAEMON_START_TIMEOUT)
+		except BaseException as error:
+			# daemons that predate version checks don't have the method
+			logger.warning("Couldn't get backend daemon version: "+str(error))
+			return False
+		backend_version = await asyncio.get_running_loop().run_in_executor(None, get_backend_version, PLUGIN_DIR+"/backend")
+		daemon_version = daemon_info.get("version", None) if isinstance(daemon_info, dict) else None
+		if daemon_version != backend_version:
+			logger.info("backend daemon version %s doesn't match backend version %s", daemon_version, backend_version)
+			return False
+		return True
+	
+	# stop a daemon running other backend files, and wait for it to exit
+	async def _stop_stale_daemon(self, pipetalker: PipeTalker):
+		logger.info("restarting backend daemon")
+		try:
+			await pipetalker.request("stop_daemon", timeout=DAEMON_START_TIMEOUT)
+		except BaseException as error:
+			logger.error("Error stopping backend daemon: "+str(error))
+		await pipetalker.unlisten()
+		backend_stats.remove_source("pipetalk")
+		if self.proc_pipetalker is pipetalker:
+			self.proc_pipetalker = None
+		# the daemon holds its lock until it has unloaded its plugin
+		lock = DaemonLock(DAEMON_LOCK_PATH)
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + DAEMON_START_TIMEOUT
+		while lock.is_held():
+			if loop.time() >= deadline:
+				raise TimeoutError("Timed out waiting for backend daemon to stop")
+			await asyncio.sleep(0.05)
+	
+	# stop the backend daemon, which is otherwise left running when the plugin is unloaded
+	async def stop_backend_daemon(self):
+		try:
+			proc_pipetalker = self.proc_pipetalker
+			if proc_pipetalker is None or not self.use_daemon:
+				raise RuntimeError("Not attached to a backend daemon")
+			await proc_pipetalker.request("stop_daemon", timeout=BACKEND_QUERY_TIMEOUT)
+		except BaseException as error:
+			logger.exception(error)
+	
 	async def get_battery_state_logs(self, **kwargs):
 		try:
 			proc_pipetalker = self.proc_pipetalker
 			if proc_pipetalker is None:
 				raise RuntimeError("No process pipetalker available")
-			return await proc_pipetalker.request("get_battery_state_logs", kwargs)
+			return await self._cached_query("get_battery_state_logs", kwargs, lambda args:self._stream_battery_state_logs(proc_pipetalker, args))
+		except BaseException as error:
+			logger.exception(error)
+	
+	# stream the logs so the backend never holds the whole result set at once
+	async def _stream_battery_state_logs(self, proc_pipetalker: PipeTalker, kwargs: dict) -> list:
+		with tracer.trace("main.get_battery_state_logs"):
+			logs = list()
+			async for logs_chunk in proc_pipetalker.stream("stream_battery_state_logs", kwargs, timeout=BACKEND_QUERY_TIMEOUT):
+				logs.extend(logs_chunk)
+			return logs
+	
+	# call multiple backend methods in a single request
+	#  calls: [{"method": "get_battery_state_logs", "args": {...}}, ...]
+	#  returns [{"result": ...} or {"error": "message"}, ...] in the same order as the calls
+	async def call_batch(self, calls: list):
+		try:
+			proc_pipetalker = self.proc_pipetalker
+			if proc_pipetalker is None:
+				raise RuntimeError("No process pipetalker available")
+			batch_calls = list()
+			for call in calls:
+				method_name = call["method"]
+				if method_name.startswith("_"):
+					raise ValueError("Cannot call private method "+method_name+" in a batch")
+				batch_calls.append((method_name, call.get("args", None) or dict()))
+			responses = await proc_pipetalker.batch(batch_calls, timeout=BACKEND_QUERY_TIMEOUT)
+			results = list()
+			for res in responses:
+				error = res.get_error()
+				if error is not None:
+					results.append({"error": getattr(error, "message", None) or str(error)})
+				else:
+					results.append({"result": res.get_result_data()})
+			return results
 		except BaseException as error:
 			logger.exception(error)
 	
@@ -106,6 +347,96 @@ class Plugin:
 			proc_pipetalker = self.proc_pipetalker
 			if proc_pipetalker is None:
 				raise RuntimeError("No process pipetalker available")
-			return await proc_pipetalker.request("get_system_event_logs", kwargs)
+			return await self._cached_query("get_system_event_logs", kwargs, lambda args:proc_pipetalker.request("get_system_event_logs", args, timeout=BACKEND_QUERY_TIMEOUT))
+		except BaseException as error:
+			logger.exception(error)
+	
+	# get the result of a backend query from the response cache, or fetch it with the given arguments if it isn't cached
+	#  Identical queries that arrive while one is being fetched wait for the same result. Queries are fetched with
+	#  their times rounded like the cache rounds them, so every caller sharing a result gets the same result.
+	async def _cached_query(self, method_name: str, kwargs: dict, fetch: Callable[[dict],Awaitable[Any]]) -> Any:
+		response_cache = self.response_cache
+		if response_cache is None:
+			return await fetch(kwargs)
+		kwargs = response_cache.round_time_args(kwargs)
+		return await response_cache.get(method_name, kwargs, lambda:fetch(kwargs), table_name=CACHED_QUERY_TABLES[method_name])
+	
+	# handle a request sent by the backend
+	async def _handle_backend_request(self, req: PipeTalkRequest) -> PipeTalkData:
+		if req.method_name == "data_changed":
+			self._when_backend_data_changed(req.get_data())
+			return None
+		raise ValueError("Unknown backend request "+req.method_name)
+	
+	# drop cached query results that were read from logs the backend has since written
+	#  changes: {table_name: [since, until]} with ISO 8601 times
+	def _when_backend_data_changed(self, changes: dict):
+		response_cache = self.response_cache
+		if response_cache is None or not isinstance(changes, dict):
+			return
+		for (table_name, (since, until)) in changes.items():
+			response_cache.invalidate(table_name, parse_cache_time(since), parse_cache_time(until))
+	
+	# latency histograms, counters and queue depths of the backend process and of this side of the pipe
+	async def get_backend_stats(self):
+		try:
+			proc_pipetalker = self.proc_pipetalker
+			if proc_pipetalker is None:
+				raise RuntimeError("No process pipetalker available")
+			return {
+				"backend": await proc_pipetalker.request("get_backend_stats", timeout=BACKEND_QUERY_TIMEOUT),
+				"main": backend_stats.to_dict()
+			}
+		except BaseException as error:
+			logger.exception(error)
+	
+	# write the spans of recent traced requests from both processes to a Chrome trace_event JSON file in the data directory
+	#  returns the path of the written file
+	async def dump_traces(self):
+		try:
+			proc_pipetalker = self.proc_pipetalker
+			if proc_pipetalker is None:
+				raise RuntimeError("No process pipetalker available")
+			# an in process backend records its spans in this process's tracer
+			events = tracer.trace_events() if isinstance(proc_pipetalker, PipeTalker) else None
+			return await proc_pipetalker.request("dump_traces", {"events": events}, timeout=BACKEND_QUERY_TIMEOUT)
+		except BaseException as error:
+			logger.exception(error)
+	
+	# profile CPU time and memory allocations of the backend process, returning the paths of the written files
+	#  see the backend Plugin.profile for the options
+	async def profile_backend(self, seconds: float = 30, mode: str = "sample", trace_memory: bool = True):
+		try:
+			proc_pipetalker = self.proc_pipetalker
+			if proc_pipetalker is None:
+				raise RuntimeError("No process pipetalker available")
+			return await proc_pipetalker.request("profile", {
+				"seconds": seconds,
+				"mode": mode,
+				"trace_memory": trace_memory
+			}, timeout=seconds+BACKEND_QUERY_TIMEOUT)
+		except BaseException as error:
+			logger.exception(error)
+	
+	# start or stop recording the raw upower monitor output of the backend, returning the path of the recording
+	async def record_monitor(self, enabled: bool = True):
+		try:
+			proc_pipetalker = self.proc_pipetalker
+			if proc_pipetalker is None:
+				raise RuntimeError("No process pipetalker available")
+			return await proc_pipetalker.request("record_monitor", {"enabled": enabled}, timeout=BACKEND_QUERY_TIMEOUT)
+		except BaseException as error:
+			logger.exception(error)
+	
+	# durations of the startup phases of this process and the backend process
+	async def get_startup_report(self):
+		try:
+			proc_pipetalker = self.proc_pipetalker
+			if proc_pipetalker is None:
+				raise RuntimeError("No process pipetalker available")
+			return {
+				"main": self.startup_report.to_dict() if self.startup_report is not None else None,
+				"backend": await proc_pipetalker.request("get_startup_report", timeout=BACKEND_QUERY_TIMEOUT)
+			}
 		except BaseException as error:
 			logger.exception(error)
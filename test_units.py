@@ -0,0 +1,1729 @@
+#!/usr/bin/env python3
+
+# Behavior checks for the backend logic that doesn't need upower, decky or a running plugin
+#  run with: python3 -m unittest test_units
+
+import os
+import sys
+import math
+import time
+import json
+import asyncio
+import datetime
+import types
+import queue
+import logging
+import subprocess
+import threading
+import tempfile
+import pstats
+import tracemalloc
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from power_history import PowerHistoryDB, BatteryStateLog, SystemEventTypes, tzinfo_utc
+from ingest_compressor import BatteryLogCompressor, DEFAULT_FIELD_TOLERANCES
+from upower_monitor import UPowerDeviceInfo, UPowerMonitor, BatteryChanges, MONITOR_RECORD_PATH_ENV
+from sampling_scheduler import AdaptiveSampler, read_power_supply_info
+from pipetalk import PipeTalker, RequestLane, PIPE_BUFFER_SIZE, LANE_BULK, DEFAULT_LANE_LIMITS, PipeTalkMessageReader, PipeTalkRequest, PipeTalkResponse, PipeTalkCancel, PipeTalkRequestError, FRAMING_TEXT, FRAMING_BINARY, BATCH_METHOD
+from pipetalk_compression import PayloadCompressor, ZlibCompression, FRAME_FLAG_ZLIB, COMPRESSION_ZLIB
+from pipetalk_shm import SharedMemoryChannel
+from pipetalk_codec import PipeTalkCodec, to_plain_data, get_codec, SUPPORTED_CODECS, CODEC_JSON
+import pipetalk_codec
+import pipetalk as pipetalk_module
+from local_backend import LocalBackend
+from response_cache import ResponseCache
+import pipetalk_shm
+from daemon import DaemonLock, get_backend_version
+from tracing import Tracer, tracer, current_trace_id, write_trace_file
+from backend_stats import LatencyHistogram, BackendStats, backend_stats, startup_report, process_stats
+from utils import SerialThreadExecutor
+import backend_stats as backend_stats_module
+from profiler import StackSampler, ProfilingSession, PROFILE_MODE_SAMPLE, PROFILE_MODE_CPROFILE
+from log_pipeline import LogPipeline, BoundedQueueHandler
+from plugin import Plugin
+import plugin as plugin_module
+
+DEVICE_PATH = "/org/freedesktop/UPower/devices/battery_BAT1"
+START_TIME = datetime.datetime(2024, 1, 1, 12, 0, 0, tzinfo=tzinfo_utc)
+
+def make_log(seconds: float, energy_Wh: float, state: str = "discharging", device_path: str = DEVICE_PATH) -> BatteryStateLog:
+	return BatteryStateLog(
+		device_path = device_path,
+		time = START_TIME + datetime.timedelta(seconds=seconds),
+		state = state,
+		energy_Wh = energy_Wh,
+		energy_empty_Wh = 0.0,
+		energy_full_Wh = 40.0,
+		energy_full_design_Wh = 40.0,
+		energy_rate_W = 10.0,
+		voltage_V = 8.0,
+		seconds_till_full = None,
+		seconds_till_empty = 3600.0,
+		percent_current = energy_Wh / 40.0 * 100.0,
+		percent_capacity = 100.0)
+
+def log_seconds(log: BatteryStateLog) -> float:
+	return (log.time - START_TIME).total_seconds()
+
+# get the value of a field at a time by interpolating between the kept logs
+def interpolate(kept_logs, field: str, seconds: float) -> float:
+	for (log_a, log_b) in zip(kept_logs, kept_logs[1:]):
+		(time_a, time_b) = (log_seconds(log_a), log_seconds(log_b))
+		if time_a <= seconds <= time_b:
+			if time_b == time_a:
+				return getattr(log_b, field)
+			ratio = (seconds - time_a) / (time_b - time_a)
+			return getattr(log_a, field) + (getattr(log_b, field) - getattr(log_a, field)) * ratio
+	raise ValueError("no kept logs around "+str(seconds))
+
+def make_device_info(energy_Wh: float, state: str = "discharging") -> UPowerDeviceInfo:
+	return UPowerDeviceInfo({
+		"native-path": "BAT1",
+		"battery": {
+			"state": state,
+			"energy": str(energy_Wh)+" Wh",
+			"energy-empty": "0 Wh",
+			"energy-full": "40 Wh",
+			"energy-full-design": "40 Wh",
+			"energy-rate": "10 W",
+			"voltage": "8 V",
+			"percentage": str(energy_Wh / 40.0 * 100.0)+"%",
+			"capacity": "100%"
+		}
+	})
+
+# convert the times of logs read from the DB to the naive times they were written with
+def normalize_log_times(stored_logs):
+	for log in stored_logs:
+		if isinstance(log.time, str):
+			log.time = datetime.datetime.fromisoformat(log.time)
+		# naive times are local times, like they are when logs are written to the DB
+		log.time = log.time.astimezone().replace(tzinfo=None)
+	return stored_logs
+
+def run_compressor(compressor: BatteryLogCompressor, logs):
+	kept_logs = list()
+	for log in logs:
+		kept_logs.extend(compressor.add(log))
+	kept_logs.extend(compressor.flush())
+	return kept_logs
+
+# a battery log row like the ones returned by queries
+def make_log_row(i: int) -> dict:
+	return {
+		'device_path': DEVICE_PATH,
+		'time': '2024-01-01 {:02d}:{:02d}:{:02d}+00:00'.format((i // 3600) % 24, (i // 60) % 60, i % 60),
+		'state': 'discharging',
+		'energy_Wh': 40.0 - (i * 0.001),
+		'energy_rate_W': 10.5,
+		'voltage_V': 8.1,
+		'percent_current': 80.0
+	}
+
+
+
+class BatteryLogCompressorTests(unittest.TestCase):
+	def test_first_log_is_kept(self):
+		compressor = BatteryLogCompressor()
+		log = make_log(0, 30.0)
+		self.assertEqual(compressor.add(log), [log])
+
+	def test_linear_series_keeps_endpoints(self):
+		compressor = BatteryLogCompressor()
+		logs = [make_log(i * 10, 30.0 - i * 0.01) for i in range(30)]
+		kept_logs = run_compressor(compressor, logs)
+		self.assertEqual(kept_logs, [logs[0], logs[-1]])
+		self.assertEqual(compressor.stats()["received"], 30)
+		self.assertEqual(compressor.stats()["kept"], 2)
+		self.assertEqual(compressor.stats()["pending"], 0)
+
+	def test_reconstruction_stays_within_tolerance(self):
+		compressor = BatteryLogCompressor()
+		logs = [make_log(i * 10, 30.0 - i * 0.01 + 0.2 * math.sin(i / 5.0)) for i in range(300)]
+		kept_logs = run_compressor(compressor, logs)
+		self.assertLess(len(kept_logs), len(logs))
+		self.assertEqual(kept_logs[0], logs[0])
+		self.assertEqual(kept_logs[-1], logs[-1])
+		tolerance = DEFAULT_FIELD_TOLERANCES["energy_Wh"]
+		for log in logs:
+			reconstructed = interpolate(kept_logs, "energy_Wh", log_seconds(log))
+			self.assertLessEqual(abs(reconstructed - log.energy_Wh), tolerance + 1e-9)
+
+	def test_state_transition_keeps_both_sides(self):
+		compressor = BatteryLogCompressor()
+		self.assertEqual(len(compressor.add(make_log(0, 30.0))), 1)
+		held = make_log(10, 29.99)
+		self.assertEqual(compressor.add(held), [])
+		charging = make_log(20, 29.98, state="charging")
+		self.assertEqual(compressor.add(charging), [held, charging])
+		self.assertEqual(compressor.flush(), [])
+
+	def test_max_interval_keeps_held_log(self):
+		compressor = BatteryLogCompressor()
+		compressor.add(make_log(0, 30.0))
+		held = make_log(300, 30.0)
+		self.assertEqual(compressor.add(held), [])
+		self.assertEqual(compressor.add(make_log(900, 30.0)), [held])
+
+	def test_flush_is_per_device(self):
+		compressor = BatteryLogCompressor()
+		other_path = DEVICE_PATH+"_other"
+		compressor.add(make_log(0, 30.0))
+		compressor.add(make_log(0, 20.0, device_path=other_path))
+		held = make_log(10, 30.0)
+		other_held = make_log(10, 20.0, device_path=other_path)
+		compressor.add(held)
+		compressor.add(other_held)
+		self.assertEqual(compressor.flush(other_path), [other_held])
+		self.assertEqual(compressor.flush(), [held])
+		self.assertEqual(compressor.flush(), [])
+
+
+
+class CompressedIngestTests(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.plugin = Plugin()
+		self.plugin.db = PowerHistoryDB(dir=self.tmp_dir.name)
+		self.plugin.ingest_compressor = BatteryLogCompressor()
+		await self.plugin.db.connect()
+
+	async def asyncTearDown(self):
+		await self.plugin.db.close()
+		self.tmp_dir.cleanup()
+
+	async def ingest(self, series):
+		for (seconds, energy_Wh) in series:
+			logtime = START_TIME + datetime.timedelta(seconds=seconds)
+			await self.plugin._log_device_info(logtime, DEVICE_PATH, make_device_info(energy_Wh), None)
+		await self.plugin._flush_ingest_compressor()
+		return normalize_log_times(await self.plugin.db.get_battery_state_logs())
+
+	async def test_segment_ending_with_unchanged_log_is_stored(self):
+		series = [(seconds, 30.0) for seconds in range(0, 541, 30)] + [(560, 35.0), (590, 35.0)]
+		stored_logs = await self.ingest(series)
+		self.assertEqual([log_seconds(log) for log in stored_logs], [0, 540, 560, 590])
+		self.assertEqual(self.plugin.db.skipped_log_count, 0)
+
+	async def test_stored_logs_stay_within_tolerance(self):
+		series = [(i * 10, 30.0 - i * 0.01 + 0.2 * math.sin(i / 5.0)) for i in range(200)]
+		series += [(2000 + i * 10, 28.0) for i in range(80)]
+		stored_logs = await self.ingest(series)
+		self.assertLess(len(stored_logs), len(series))
+		tolerance = DEFAULT_FIELD_TOLERANCES["energy_Wh"]
+		for (seconds, energy_Wh) in series:
+			reconstructed = interpolate(stored_logs, "energy_Wh", seconds)
+			self.assertLessEqual(abs(reconstructed - energy_Wh), tolerance + 1e-9)
+
+
+
+class BatteryChangesTests(unittest.TestCase):
+	def make_info(self) -> UPowerDeviceInfo:
+		return UPowerDeviceInfo({
+			"native-path": "BAT1",
+			"updated": "Mon 01 Jan 2024 12:00:00 PM UTC",
+			"battery": {
+				"state": "discharging",
+				"energy": "30 Wh",
+				"percentage": "75%"
+			}
+		})
+
+	def test_no_changes(self):
+		info = self.make_info()
+		self.assertEqual(info.get_changes(self.make_info()), BatteryChanges.NONE)
+
+	def test_ignored_keys(self):
+		info = self.make_info()
+		patch = UPowerDeviceInfo({"updated": "Mon 01 Jan 2024 12:00:10 PM UTC"})
+		self.assertEqual(info.get_changes(patch), BatteryChanges.NONE)
+
+	def test_battery_keys_map_to_flags(self):
+		info = self.make_info()
+		patch = UPowerDeviceInfo({"battery": {"energy": "29.9 Wh", "percentage": "75%"}})
+		self.assertEqual(info.get_changes(patch), BatteryChanges.ENERGY)
+		patch = UPowerDeviceInfo({"battery": {"state": "charging", "percentage": "76%"}})
+		self.assertEqual(info.get_changes(patch), BatteryChanges.STATE | BatteryChanges.PERCENT_CURRENT)
+
+	def test_other_keys(self):
+		info = self.make_info()
+		patch = UPowerDeviceInfo({"native-path": "BAT2", "battery": {"warning-level": "low"}})
+		changes = info.get_changes(patch)
+		self.assertEqual(changes, BatteryChanges.OTHER)
+		self.assertFalse(changes & BatteryChanges.BATTERY)
+
+	def test_none_values_never_change(self):
+		info = self.make_info()
+
+
+
+class UnchangedUpdateTests(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.db = PowerHistoryDB(dir=self.tmp_dir.name)
+		await self.db.connect()
+
+	async def asyncTearDown(self):
+		await self.db.close()
+		self.tmp_dir.cleanup()
+
+	async def get_logged_seconds(self):
+		return [log_seconds(log) for log in normalize_log_times(await self.db.get_battery_state_logs())]
+
+	async def test_monitor_suppresses_unchanged_updates(self):
+		monitor = UPowerMonitor()
+		monitor.device_infos = dict()
+		updates = list()
+		monitor.when_device_updated = lambda logtime, device_path, device_info, changes: updates.append(changes)
+		monitor.update_device_info(START_TIME, DEVICE_PATH, make_device_info(30.0))
+		monitor.update_device_info(START_TIME, DEVICE_PATH, make_device_info(30.0))
+		monitor.update_device_info(START_TIME, DEVICE_PATH, make_device_info(29.0))
+		self.assertEqual(updates, [BatteryChanges.ALL, BatteryChanges.ENERGY | BatteryChanges.PERCENT_CURRENT])
+
+	async def test_concurrent_identical_logs_are_written_once(self):
+		await asyncio.gather(self.db.log_battery_state(make_log(0, 30.0)), self.db.log_battery_state(make_log(10, 30.0)))
+		self.assertEqual(await self.get_logged_seconds(), [0])
+		self.assertEqual(self.db.skipped_log_count, 1)
+
+	async def test_failed_write_does_not_skip_next_log(self):
+		await self.db.log_battery_state(make_log(0, 30.0))
+		failing_log = make_log(10, 29.0)
+		failing_log.state = None
+		with self.assertRaises(Exception):
+			await self.db.log_battery_state(failing_log)
+		await self.db.log_battery_state(make_log(20, 29.0))
+		self.assertEqual(await self.get_logged_seconds(), [0, 20])
+
+	async def test_heartbeat_logs_unchanged_battery(self):
+		plugin = Plugin()
+		plugin.db = self.db
+		plugin.monitor = types.SimpleNamespace(device_infos={DEVICE_PATH: make_device_info(30.0)})
+		last_logtime = datetime.datetime.utcnow() - datetime.timedelta(minutes=11)
+		await self.db.log_device_info(last_logtime, DEVICE_PATH, make_device_info(30.0))
+		with unittest.mock.patch.object(plugin_module, "LOG_HEARTBEAT_INTERVAL", 0.001):
+			heartbeat_task = asyncio.create_task(plugin._log_heartbeats())
+			await asyncio.sleep(0.05)
+			heartbeat_task.cancel()
+			await asyncio.wait([heartbeat_task])
+		# the first heartbeat is written, and the rest are skipped until the heartbeat log is old enough
+		self.assertEqual(len(await self.db.get_battery_state_logs()), 2)
+		self.assertGreater(self.db.skipped_log_count, 0)
+
+
+
+class MonitorRecordPathTests(unittest.IsolatedAsyncioTestCase):
+	async def test_environment_is_read_when_monitor_starts(self):
+		monitor = UPowerMonitor()
+		with unittest.mock.patch.dict(os.environ, {MONITOR_RECORD_PATH_ENV: "/tmp/recording.txt"}):
+			self.assertEqual(monitor.get_record_path(), "/tmp/recording.txt")
+			monitor.record_path = "/tmp/other.txt"
+			self.assertEqual(monitor.get_record_path(), "/tmp/other.txt")
+		with unittest.mock.patch.dict(os.environ, clear=True):
+			self.assertIsNone(UPowerMonitor().get_record_path())
+
+	async def test_record_monitor_applies_to_later_monitor(self):
+		with tempfile.TemporaryDirectory() as tmp_dir, \
+			unittest.mock.patch.object(plugin_module, "RECORDINGS_DIR", tmp_dir), \
+			unittest.mock.patch.dict(os.environ, clear=True):
+			plugin = Plugin()
+			record_path = await plugin.record_monitor(True)
+			self.assertTrue(record_path.startswith(tmp_dir+"/"))
+			self.assertEqual(UPowerMonitor().get_record_path(), record_path)
+			self.assertIsNone(await plugin.record_monitor(False))
+			self.assertIsNone(UPowerMonitor().get_record_path())
+
+
+
+class AdaptiveSamplerTests(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		os.mkdir(self.tmp_dir.name+"/BAT1")
+		self.monitor = UPowerMonitor()
+		info = make_device_info(30.0)
+		info.info["native-path"] = "BAT1"
+		self.monitor.device_infos = {DEVICE_PATH: info}
+		self.updates = list()
+		self.monitor.when_device_updated = lambda logtime, device_path, device_info, changes: self.updates.append(device_info.battery_info.energy_Wh)
+		self.sampler = AdaptiveSampler(self.monitor)
+		self.sampler.power_supply_dir = self.tmp_dir.name
+
+	async def asyncTearDown(self):
+		self.tmp_dir.cleanup()
+
+	def write_uevent(self, props: dict):
+		with open(self.tmp_dir.name+"/BAT1/uevent", "w") as uevent_file:
+			for (key, val) in props.items():
+				uevent_file.write("POWER_SUPPLY_"+key+"="+str(val)+"\n")
+
+	def test_reads_energy_values(self):
+		self.write_uevent({"STATUS": "Discharging", "ENERGY_NOW": 29500000, "ENERGY_FULL": 40000000, "ENERGY_FULL_DESIGN": 50000000, "POWER_NOW": 9800000, "VOLTAGE_NOW": 8100000})
+		batt_info = read_power_supply_info(self.tmp_dir.name+"/BAT1").battery_info
+		self.assertEqual(batt_info.state, "discharging")
+		self.assertAlmostEqual(batt_info.energy_Wh, 29.5)
+		self.assertAlmostEqual(batt_info.energy_rate_W, 9.8)
+		self.assertAlmostEqual(batt_info.voltage_V, 8.1)
+		self.assertAlmostEqual(batt_info.percent_current, 73.8)
+		self.assertAlmostEqual(batt_info.percent_capacity, 80.0)
+
+	def test_converts_charge_with_design_voltage(self):
+		self.write_uevent({"STATUS": "Charging", "CHARGE_NOW": 4000000, "CHARGE_FULL": 5000000, "CURRENT_NOW": -1500000, "VOLTAGE_NOW": 8300000, "VOLTAGE_MIN_DESIGN": 7700000})
+		batt_info = read_power_supply_info(self.tmp_dir.name+"/BAT1").battery_info
+		self.assertEqual(batt_info.state, "charging")
+		self.assertAlmostEqual(batt_info.energy_Wh, 30.8)
+		self.assertAlmostEqual(batt_info.energy_full_Wh, 38.5)
+		self.assertAlmostEqual(batt_info.energy_rate_W, 11.55)
+
+	async def test_polls_fresher_values_than_upower(self):
+		# upower's cached info stays at 30 Wh, while the fuel gauge keeps moving
+		for energy_uWh in (29990000, 29980000, 29980000, 29970000):
+			self.write_uevent({"STATUS": "Discharging", "ENERGY_NOW": energy_uWh, "ENERGY_FULL": 40000000})
+			await self.sampler._poll_device(DEVICE_PATH)
+		# the unchanged read is suppressed by the monitor
+		self.assertEqual(self.updates, [29.99, 29.98, 29.97])
+		self.assertEqual(self.sampler.poll_count, 4)
+
+	async def test_devices_without_power_supply_are_not_polled(self):
+		self.monitor.device_infos[DEVICE_PATH].info["native-path"] = "BAT2"
+		self.sampler.observe(DEVICE_PATH, self.monitor.device_infos[DEVICE_PATH])
+		await self.sampler._poll_device(DEVICE_PATH)
+		self.assertEqual(self.updates, [])
+		self.assertEqual(self.sampler.poll_count, 0)
+		self.assertEqual(self.sampler.stats()["intervals"][DEVICE_PATH], self.sampler.max_interval)
+
+
+
+class PipeTalkMessageReaderTests(unittest.TestCase):
+	def test_text_lines_split_across_feeds(self):
+		reader = PipeTalkMessageReader(initial_size=16)
+		line = PipeTalkRequest.create("1", "get_value", {"a": 1}).stringify() + "\n\n"
+		line += PipeTalkResponse.from_result_data("1", [1, 2, 3]).stringify() + "\n"
+		messages = list()
+		for char in line.encode('utf8'):
+			reader.feed(bytes((char,)))
+			msg = reader.next_message()
+			while msg is not None:
+				messages.append(msg)
+				msg = reader.next_message()
+		self.assertEqual(len(messages), 2)
+		self.assertIsInstance(messages[0], PipeTalkRequest)
+		self.assertEqual(messages[0].method_name, "get_value")
+		self.assertEqual(messages[0].get_data(), {"a": 1})
+		self.assertIsInstance(messages[1], PipeTalkResponse)
+		self.assertEqual(messages[1].get_result_data(), [1, 2, 3])
+
+	def test_binary_frames_split_across_feeds(self):
+		reader = PipeTalkMessageReader(initial_size=16)
+		reader.framing = FRAMING_BINARY
+		data = b"".join((
+			PipeTalkRequest.create("7", "get_value", {"text": "x" * 100}).to_frame(),
+			PipeTalkCancel(request_id="7").to_frame(),
+			PipeTalkResponse.from_result_data("7", "done").to_frame()))
+		messages = list()
+		for offset in range(0, len(data), 5):
+			reader.feed(data[offset:offset+5])
+			msg = reader.next_message()
+			while msg is not None:
+				messages.append(msg)
+				msg = reader.next_message()
+		self.assertEqual([type(msg) for msg in messages], [PipeTalkRequest, PipeTalkCancel, PipeTalkResponse])
+		self.assertEqual(messages[0].request_id, "7")
+		self.assertEqual(messages[0].get_data(), {"text": "x" * 100})
+		self.assertEqual(messages[2].get_result_data(), "done")
+
+	def test_incomplete_frame_waits_for_more_bytes(self):
+		reader = PipeTalkMessageReader()
+		reader.framing = FRAMING_BINARY
+		frame = PipeTalkRequest.create("3", "get_value", [1]).to_frame()
+		reader.feed(frame[:-1])
+
+	def test_framing_switch_parses_buffered_bytes(self):
+		reader = PipeTalkMessageReader()
+		line = (PipeTalkResponse.from_result_data("1", "text").stringify()+"\n").encode('utf8')
+		frame = PipeTalkResponse.from_result_data("2", "binary").to_frame()
+		reader.feed(line + frame)
+		self.assertEqual(reader.next_message().get_result_data(), "text")
+		reader.framing = FRAMING_BINARY
+		self.assertEqual(reader.next_message().get_result_data(), "binary")
+		self.assertIsNone(reader.next_message())
+
+
+
+class PipeTalkerTestCase(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.talkers = list()
+
+	async def asyncTearDown(self):
+		for talker in self.talkers:
+			await talker.unlisten()
+			for pipe_file in (talker.reader, talker.writer):
+				if not pipe_file.closed:
+					pipe_file.close()
+
+	# connect a client to a server that handles requests with the given handler, over a pair of pipes
+	async def connect(self, request_handler, negotiate: bool = True, threaded: bool = False, **negotiate_options):
+		(req_reader_fd, req_writer_fd) = os.pipe()
+		(res_reader_fd, res_writer_fd) = os.pipe()
+		server = PipeTalker(
+			reader = open(req_reader_fd, 'rb'),
+			writer = open(res_writer_fd, 'wb'),
+			request_handler = request_handler)
+		client = PipeTalker(
+			reader = open(res_reader_fd, 'rb'),
+			writer = open(req_writer_fd, 'wb'))
+		self.talkers.extend((client, server))
+		if threaded:
+			server.listen()
+			client.listen()
+		else:
+			await server.listen_async()
+			await client.listen_async()
+		if negotiate:
+			await client.negotiate(**negotiate_options)
+		return (client, server)
+
+	# wait for an event without hanging the test if it never happens
+	async def wait_for_event(self, event: asyncio.Event):
+		await asyncio.wait_for(event.wait(), 5)
+
+
+
+class RequestMultiplexingTests(PipeTalkerTestCase):
+	async def asyncSetUp(self):
+		await super().asyncSetUp()
+		self.handler_started = asyncio.Event()
+		self.handler_cancelled = asyncio.Event()
+
+	async def handle_request(self, req: PipeTalkRequest):
+		if req.method_name == "echo_after":
+			(delay, value) = req.get_data()
+			await asyncio.sleep(delay)
+			return value
+		elif req.method_name == "wait_forever":
+			self.handler_started.set()
+			try:
+				await asyncio.Event().wait()
+			except asyncio.CancelledError:
+				self.handler_cancelled.set()
+				raise
+		raise ValueError("Unknown method "+req.method_name)
+
+	async def test_responses_are_matched_to_requests(self):
+		(client, server) = await self.connect(self.handle_request)
+		results = await asyncio.gather(*(client.request("echo_after", [(5 - i) * 0.01, i]) for i in range(5)))
+		self.assertEqual(results, [0, 1, 2, 3, 4])
+		self.assertEqual(len(client._waiting_requests), 0)
+
+	async def test_error_response(self):
+		(client, server) = await self.connect(self.handle_request)
+		with self.assertRaises(PipeTalkRequestError) as raised:
+			await client.request("missing")
+		self.assertEqual(raised.exception.message, "ValueError('Unknown method missing')")
+
+	async def test_timeout_cancels_handler(self):
+		(client, server) = await self.connect(self.handle_request)
+		with self.assertRaises(asyncio.TimeoutError):
+			await client.request("wait_forever", timeout=0.05)
+		await self.wait_for_event(self.handler_cancelled)
+		self.assertEqual(len(client._waiting_requests), 0)
+		# the connection is still usable
+		self.assertEqual(await client.request("echo_after", [0, "ok"]), "ok")
+
+	async def test_cancelled_caller_cancels_handler(self):
+		(client, server) = await self.connect(self.handle_request)
+		request_task = asyncio.create_task(client.request("wait_forever"))
+		await self.wait_for_event(self.handler_started)
+		request_task.cancel()
+		with self.assertRaises(asyncio.CancelledError):
+			await request_task
+		await self.wait_for_event(self.handler_cancelled)
+		self.assertEqual(len(server._running_requests), 0)
+
+	async def test_state_is_per_instance(self):
+		(client_a, server_a) = await self.connect(self.handle_request)
+		(client_b, server_b) = await self.connect(self.handle_request)
+		request_task = asyncio.create_task(client_a.request("echo_after", [0.05, "a"]))
+		await asyncio.sleep(0)
+		self.assertEqual(len(client_a._waiting_requests), 1)
+		self.assertEqual(len(client_b._waiting_requests), 0)
+		self.assertEqual(await client_b.request("echo_after", [0, "b"]), "b")
+		self.assertEqual(await request_task, "a")
+
+
+
+class BatchRequestTests(PipeTalkerTestCase):
+	async def asyncSetUp(self):
+		await super().asyncSetUp()
+		self.handled_methods = list()
+
+	async def handle_request(self, req: PipeTalkRequest):
+		self.handled_methods.append(req.method_name)
+		if req.method_name == "double":
+			return req.get_data() * 2
+		raise ValueError("Unknown method "+req.method_name)
+
+	async def test_responses_are_in_call_order(self):
+		(client, server) = await self.connect(self.handle_request)
+		responses = await client.batch([("double", 1), ("double", 2), ("double", 3)])
+		self.assertEqual([res.get_result_data() for res in responses], [2, 4, 6])
+
+	async def test_partial_failure(self):
+		(client, server) = await self.connect(self.handle_request)
+		responses = await client.batch([("double", 1), ("missing", None), ("double", 3)])
+		self.assertEqual(responses[0].get_result_data(), 2)
+		self.assertIsNone(responses[0].get_error())
+		self.assertIsInstance(responses[1].get_error(), PipeTalkRequestError)
+		self.assertEqual(responses[1].get_error().message, "ValueError('Unknown method missing')")
+		self.assertEqual(responses[2].get_result_data(), 6)
+
+	async def test_invalid_call_fails_whole_batch(self):
+		(client, server) = await self.connect(self.handle_request)
+		res = await client._send_request_with_id(client._get_next_request_id(), BATCH_METHOD, [["double", 1], [2]])
+		self.assertIn("Invalid call at index 1 of batch request", res.get_error().message)
+		# no call is handled when any call is invalid
+		self.assertEqual(self.handled_methods, [])
+
+	async def test_empty_batch(self):
+		(client, server) = await self.connect(self.handle_request)
+		self.assertEqual(await client.batch([]), [])
+
+
+
+class PayloadCompressorTests(unittest.TestCase):
+	def make_compressor(self) -> PayloadCompressor:
+		compressor = PayloadCompressor(ZlibCompression())
+		compressor.size_threshold = 1024
+		# make compressing always look worth it, so the skipping doesn't depend on the speed of this machine
+		compressor.transfer_bytes_per_second = 1.0
+		return compressor
+
+	# text that zlib can only compress to about half its size
+	def make_half_compressible_payload(self) -> bytes:
+		return os.urandom(50000).hex().encode('utf8')
+
+	def test_round_trip(self):
+		compressor = self.make_compressor()
+		payload = b'{"rows":[' + b'{"energy":30.0},' * 1000 + b']}'
+		(flags, compressed) = compressor.compress(payload)
+		self.assertEqual(flags, FRAME_FLAG_ZLIB)
+		self.assertLess(len(compressed), len(payload))
+		self.assertEqual(bytes(compressor.decompress(flags, compressed)), payload)
+		self.assertEqual(compressor.stats.bytes_in, len(payload))
+		self.assertEqual(compressor.stats.bytes_out, len(compressed))
+
+	def test_small_payloads_are_not_compressed(self):
+		compressor = self.make_compressor()
+		payload = b"a" * 1023
+		self.assertEqual(compressor.compress(payload), (0, payload))
+		self.assertEqual(compressor.stats.compressed_count, 0)
+
+	def test_incompressible_payloads_are_sent_as_is(self):
+		compressor = self.make_compressor()
+		payload = os.urandom(4096)
+		self.assertEqual(compressor.compress(payload), (0, payload))
+
+	def test_no_compression_only_decompresses(self):
+		payload = b"b" * 100000
+		(flags, compressed) = self.make_compressor().compress(payload)
+		compressor = PayloadCompressor()
+		self.assertEqual(compressor.compress(payload), (0, payload))
+		self.assertEqual(bytes(compressor.decompress(flags, compressed)), payload)
+		self.assertEqual(compressor.decompress(0, payload), payload)
+
+	def test_skips_after_compressing_is_not_worth_it(self):
+		compressor = self.make_compressor()
+		compressor.transfer_bytes_per_second = 1e18
+		payload = self.make_half_compressible_payload()
+		self.assertEqual(compressor.compress(payload)[0], FRAME_FLAG_ZLIB)
+		for _ in range(compressor.min_skip_count):
+			self.assertEqual(compressor.compress(payload), (0, payload))
+		self.assertEqual(compressor.stats.skipped_count, compressor.min_skip_count)
+		self.assertEqual(compressor.compress(payload)[0], FRAME_FLAG_ZLIB)
+
+	def test_highly_compressible_payloads_are_always_compressed(self):
+		compressor = PayloadCompressor(ZlibCompression())
+		compressor.transfer_bytes_per_second = 1e18
+		payload = json.dumps([make_log_row(i) for i in range(5000)]).encode('utf8')
+		for _ in range(compressor.min_skip_count + 1):
+			(flags, compressed) = compressor.compress(payload)
+			self.assertEqual(flags, FRAME_FLAG_ZLIB)
+			self.assertLess(len(compressed), len(payload) * compressor.ratio_threshold)
+		self.assertEqual(compressor.stats.skipped_count, 0)
+
+	def test_transfer_speed_is_measured(self):
+		compressor = PayloadCompressor(ZlibCompression())
+		compressor.transfer_bytes_per_second = 1e18
+		# writes below the size threshold don't take long enough to measure
+		compressor.record_transfer(compressor.size_threshold - 1, 1.0)
+		self.assertEqual(compressor.transfer_bytes_per_second, 1e18)
+		# a slow pipe makes compressing moderately compressible payloads worth it
+		for _ in range(200):
+			compressor.record_transfer(1000000, 1.0)
+		self.assertAlmostEqual(compressor.transfer_bytes_per_second, 1000000, delta=1)
+		self.assertEqual(compressor.compress(self.make_half_compressible_payload())[0], FRAME_FLAG_ZLIB)
+		self.assertEqual(compressor._skip_count, 0)
+
+	def test_unknown_flag(self):
+		with self.assertRaises(ValueError):
+			PayloadCompressor().decompress(0x03, b"data")
+
+	def test_compressed_frames(self):
+		compressor = PayloadCompressor(ZlibCompression())
+		compressor.size_threshold = 0
+		compressor.transfer_bytes_per_second = 1.0
+		reader = PipeTalkMessageReader()
+		reader.framing = FRAMING_BINARY
+		data = ["row"] * 1000
+		reader.feed(PipeTalkResponse.from_result_data("4", data).to_frame(compressor))
+		self.assertEqual(compressor.stats.compressed_count, 1)
+		self.assertEqual(reader.next_message().get_result_data(), data)
+
+
+
+class CompressedResponseTests(PipeTalkerTestCase):
+	async def handle_request(self, req: PipeTalkRequest):
+		return [make_log_row(i) for i in range(req.get_data())]
+
+	async def test_large_result_is_compressed(self):
+		(client, server) = await self.connect(self.handle_request, compressions=[COMPRESSION_ZLIB], shm=False)
+		self.assertEqual(server.compression, COMPRESSION_ZLIB)
+		rows = await client.request("get_rows", 5000)
+		self.assertEqual(rows, [make_log_row(i) for i in range(5000)])
+		self.assertEqual(server._compressor.stats.compressed_count, 1)
+		self.assertEqual(client._compressor.stats.decompressed_count, 1)
+		self.assertLess(server.written_bytes, server._compressor.stats.bytes_in * server._compressor.ratio_threshold)
+
+
+
+class StreamTests(PipeTalkerTestCase):
+	async def asyncSetUp(self):
+		await super().asyncSetUp()
+		self.generator_closed = asyncio.Event()
+
+	async def handle_request(self, req: PipeTalkRequest):
+		if req.method_name == "get_chunks":
+			return self.generate_chunks(req.get_data())
+		elif req.method_name == "get_chunks_then_fail":
+			return self.generate_chunks(req.get_data(), fail=True)
+		elif req.method_name == "get_endless_chunks":
+			return self.generate_endless_chunks()
+		elif req.method_name == "get_value":
+			return req.get_data()
+		raise ValueError("Unknown method "+req.method_name)
+
+	async def generate_endless_chunks(self):
+		try:
+			i = 0
+			while True:
+				yield [i]
+				i += 1
+				await asyncio.sleep(0.001)
+		finally:
+			self.generator_closed.set()
+
+	async def generate_chunks(self, chunk_count: int, fail: bool = False):
+		try:
+			for i in range(chunk_count):
+				# later chunks are produced faster, so they'd overtake earlier ones if they weren't ordered
+				await asyncio.sleep((chunk_count - i) * 0.002)
+				yield [i * 2, i * 2 + 1]
+			if fail:
+				raise ValueError("failed after chunks")
+		finally:
+			self.generator_closed.set()
+
+	async def test_chunks_are_in_order_until_the_end(self):
+		(client, server) = await self.connect(self.handle_request)
+		chunks = [chunk async for chunk in client.stream("get_chunks", 10)]
+		self.assertEqual(chunks, [[i * 2, i * 2 + 1] for i in range(10)])
+		self.assertEqual(len(client._waiting_requests), 0)
+		self.assertTrue(self.generator_closed.is_set())
+
+	async def test_empty_stream_ends(self):
+		(client, server) = await self.connect(self.handle_request)
+		self.assertEqual([chunk async for chunk in client.stream("get_chunks", 0)], [])
+		self.assertEqual([chunk async for chunk in client.stream("get_value", None)], [])
+
+	async def test_plain_result_is_a_single_chunk(self):
+		(client, server) = await self.connect(self.handle_request)
+		self.assertEqual([chunk async for chunk in client.stream("get_value", {"a": 1})], [{"a": 1}])
+
+	async def test_error_after_chunks(self):
+		(client, server) = await self.connect(self.handle_request)
+		chunks = list()
+		with self.assertRaises(PipeTalkRequestError) as raised:
+			async for chunk in client.stream("get_chunks_then_fail", 3):
+				chunks.append(chunk)
+		self.assertEqual(chunks, [[0, 1], [2, 3], [4, 5]])
+		self.assertEqual(raised.exception.message, "ValueError('failed after chunks')")
+
+	async def test_stopping_early_cancels_the_stream(self):
+		(client, server) = await self.connect(self.handle_request)
+		stream = client.stream("get_endless_chunks")
+		self.assertEqual(await stream.__anext__(), [0])
+		await stream.aclose()
+		await self.wait_for_event(self.generator_closed)
+		self.assertEqual(len(client._waiting_requests), 0)
+		self.assertEqual(await client.request("get_value", 1), 1)
+
+	async def test_request_joins_chunks(self):
+		(client, server) = await self.connect(self.handle_request)
+		self.assertEqual(await client.request("get_chunks", 3), [0, 1, 2, 3, 4, 5])
+
+
+
+class RequestLaneTests(unittest.IsolatedAsyncioTestCase):
+	async def test_limits_concurrent_requests(self):
+		lane = RequestLane("bulk", max_concurrent=2)
+		running = list()
+		max_running = 0
+		async def handle(index: int):
+			nonlocal max_running
+			await lane.acquire("query")
+			try:
+				running.append(index)
+				max_running = max(max_running, len(running))
+				await asyncio.sleep(0.01)
+				running.remove(index)
+			finally:
+				lane.release()
+		await asyncio.gather(*(handle(i) for i in range(6)))
+		self.assertEqual(max_running, 2)
+		self.assertEqual(lane.stats(), {
+			"max_concurrent": 2,
+			"running": 0,
+			"queued": 0,
+			"admitted": 6,
+			"queued_total": 4
+		})
+
+	async def test_round_robin_between_methods(self):
+		lane = RequestLane("bulk", max_concurrent=1)
+		await lane.acquire("first")
+		order = list()
+		async def handle(method_name: str, index: int):
+			await lane.acquire(method_name)
+			order.append((method_name, index))
+			lane.release()
+		tasks = [asyncio.create_task(handle("a", i)) for i in range(3)]
+		tasks.append(asyncio.create_task(handle("b", 0)))
+		await asyncio.sleep(0)
+		self.assertEqual(lane.queued_count, 4)
+		lane.release()
+		await asyncio.gather(*tasks)
+		self.assertEqual(order, [("a", 0), ("b", 0), ("a", 1), ("a", 2)])
+
+	async def test_cancelled_waiter_is_removed(self):
+		lane = RequestLane("bulk", max_concurrent=1)
+		await lane.acquire("first")
+		task = asyncio.create_task(lane.acquire("second"))
+		await asyncio.sleep(0)
+		self.assertEqual(lane.queued_count, 1)
+		task.cancel()
+		with self.assertRaises(asyncio.CancelledError):
+			await task
+		self.assertEqual(lane.queued_count, 0)
+		lane.release()
+		self.assertEqual(lane.running_count, 0)
+
+	async def test_raising_limit_admits_waiters(self):
+		lane = RequestLane("bulk", max_concurrent=1)
+		await lane.acquire("first")
+		task = asyncio.create_task(lane.acquire("second"))
+		await asyncio.sleep(0)
+		lane.set_max_concurrent(2)
+		await task
+
+class PipeTalkerLaneTests(PipeTalkerTestCase):
+	async def test_bulk_methods_are_limited(self):
+		running = 0
+		max_running = 0
+		async def handle_request(req: PipeTalkRequest):
+			nonlocal running, max_running
+			running += 1
+			max_running = max(max_running, running)
+			await asyncio.sleep(0.01)
+			running -= 1
+			return req.get_data()
+		(client, server) = await self.connect(handle_request)
+		server.method_lanes["get_rows"] = LANE_BULK
+		results = await asyncio.gather(*(client.request("get_rows", i) for i in range(6)))
+		self.assertEqual(results, list(range(6)))
+		self.assertEqual(max_running, DEFAULT_LANE_LIMITS[LANE_BULK])
+		self.assertEqual(server.lanes[LANE_BULK].admitted_count, 6)
+		# other methods aren't held up by the bulk lane
+		await asyncio.gather(*(client.request("get_value", i) for i in range(6)))
+		self.assertEqual(max_running, 6)
+
+
+
+class SharedMemoryTests(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		patcher = unittest.mock.patch.object(pipetalk_shm, "SHM_DIR", self.temp_dir.name)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.addCleanup(self.temp_dir.cleanup)
+
+	def create_region(self, name: str):
+		with open(os.path.join(self.temp_dir.name, name), 'wb') as region_file:
+			region_file.write(b"payload")
+
+	def get_dead_pid(self) -> int:
+		process = subprocess.Popen([sys.executable, "-c", "pass"])
+		process.wait()
+		return process.pid
+
+	def test_removes_regions_of_dead_processes(self):
+		dead_pid = self.get_dead_pid()
+		names = [
+			"pipetalk-{}-0".format(dead_pid),
+			"pipetalk-{}-1".format(dead_pid),
+			"pipetalk-{}-0".format(os.getpid()),
+			"pipetalk-{}-0".format(os.getppid()),
+			"pipetalk-other",
+			"other-{}-0".format(dead_pid)]
+		for name in names:
+			self.create_region(name)
+		self.assertEqual(pipetalk_shm.remove_stale_regions(), 2)
+		self.assertEqual(sorted(os.listdir(self.temp_dir.name)), sorted(names[2:]))
+
+	def test_keeps_regions_of_other_users(self):
+		name = "pipetalk-{}-0".format(self.get_dead_pid())
+		self.create_region(name)
+		with unittest.mock.patch.object(pipetalk_shm.os, "getuid", return_value=os.getuid() + 1):
+			self.assertEqual(pipetalk_shm.remove_stale_regions(), 0)
+		self.assertEqual(os.listdir(self.temp_dir.name), [name])
+
+	def test_missing_dir(self):
+		with unittest.mock.patch.object(pipetalk_shm, "SHM_DIR", os.path.join(self.temp_dir.name, "missing")):
+			self.assertEqual(pipetalk_shm.remove_stale_regions(), 0)
+
+	def test_acknowledged_and_unacknowledged_regions_are_removed(self):
+		sender = SharedMemoryChannel()
+		receiver = SharedMemoryChannel()
+		receiver.on_region_read = sender.reclaim
+		payload = b"x" * 100
+		self.assertEqual(receiver.receive(sender.send(payload)), payload)
+		self.assertEqual(sender.outstanding_count, 0)
+		self.assertEqual(os.listdir(self.temp_dir.name), [])
+		sender.send(payload)
+		self.assertEqual(len(os.listdir(self.temp_dir.name)), 1)
+		sender.close()
+		self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+	def test_rejects_names_outside_the_dir(self):
+		with self.assertRaises(ValueError):
+			SharedMemoryChannel().receive(b"pipetalk-1/../../etc/passwd")
+
+
+
+class PipeTalkWriterTests(PipeTalkerTestCase):
+	async def asyncSetUp(self):
+		await super().asyncSetUp()
+		self.received_values = list()
+		self.received_evt = asyncio.Event()
+
+	async def handle_request(self, req: PipeTalkRequest):
+		self.received_values.append(req.get_data())
+		self.received_evt.set()
+		return req.get_data()
+
+	async def test_queued_frames_are_joined(self):
+		for threaded in (False, True):
+			with self.subTest(threaded=threaded):
+				(client, server) = await self.connect(self.handle_request, threaded=threaded)
+				(write_count, frame_count) = (client.write_count, client.written_frame_count)
+				results = await asyncio.gather(*(client.request("echo", i) for i in range(50)))
+				self.assertEqual(results, list(range(50)))
+				self.assertEqual(client.written_frame_count - frame_count, 50)
+				self.assertLess(client.write_count - write_count, 50)
+				self.assertEqual(client.stats()["writes"]["queued_bytes"], 0)
+
+	async def test_queued_writes_are_written_when_stopping(self):
+		(client, server) = await self.connect(self.handle_request)
+		request_task = asyncio.create_task(client.request("echo", "last"))
+		await asyncio.sleep(0)
+		await client.unlisten()
+		await self.wait_for_event(self.received_evt)
+		self.assertEqual(self.received_values, ["last"])
+		self.assertEqual(client.dropped_write_count, 0)
+		request_task.cancel()
+		await asyncio.gather(request_task, return_exceptions=True)
+
+	async def test_writes_after_stopping_are_dropped(self):
+		for threaded in (False, True):
+			with self.subTest(threaded=threaded):
+				(client, server) = await self.connect(self.handle_request, threaded=threaded)
+				await server.unlisten()
+				server._write_response(PipeTalkResponse.from_result_data("1", "late"))
+				self.assertEqual(server.dropped_write_count, 1)
+				self.assertIsNone(server._writer_task)
+
+
+
+# import the plugin loader's main module without decky or its log file
+def import_main_module():
+	with unittest.mock.patch.dict(sys.modules, {"decky_plugin": types.ModuleType("decky_plugin")}), \
+			unittest.mock.patch.object(sys, "path", list(sys.path)), \
+			unittest.mock.patch("log_pipeline.setup_logging"), \
+			unittest.mock.patch.object(tracer, "process_name", tracer.process_name):
+		sys.modules.pop("main", None)
+		import main
+	return main
+
+
+
+class DaemonLockTests(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.temp_dir.cleanup)
+		self.lock_path = os.path.join(self.temp_dir.name, "daemon", "daemon.lock")
+
+	def test_only_one_holder(self):
+		lock = DaemonLock(self.lock_path)
+		self.assertFalse(lock.is_held())
+		self.assertTrue(lock.acquire())
+		self.assertTrue(lock.is_held())
+		with open(self.lock_path) as lock_file:
+			self.assertEqual(lock_file.read(), str(os.getpid()))
+		other_lock = DaemonLock(self.lock_path)
+		self.assertFalse(other_lock.acquire())
+		lock.release()
+		self.assertFalse(lock.is_held())
+		self.assertTrue(other_lock.acquire())
+		other_lock.release()
+
+	def test_backend_version_follows_source_files(self):
+		backend_dir = self.temp_dir.name
+		with open(os.path.join(backend_dir, "plugin.py"), 'w') as source_file:
+			source_file.write("a = 1\n")
+		version = get_backend_version(backend_dir)
+		with open(os.path.join(backend_dir, "notes.txt"), 'w') as other_file:
+			other_file.write("not source")
+		self.assertEqual(get_backend_version(backend_dir), version)
+		with open(os.path.join(backend_dir, "plugin.py"), 'w') as source_file:
+			source_file.write("a = 2\n")
+		self.assertNotEqual(get_backend_version(backend_dir), version)
+
+
+
+class StaleDaemonTests(PipeTalkerTestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.main_module = import_main_module()
+
+	async def asyncSetUp(self):
+		await super().asyncSetUp()
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.temp_dir.cleanup)
+		self.lock_path = os.path.join(self.temp_dir.name, "daemon.lock")
+		self.daemon_lock = DaemonLock(self.lock_path)
+		self.daemon_lock.acquire()
+		self.addCleanup(self.daemon_lock.release)
+		self.daemon_version = get_backend_version(os.path.join(self.main_module.PLUGIN_DIR, "backend"))
+		self.main_plugin = self.main_module.Plugin()
+
+	# answer like a daemon, which unloads its plugin and releases its lock a while after it's told to stop
+	async def handle_request(self, req: PipeTalkRequest):
+		if req.method_name == "get_daemon_version":
+			return {"version": self.daemon_version}
+		elif req.method_name == "stop_daemon":
+			asyncio.get_running_loop().call_later(0.1, self.daemon_lock.release)
+			return None
+		raise AttributeError("'Plugin' object has no attribute '"+req.method_name+"'")
+
+	async def test_current_daemon(self):
+		(client, server) = await self.connect(self.handle_request)
+		self.assertTrue(await self.main_plugin._is_daemon_current(client))
+
+	async def test_daemon_with_other_files(self):
+		(client, server) = await self.connect(self.handle_request)
+		self.daemon_version = "0123456789abcdef"
+		self.assertFalse(await self.main_plugin._is_daemon_current(client))
+
+	async def test_daemon_without_version_check(self):
+		async def handle_old_request(req: PipeTalkRequest):
+			raise AttributeError("'Plugin' object has no attribute '"+req.method_name+"'")
+		(client, server) = await self.connect(handle_old_request)
+		self.assertFalse(await self.main_plugin._is_daemon_current(client))
+
+	async def test_stale_daemon_is_stopped(self):
+		(client, server) = await self.connect(self.handle_request)
+		self.main_plugin.proc_pipetalker = client
+		with unittest.mock.patch.object(self.main_module, "DAEMON_LOCK_PATH", self.lock_path):
+			await self.main_plugin._stop_stale_daemon(client)
+		self.assertFalse(self.daemon_lock.is_held())
+		self.assertIsNone(self.main_plugin.proc_pipetalker)
+		self.assertIsNone(client._read_transport)
+
+
+
+class PlainDataTests(unittest.TestCase):
+	# data with the values that the codecs convert, including in rows after the first
+	def make_data(self) -> dict:
+		return {
+			"time": datetime.datetime(2024, 1, 1, 12, 0, 0),
+			"date": datetime.date(2024, 1, 1),
+			"devices": {DEVICE_PATH},
+			"range": (1, 2),
+			"rows": [
+				{"time": "2024-01-01 12:00:00", "energy_Wh": 30.0},
+				{"time": datetime.datetime(2024, 1, 1, 12, 0, 1), "energy_Wh": 29.9},
+				[datetime.time(12, 0, 2), (3, 4)]
+			],
+			"count": 3,
+			"state": None
+		}
+
+	def test_converts_like_the_codecs(self):
+		for codec_name in SUPPORTED_CODECS:
+			with self.subTest(codec=codec_name):
+				codec = get_codec(codec_name)
+				self.assertEqual(to_plain_data(self.make_data()), codec.decode(codec.encode(self.make_data())))
+
+	def test_plain_data_is_returned_as_is(self):
+		rows = [make_log_row(i) for i in range(3)]
+		self.assertIs(to_plain_data(rows), rows)
+		self.assertEqual(rows, [make_log_row(i) for i in range(3)])
+		self.assertEqual(to_plain_data("text"), "text")
+
+
+
+class LocalBackendTests(unittest.IsolatedAsyncioTestCase):
+	class FakePlugin:
+		async def get_logs(self, count: int):
+			return [{"time": datetime.datetime(2024, 1, 1, 12, 0, i), "states": ("charging",)} for i in range(count)]
+
+		async def stream_logs(self, count: int):
+			for i in range(count):
+				yield [{"time": datetime.datetime(2024, 1, 1, 12, 0, i)}]
+
+		def get_devices(self):
+			return {DEVICE_PATH}
+
+		async def fail(self):
+			raise ValueError("failed")
+
+	def setUp(self):
+		self.backend = LocalBackend(self.FakePlugin())
+
+	async def test_request_converts_results(self):
+		self.assertEqual(await self.backend.request("get_logs", {"count": 2}), [
+			{"time": "2024-01-01T12:00:00", "states": ["charging"]},
+			{"time": "2024-01-01T12:00:01", "states": ["charging"]}])
+		self.assertEqual(await self.backend.request("get_devices"), [DEVICE_PATH])
+
+	async def test_stream_converts_chunks(self):
+		chunks = [chunk async for chunk in self.backend.stream("stream_logs", {"count": 2})]
+		self.assertEqual(chunks, [[{"time": "2024-01-01T12:00:00"}], [{"time": "2024-01-01T12:00:01"}]])
+		self.assertEqual(await self.backend.request("stream_logs", {"count": 2}), [{"time": "2024-01-01T12:00:00"}, {"time": "2024-01-01T12:00:01"}])
+
+	async def test_batch(self):
+		responses = await self.backend.batch([("get_devices", None), ("fail", None)])
+		self.assertEqual(responses[0].get_result_data(), [DEVICE_PATH])
+		self.assertIsInstance(responses[1].get_error(), ValueError)
+		self.assertEqual(self.backend.running_count, 0)
+
+	async def test_private_methods_are_rejected(self):
+		with self.assertRaises(ValueError):
+			await self.backend.request("__init__")
+
+
+
+class ResponseCacheTests(unittest.IsolatedAsyncioTestCase):
+	def setUp(self):
+		self.fetch_count = 0
+
+	def make_fetch(self, result, delay: float = 0):
+		async def fetch():
+			self.fetch_count += 1
+			if delay > 0:
+				await asyncio.sleep(delay)
+			return result
+		return fetch
+
+	async def test_caches_results(self):
+		cache = ResponseCache()
+		args = {"time_start": None, "limit": 5}
+		self.assertEqual(await cache.get("get_logs", args, self.make_fetch([1])), [1])
+		self.assertEqual(await cache.get("get_logs", {"limit": 5}, self.make_fetch([2])), [1])
+		self.assertEqual(await cache.get("get_logs", {"limit": 6}, self.make_fetch([3])), [3])
+		self.assertEqual(self.fetch_count, 2)
+		self.assertEqual(cache.stats()["hits"], 1)
+		self.assertEqual(cache.stats()["misses"], 2)
+
+	async def test_single_flight(self):
+		cache = ResponseCache()
+		results = await asyncio.gather(*(cache.get("get_logs", {}, self.make_fetch([1], delay=0.01)) for _ in range(5)))
+		self.assertEqual(results, [[1]] * 5)
+		self.assertEqual(self.fetch_count, 1)
+		self.assertEqual(cache.stats()["shared"], 4)
+
+	async def test_cancelled_caller_does_not_cancel_fetch(self):
+		cache = ResponseCache()
+		first = asyncio.create_task(cache.get("get_logs", {}, self.make_fetch([1], delay=0.01)))
+		second = asyncio.create_task(cache.get("get_logs", {}, self.make_fetch([2])))
+		await asyncio.sleep(0)
+		first.cancel()
+		self.assertEqual(await second, [1])
+		self.assertEqual(self.fetch_count, 1)
+
+	async def test_failed_fetch_is_not_cached(self):
+		cache = ResponseCache()
+		async def fail():
+			raise RuntimeError("failed")
+		with self.assertRaises(RuntimeError):
+			await cache.get("get_logs", {}, fail)
+		self.assertEqual(await cache.get("get_logs", {}, self.make_fetch([1])), [1])
+		self.assertEqual(cache.stats()["fetching"], 0)
+
+	async def test_invalidate_by_table_and_range(self):
+		cache = ResponseCache()
+		morning = {"time_start": "2024-01-01T08:00:00+00:00", "time_end": "2024-01-01T12:00:00+00:00"}
+		evening = {"time_start": "2024-01-01T18:00:00+00:00", "time_end": "2024-01-01T22:00:00+00:00"}
+		await cache.get("get_logs", morning, self.make_fetch("morning"), table_name="BatteryStateLog")
+		await cache.get("get_logs", evening, self.make_fetch("evening"), table_name="BatteryStateLog")
+		await cache.get("get_events", {}, self.make_fetch("events"), table_name="PluginEventLog")
+		cache.invalidate("BatteryStateLog", changed_since=datetime.datetime(2024, 1, 1, 19, 0, tzinfo=datetime.timezone.utc))
+		self.assertEqual(cache.stats()["invalidated"], 1)
+		self.assertEqual(await cache.get("get_logs", morning, self.make_fetch("new")), "morning")
+		self.assertEqual(await cache.get("get_logs", evening, self.make_fetch("new")), "new")
+		self.assertEqual(await cache.get("get_events", {}, self.make_fetch("new")), "events")
+
+	async def test_invalidate_during_fetch(self):
+		cache = ResponseCache()
+		task = asyncio.create_task(cache.get("get_logs", {}, self.make_fetch("old", delay=0.01), table_name="BatteryStateLog"))
+		await asyncio.sleep(0)
+		cache.invalidate("BatteryStateLog")
+		self.assertEqual(await task, "old")
+		self.assertEqual(await cache.get("get_logs", {}, self.make_fetch("new")), "new")
+
+	async def test_clear(self):
+		cache = ResponseCache()
+		await cache.get("get_logs", {}, self.make_fetch("old"))
+		cache.clear()
+		self.assertEqual(await cache.get("get_logs", {}, self.make_fetch("new")), "new")
+
+	async def test_expires(self):
+		cache = ResponseCache(ttl=0.01)
+		await cache.get("get_logs", {}, self.make_fetch("old"))
+		await asyncio.sleep(0.02)
+		self.assertEqual(await cache.get("get_logs", {}, self.make_fetch("new")), "new")
+		self.assertEqual(cache.stats()["expired"], 1)
+
+	async def test_evicts_least_recently_used(self):
+		cache = ResponseCache(max_entries=2)
+		await cache.get("a", {}, self.make_fetch("a"))
+		await cache.get("b", {}, self.make_fetch("b"))
+		await cache.get("a", {}, self.make_fetch("new"))
+		await cache.get("c", {}, self.make_fetch("c"))
+		self.assertEqual(cache.stats()["evicted"], 1)
+		self.assertEqual(await cache.get("a", {}, self.make_fetch("new")), "a")
+		self.assertEqual(await cache.get("b", {}, self.make_fetch("new")), "new")
+
+	async def test_times_are_rounded_to_the_bucket(self):
+		cache = ResponseCache(time_bucket=30)
+		self.assertEqual(cache.round_time_args({
+			"time_start": "2024-01-01T11:00:05.123Z",
+			"group_by_interval_start": "2024-01-01T11:00:05.123Z",
+			"time_end": "2024-01-01T12:00:05.123Z",
+			"group_by_interval": 60,
+			"time_start_incl": True
+		}), {
+			"time_start": "2024-01-01T11:00:00+00:00",
+			"group_by_interval_start": "2024-01-01T11:00:00+00:00",
+			"time_end": "2024-01-01T12:00:30+00:00",
+			"group_by_interval": 60,
+			"time_start_incl": True
+		})
+		self.assertEqual(cache.round_time_args({"time_start": "yesterday"}), {"time_start": "yesterday"})
+
+	async def test_logs_written_after_an_open_ended_fetch(self):
+		cache = ResponseCache()
+		now = datetime.datetime.now(datetime.timezone.utc)
+		args = {"time_start": (now - datetime.timedelta(hours=1)).isoformat()}
+		await cache.get("get_logs", args, self.make_fetch("old"), table_name="BatteryStateLog")
+		# a log newer than the result doesn't change what the query read
+		later = now + datetime.timedelta(seconds=5)
+		cache.invalidate("BatteryStateLog", changed_since=later, changed_until=later)
+		self.assertEqual(await cache.get("get_logs", args, self.make_fetch("new")), "old")
+		# a log written late within the range of the query does
+		earlier = now - datetime.timedelta(minutes=5)
+		cache.invalidate("BatteryStateLog", changed_since=earlier, changed_until=earlier)
+		self.assertEqual(await cache.get("get_logs", args, self.make_fetch("new")), "new")
+
+	async def test_ui_fetches_a_few_seconds_apart(self):
+		main_plugin = import_main_module().Plugin()
+		main_plugin.response_cache = ResponseCache()
+		fetched_args = list()
+		async def fetch(args: dict):
+			fetched_args.append(args)
+			return [make_log_row(0)]
+		# the args that the battery graph gets the last hour of logs with
+		def make_ui_args(now: datetime.datetime) -> dict:
+			time_start = (now - datetime.timedelta(hours=1)).isoformat(timespec='milliseconds').replace("+00:00", "Z")
+			return {
+				"time_start": time_start,
+				"time_start_incl": True,
+				"group_by_interval_start": time_start,
+				"group_by_interval": 60
+			}
+		now = datetime.datetime(2024, 1, 1, 12, 0, 1, 250000, tzinfo=datetime.timezone.utc)
+		first = await main_plugin._cached_query("get_battery_state_logs", make_ui_args(now), fetch)
+		second = await main_plugin._cached_query("get_battery_state_logs", make_ui_args(now + datetime.timedelta(seconds=4)), fetch)
+		self.assertIs(second, first)
+		self.assertEqual(main_plugin.response_cache.stats()["hits"], 1)
+		self.assertEqual(fetched_args, [{
+			"time_start": "2024-01-01T11:00:00+00:00",
+			"time_start_incl": True,
+			"group_by_interval_start": "2024-01-01T11:00:00+00:00",
+			"group_by_interval": 60
+		}])
+
+
+
+class BackendProcessTests(unittest.TestCase):
+	def test_exits_normally_when_its_pipe_closes(self):
+		backend_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend", "__main__.py")
+		with tempfile.TemporaryDirectory() as home_dir:
+			proc = subprocess.Popen(
+				[sys.executable, backend_path],
+				env=dict(os.environ, HOME=home_dir),
+				stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE,
+				stderr=subprocess.PIPE)
+			(stdout, stderr) = proc.communicate(input=b"", timeout=30)
+		self.assertEqual(proc.returncode, 0)
+		self.assertEqual(stdout, b"")
+		self.assertNotIn(b"Traceback", stderr)
+
+
+
+class MonitorStreamTests(unittest.IsolatedAsyncioTestCase):
+	async def read_chunks(self, output: bytes, limit: int = 256) -> list:
+		monitor = UPowerMonitor()
+		chunks = list()
+		monitor._parse_monitor_chunk = lambda chunk_str, utcnow: chunks.append(chunk_str)
+		stdout = asyncio.StreamReader(limit=limit)
+		stdout.feed_data(output)
+		stdout.feed_eof()
+		await asyncio.wait_for(monitor._read_monitor_stream(None, stdout), 5)
+		return chunks
+
+	def make_chunk(self, name: str, body_size: int = 10) -> bytes:
+		return ("[12:00:00.000]\tdevice changed:     /"+name+"\n  "+("x" * body_size)+"\n\n").encode('utf8')
+
+	async def test_oversized_chunk_is_skipped(self):
+		chunks = await self.read_chunks(self.make_chunk("a") + self.make_chunk("big", 1000) + self.make_chunk("b"))
+		self.assertEqual(chunks, [self.make_chunk("a").decode('utf8'), self.make_chunk("b").decode('utf8')])
+
+	async def test_oversized_chunk_at_the_end(self):
+		chunks = await self.read_chunks(self.make_chunk("a") + self.make_chunk("big", 1000)[:-2])
+		self.assertEqual(chunks, [self.make_chunk("a").decode('utf8')])
+
+
+
+class PipeTransportTests(PipeTalkerTestCase):
+	async def handle_request(self, req: PipeTalkRequest):
+		return req.get_data()
+
+	async def test_listens_on_the_loop(self):
+		thread_count = threading.active_count()
+		(client, server) = await self.connect(self.handle_request)
+		self.assertIsNone(server._reader_thread)
+		self.assertIsNotNone(server._read_transport)
+		self.assertEqual(threading.active_count(), thread_count)
+		self.assertEqual(await client.request("echo", {"a": 1}), {"a": 1})
+
+	async def test_message_larger_than_the_pipe(self):
+		(client, server) = await self.connect(self.handle_request, shm=False, compressions=[])
+		data = "x" * (PIPE_BUFFER_SIZE * 8)
+		self.assertEqual(await client.request("echo", data), data)
+
+	async def test_wait_returns_when_the_other_end_closes(self):
+		(client, server) = await self.connect(self.handle_request)
+		await client.unlisten()
+		client.writer.close()
+		await asyncio.wait_for(server.wait(), 5)
+
+
+
+# a codec with payloads that can only be sent with binary framing
+class BinaryJsonCodec(PipeTalkCodec):
+	name = 'binary-json'
+	binary = True
+
+	def encode(self, data):
+		return b"\xff" + json.dumps(data, default=str).encode('utf8')
+
+	def decode(self, payload):
+		return json.loads(bytes(payload[1:]))
+
+
+
+class CodecNegotiationTests(PipeTalkerTestCase):
+	async def handle_request(self, req: PipeTalkRequest):
+		if req.method_name == "get_time":
+			return {"time": datetime.datetime(2024, 1, 1, 12, 0, 0), "states": ("charging", "discharging")}
+		return req.get_data()
+
+	async def test_every_codec(self):
+		for codec_name in SUPPORTED_CODECS:
+			with self.subTest(codec=codec_name):
+				(client, server) = await self.connect(self.handle_request, codecs=[codec_name])
+				self.assertEqual((client.codec, server.codec), (codec_name, codec_name))
+				self.assertEqual(await client.request("echo", {"rows": [1.5, "a", None]}), {"rows": [1.5, "a", None]})
+				self.assertEqual(await client.request("get_time"), {"time": "2024-01-01T12:00:00", "states": ["charging", "discharging"]})
+
+	async def test_first_supported_codec_is_used(self):
+		(client, server) = await self.connect(self.handle_request, codecs=["unknown", CODEC_JSON])
+		self.assertEqual((client.codec, server.codec), (CODEC_JSON, CODEC_JSON))
+
+	async def test_binary_codec_needs_binary_framing(self):
+		codec = BinaryJsonCodec()
+		with unittest.mock.patch.dict(pipetalk_codec.CODECS, {codec.name: codec}), \
+				unittest.mock.patch.object(pipetalk_module, "SUPPORTED_CODECS", [codec.name] + SUPPORTED_CODECS):
+			(client, server) = await self.connect(self.handle_request, framings=[FRAMING_TEXT], codecs=[codec.name, CODEC_JSON])
+			self.assertEqual(server.codec, CODEC_JSON)
+			(client, server) = await self.connect(self.handle_request, framings=[FRAMING_BINARY], codecs=[codec.name, CODEC_JSON])
+			self.assertEqual(server.codec, codec.name)
+			self.assertEqual(await client.request("echo", [1, 2]), [1, 2])
+
+	def test_codecs_must_implement_encode_and_decode(self):
+		with self.assertRaises(TypeError):
+			PipeTalkCodec()
+
+
+
+class LatencyHistogramTests(unittest.TestCase):
+	def test_buckets_are_within_an_eighth(self):
+		for value_us in list(range(0, 5000)) + [2 ** 20 + 12345, 2 ** 30 + 1]:
+			upper_bound = backend_stats_module._bucket_upper_bound(backend_stats_module._bucket_index(value_us))
+			self.assertGreaterEqual(upper_bound, value_us)
+			self.assertLessEqual(upper_bound, value_us * 1.125 + 1)
+
+	def test_percentiles(self):
+		histogram = LatencyHistogram()
+		self.assertEqual(histogram.to_dict(), {"count": 0})
+		for value_ms in range(1, 1001):
+			histogram.record(value_ms / 1000)
+		stats = histogram.to_dict()
+		self.assertEqual(stats["count"], 1000)
+		self.assertEqual((stats["min_ms"], stats["max_ms"]), (1, 1000))
+		self.assertAlmostEqual(stats["mean_ms"], 500.5)
+		for (name, expected_ms) in (("p50_ms", 500), ("p90_ms", 900), ("p99_ms", 990)):
+			self.assertGreaterEqual(stats[name], expected_ms)
+			self.assertLessEqual(stats[name], expected_ms * 1.125)
+
+	def test_stats(self):
+		stats = BackendStats()
+		stats.record("query", 0.002)
+		stats.increment("calls")
+		stats.increment("calls", 2)
+		stats.add_gauge("queued", lambda:3)
+		stats.add_gauge("broken", lambda:1 / 0)
+		stats.add_source("pipe", lambda:{"writes": 1})
+		stats.add_source("removed", lambda:{})
+		stats.remove_source("removed")
+		stats_dict = stats.to_dict()
+		self.assertEqual(stats_dict["latency"]["query"]["count"], 1)
+		self.assertEqual(stats_dict["counters"], {"calls": 3})
+		self.assertEqual(stats_dict["gauges"], {"queued": 3, "broken": None})
+		self.assertEqual(stats_dict["sources"], {"pipe": {"writes": 1}})
+
+
+
+class RequestLatencyTests(PipeTalkerTestCase):
+	async def test_round_trips_are_recorded(self):
+		async def handle_request(req: PipeTalkRequest):
+			return None
+		(client, server) = await self.connect(handle_request)
+		for _ in range(3):
+			await client.request("get_nothing")
+		self.assertEqual(backend_stats.histograms["pipetalk.rtt.get_nothing"].count, 3)
+
+
+
+class TracerTests(unittest.TestCase):
+	def test_spans_are_only_recorded_in_a_trace(self):
+		trace_tracer = Tracer("test")
+		with trace_tracer.span("untraced"):
+			pass
+		self.assertEqual(trace_tracer.trace_ids(), [])
+		with trace_tracer.trace("root") as trace_id:
+			with trace_tracer.span("stage", {"rows": 2}):
+				pass
+		events = trace_tracer.trace_events()
+		self.assertEqual(events[0], {"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "test"}})
+		self.assertEqual([(event["name"], event["ph"]) for event in events[1:]], [("stage", "X"), ("root", "X")])
+		self.assertEqual(events[1]["args"], {"trace_id": trace_id, "rows": 2})
+		(stage, root) = events[1:]
+		self.assertGreaterEqual(stage["ts"], root["ts"])
+		self.assertLessEqual(stage["ts"] + stage["dur"], root["ts"] + root["dur"] + 1)
+		self.assertIsNone(current_trace_id.get())
+
+	def test_keeps_the_latest_traces(self):
+		trace_tracer = Tracer()
+		trace_tracer.max_traces = 2
+		trace_tracer.max_spans_per_trace = 3
+		trace_ids = list()
+		for _ in range(3):
+			with trace_tracer.trace("root") as trace_id:
+				trace_ids.append(trace_id)
+				for _ in range(5):
+					with trace_tracer.span("stage"):
+						pass
+		self.assertEqual(trace_tracer.trace_ids(), trace_ids[1:])
+		self.assertEqual(len(trace_tracer.trace_events()), 1 + 2 * 3)
+
+	def test_write_trace_file(self):
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = os.path.join(temp_dir, "traces", "trace.json")
+			write_trace_file(path, [{"name": "a"}])
+			with open(path) as trace_file:
+				self.assertEqual(json.load(trace_file), {"traceEvents": [{"name": "a"}], "displayTimeUnit": "ms"})
+
+
+
+class RequestTraceTests(PipeTalkerTestCase):
+	async def test_trace_continues_across_the_pipe(self):
+		async def handle_request(req: PipeTalkRequest):
+			with tracer.span("handler"):
+				return current_trace_id.get()
+		(client, server) = await self.connect(handle_request)
+		tracer.clear()
+		with tracer.trace("caller") as trace_id:
+			self.assertEqual(await client.request("get_trace_id"), trace_id)
+		self.assertIsNone(await client.request("get_trace_id"))
+		span_names = {event["name"] for event in tracer.trace_events()[1:] if event["args"]["trace_id"] == trace_id}
+		self.assertTrue({"caller", "pipetalk.request get_trace_id", "pipetalk.handle get_trace_id", "handler"} <= span_names)
+		tracer.clear()
+
+
+
+class ProfilerTests(unittest.IsolatedAsyncioTestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.temp_dir.cleanup)
+
+	def test_sampler_sees_other_threads(self):
+		stop_evt = threading.Event()
+		def busy_function():
+			while not stop_evt.is_set():
+				sum(range(1000))
+		busy_thread = threading.Thread(target=busy_function, name="busy")
+		sampler = StackSampler(interval=0.001)
+		busy_thread.start()
+		sampler.start()
+		time.sleep(0.1)
+		sampler.stop()
+		stop_evt.set()
+		busy_thread.join()
+		path = os.path.join(self.temp_dir.name, "profile.collapsed")
+		sampler.write_collapsed(path)
+		with open(path) as collapsed_file:
+			lines = collapsed_file.read().splitlines()
+		self.assertGreater(sampler.sample_count, 0)
+		busy_lines = [line for line in lines if line.startswith("busy;")]
+		self.assertGreater(len(busy_lines), 0)
+		self.assertIn("busy_function (test_units.py:", busy_lines[0])
+		self.assertFalse(any(line.startswith("stack-sampler;") for line in lines))
+
+	async def test_sample_session_with_memory(self):
+		paths = await ProfilingSession(self.temp_dir.name, mode=PROFILE_MODE_SAMPLE).run(0.05)
+		self.assertEqual([os.path.splitext(path)[1] for path in paths], [".collapsed", ".tracemalloc", ".txt"])
+		self.assertTrue(all(os.path.exists(path) for path in paths))
+		self.assertFalse(tracemalloc.is_tracing())
+
+	async def test_cprofile_session(self):
+		paths = await ProfilingSession(self.temp_dir.name, mode=PROFILE_MODE_CPROFILE, trace_memory=False).run(0.01)
+		self.assertEqual(len(paths), 1)
+		self.assertTrue(paths[0].endswith(".pstats"))
+		pstats.Stats(paths[0])
+
+	def test_unknown_mode(self):
+		with self.assertRaises(ValueError):
+			ProfilingSession(self.temp_dir.name, mode="unknown")
+
+
+
+class LogPipelineTests(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.temp_dir.cleanup)
+		# the pipeline replaces the handlers of the root logger
+		root_logger = logging.getLogger()
+		(root_handlers, root_level) = (list(root_logger.handlers), root_logger.level)
+		def restore_root_logger():
+			for handler in list(root_logger.handlers):
+				root_logger.removeHandler(handler)
+			for handler in root_handlers:
+				root_logger.addHandler(handler)
+			root_logger.setLevel(root_level)
+		self.addCleanup(restore_root_logger)
+
+	def make_record(self, message: str, *args) -> logging.LogRecord:
+		return logging.LogRecord("test", logging.INFO, __file__, 0, message, args, None)
+
+	def test_full_queue_drops_records(self):
+		handler = BoundedQueueHandler(queue.Queue(2))
+		for i in range(3):
+			handler.handle(self.make_record("log %d", i))
+		self.assertEqual(handler.dropped_count, 1)
+		record = handler.queue.get_nowait()
+		# records are formatted when they're queued
+		self.assertEqual((record.msg, record.args), ("log 0", None))
+
+	def test_writes_records_from_the_listener_thread(self):
+		path = os.path.join(self.temp_dir.name, "plugin.log")
+		with open(path, 'w') as log_file:
+			log_file.write("previous run\n")
+		pipeline = LogPipeline(path, queue_size=100)
+		pipeline.start()
+		logging.getLogger().info("written by %s", "the listener")
+		logging.getLogger().debug("below the level")
+		pipeline.stop()
+		with open(path) as log_file:
+			lines = log_file.read().splitlines()
+		self.assertEqual(len(lines), 1)
+		self.assertTrue(lines[0].endswith(" INFO written by the listener"))
+		with open(path+".1") as log_file:
+			self.assertEqual(log_file.read(), "previous run\n")
+		self.assertEqual(pipeline.stats(), {"queued": 0, "dropped": 0})
+
+
+
+class BackgroundWarmUpTests(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.monitor_started = asyncio.Event()
+		self.plugin = Plugin()
+		self.plugin.db = PowerHistoryDB(dir=self.tmp_dir.name)
+		self.plugin.adaptive_sampling = False
+		self.plugin.system_signal_listener = unittest.mock.AsyncMock()
+		self.plugin.monitor = unittest.mock.AsyncMock()
+		self.plugin.monitor.start_async.side_effect = self.monitor_started.wait
+		self.plugin.monitor.stats = lambda: {}
+		self.plugin.monitor.device_infos = dict()
+
+	async def asyncTearDown(self):
+		if self.plugin.started:
+			await self.plugin._unload()
+		backend_stats.remove_source("db")
+		backend_stats.remove_source("monitor")
+		self.tmp_dir.cleanup()
+
+	async def test_main_returns_before_monitor_starts(self):
+		await asyncio.wait_for(self.plugin._main(), timeout=5)
+		self.assertFalse(self.plugin._warmup_task.done())
+		self.assertEqual(await self.plugin.db.get_battery_state_logs(), [])
+		self.assertIn("ready", startup_report.to_dict()["milestones_ms"])
+		self.plugin.system_signal_listener.listen_async.assert_awaited_once()
+		self.plugin.monitor.start_async.assert_awaited_once()
+
+	async def test_warm_up_logs_plugin_load(self):
+		await self.plugin._main()
+		self.monitor_started.set()
+		await asyncio.wait_for(self.plugin._warmup_task, timeout=5)
+		events = await self.plugin.db.get_system_event_logs()
+		self.assertEqual([event.event for event in events], [SystemEventTypes.PLUGIN_LOAD])
+		self.assertIsNotNone(self.plugin._heartbeat_task)
+
+	async def test_unload_cancels_warm_up(self):
+		await self.plugin._main()
+		warmup_task = self.plugin._warmup_task
+		await asyncio.wait_for(self.plugin._unload(), timeout=5)
+		self.assertTrue(warmup_task.cancelled())
+		self.assertIsNone(self.plugin._warmup_task)
+		self.assertIsNone(self.plugin._heartbeat_task)
+		self.plugin.system_signal_listener.unlisten_async.assert_awaited_once()
+		self.plugin.monitor.stop_async.assert_awaited_once()
+
+
+
+class SerialThreadExecutorTests(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.executor = SerialThreadExecutor("test-executor")
+
+	async def asyncTearDown(self):
+		self.executor.shutdown(wait=True)
+
+	async def test_calls_run_in_order_on_one_thread(self):
+		calls = []
+		def call(i):
+			calls.append((i, threading.get_ident()))
+			return i
+		results = await asyncio.gather(*[self.executor.run(lambda i=i:call(i)) for i in range(50)])
+		self.assertEqual(results, list(range(50)))
+		self.assertEqual([i for (i, _) in calls], list(range(50)))
+		thread_ids = set(thread_id for (_, thread_id) in calls)
+		self.assertEqual(len(thread_ids), 1)
+		self.assertNotIn(threading.get_ident(), thread_ids)
+
+	async def test_error_is_raised_to_caller(self):
+		def fail():
+			raise ValueError("failed call")
+		with self.assertRaises(ValueError):
+			await self.executor.run(fail)
+		self.assertEqual(await self.executor.run(lambda:"next"), "next")
+
+	async def test_cancelled_call_is_skipped(self):
+		release_event = threading.Event()
+		calls = []
+		blocking_task = asyncio.create_task(self.executor.run(lambda:release_event.wait(5)))
+		skipped_task = asyncio.create_task(self.executor.run(lambda:calls.append("skipped")))
+		await asyncio.sleep(0.05)
+		skipped_task.cancel()
+		await asyncio.wait([skipped_task])
+		release_event.set()
+		await blocking_task
+		await self.executor.run(lambda:calls.append("next"))
+		self.assertEqual(calls, ["next"])
+
+	async def test_shutdown_runs_submitted_calls(self):
+		calls = []
+		task = asyncio.create_task(self.executor.run(lambda:calls.append("submitted")))
+		await asyncio.sleep(0)
+		self.executor.shutdown(wait=True)
+		await task
+		self.assertEqual(calls, ["submitted"])
+		with self.assertRaises(RuntimeError):
+			await self.executor.run(lambda:None)
+
+
+
+class SingleDBThreadTests(unittest.IsolatedAsyncioTestCase):
+	async def test_db_operations_share_one_thread(self):
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			db = PowerHistoryDB(dir=tmp_dir)
+			thread_ids = set()
+			original_db_op = db._db_op
+			async def recording_db_op(callable):
+				def recording_callable():
+					thread_ids.add(threading.get_ident())
+					return callable()
+				return await original_db_op(recording_callable)
+			db._db_op = recording_db_op
+			await db.connect()
+			await asyncio.gather(*[db.add_battery_state_log(make_log(i * 60, 30.0 - i * 0.5)) for i in range(20)])
+			self.assertEqual(len(await db.get_battery_state_logs()), 20)
+			db_threads = [thread for thread in threading.enumerate() if thread.name == "power-history-db"]
+			self.assertEqual(len(db_threads), 1)
+			await db.close()
+			self.assertEqual(thread_ids, {db_threads[0].ident})
+			db_threads[0].join(timeout=5)
+			self.assertFalse(db_threads[0].is_alive())
+
+	def test_process_stats_counts_threads(self):
+		stats = process_stats()
+		self.assertGreaterEqual(stats["threads"], 1)
+		self.assertIn(threading.current_thread().name, stats["python_threads"])
+		self.assertGreaterEqual(stats["voluntary_context_switches"], 0)
+
+
+
+if __name__ == '__main__':
+	unittest.main()